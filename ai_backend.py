@@ -0,0 +1,280 @@
+"""Chat-completion backends for the AI routes and jobs.
+
+``AI_BACKEND`` selects one:
+
+- ``openai``: the OpenAI API (``OPENAI_API_KEY``, ``OPENAI_MODEL``)
+- ``fake``: a local, deterministic stand-in that never touches the network,
+  for tests, benchmarks and development without an API key
+
+Both expose ``complete(model, messages, max_tokens)`` returning the text,
+``stream(...)`` returning an iterable of text chunks with a ``close()``, and
+``close()`` to release their connections.
+Routes reach them through the per-worker AIDispatcher, which bounds how many
+calls run at once.
+"""
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AIBusy(Exception):
+    """Raised when no completion slot frees up within the queue timeout."""
+
+
+class OpenAIBackend:
+    """OpenAI (or any compatible gateway at ``base_url``) with one pooled client.
+
+    The client and its keep-alive connections are built lazily per process,
+    so forked workers never share sockets, and reused for every call.
+    """
+
+    def __init__(self, api_key, base_url=None, timeout=60, retries=2, pool_size=8):
+        self.api_key = api_key
+        self.base_url = base_url or None
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_size = pool_size
+        self._client = None
+        self._client_pid = None
+        self._client_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config.get('OPENAI_API_KEY'),
+            base_url=config.get('OPENAI_API_BASE'),
+            timeout=config.get('OPENAI_TIMEOUT', 60),
+            retries=config.get('OPENAI_RETRIES', 2),
+            pool_size=config.get('AI_MAX_CONCURRENCY', 8),
+        )
+
+    @property
+    def configured(self):
+        return bool(self.api_key)
+
+    @property
+    def client(self):
+        pid = os.getpid()
+        if self._client is None or self._client_pid != pid:
+            with self._client_lock:
+                if self._client is None or self._client_pid != pid:
+                    import httpx
+                    from openai import OpenAI
+                    self._client = OpenAI(
+                        api_key=self.api_key,
+                        base_url=self.base_url,
+                        timeout=self.timeout,
+                        max_retries=self.retries,
+                        http_client=httpx.Client(
+                            timeout=self.timeout,
+                            limits=httpx.Limits(max_connections=self.pool_size,
+                                                max_keepalive_connections=self.pool_size),
+                        ),
+                    )
+                    self._client_pid = pid
+        return self._client
+
+    def close(self):
+        """Close the pooled connections; the next call builds a new client"""
+        with self._client_lock:
+            client, self._client = self._client, None
+            if client is not None and self._client_pid == os.getpid():
+                client.close()
+
+    def complete(self, model, messages, max_tokens):
+        response = self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens
+        )
+        return response.choices[0].message.content
+
+    def stream(self, model, messages, max_tokens):
+        return _OpenAIStream(self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            stream=True
+        ))
+
+
+class _OpenAIStream:
+    def __init__(self, stream):
+        self._stream = stream
+
+    def __iter__(self):
+        for chunk in self._stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                yield delta
+
+    def close(self):
+        self._stream.close()
+
+
+class FakeBackend:
+    """Answers with the first lines of the last message, so output is
+    deterministic, shorter than the input and traceable back to it.
+    """
+    configured = True
+
+    def __init__(self, max_chars=200):
+        self.max_chars = max_chars
+
+    def close(self):
+        pass
+
+    def complete(self, model, messages, max_tokens):
+        text = re.sub(r'\s+', ' ', messages[-1]['content']).strip()
+        return f"摘要: {text[:self.max_chars]}"
+
+    def stream(self, model, messages, max_tokens):
+        text = self.complete(model, messages, max_tokens)
+        return _ListStream([text[i:i + 8] for i in range(0, len(text), 8)])
+
+
+class _ListStream(list):
+    def close(self):
+        pass
+
+
+def backend_from_config(config):
+    if config.get('AI_BACKEND') == 'fake':
+        return FakeBackend()
+    return OpenAIBackend.from_config(config)
+
+
+# Settings a backend is built from; changing any of them builds a new one
+_BACKEND_SETTINGS = ('AI_BACKEND', 'OPENAI_API_KEY', 'OPENAI_API_BASE', 'OPENAI_TIMEOUT', 'OPENAI_RETRIES')
+
+
+class AIDispatcher:
+    """Per-worker entry point for completions.
+
+    Keeps one backend for the current settings (rebuilt when PUT /api/ai/config
+    changes them), runs blocking SDK calls on a bounded thread pool instead of
+    the request's greenlet, and admits at most ``max_concurrency`` calls and
+    streams at a time; a caller that can't get a slot within
+    ``queue_timeout`` seconds gets AIBusy.
+    """
+
+    def __init__(self, max_concurrency=8, queue_timeout=30):
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._backend = None
+        self._settings = None
+        self._in_flight = {}  # backend -> calls and open streams using it
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+
+    def for_config(self, config):
+        settings = tuple(config.get(name) for name in _BACKEND_SETTINGS)
+        retired = None
+        with self._lock:
+            if self._backend is None or settings != self._settings:
+                # Calls in flight keep the old backend; the last one to finish closes it
+                if self._backend is not None and not self._in_flight.get(self._backend):
+                    retired = self._backend
+                self._backend = backend_from_config(config)
+                self._settings = settings
+            dispatched = _Dispatched(self, self._backend)
+        if retired is not None:
+            _close(retired)
+        return dispatched
+
+    def _enter(self, backend):
+        with self._lock:
+            self._in_flight[backend] = self._in_flight.get(backend, 0) + 1
+
+    def _exit(self, backend):
+        with self._lock:
+            count = self._in_flight.pop(backend) - 1
+            if count:
+                self._in_flight[backend] = count
+            retired = not count and backend is not self._backend
+        if retired:
+            _close(backend)
+
+    @property
+    def executor(self):
+        # Threads don't survive fork: build the pool in the process that uses it
+        pid = os.getpid()
+        with self._lock:
+            if self._executor is None or self._executor_pid != pid:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency,
+                                                    thread_name_prefix='ai')
+                self._executor_pid = pid
+            return self._executor
+
+    def acquire(self, backend):
+        """Take a completion slot and pin ``backend`` until release()"""
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise AIBusy('AI completion slots exhausted')
+        self._enter(backend)
+
+    def release(self, backend):
+        try:
+            self._exit(backend)
+        finally:
+            self._slots.release()
+
+
+def _close(backend):
+    # A failure to close must not fail the request that triggered it
+    try:
+        backend.close()
+    except Exception as e:
+        print(f"Failed to close AI backend: {e}")
+
+
+class _Dispatched:
+    """A backend whose calls go through the dispatcher's slots and thread pool"""
+
+    def __init__(self, dispatcher, backend):
+        self._dispatcher = dispatcher
+        self._backend = backend
+
+    @property
+    def configured(self):
+        return self._backend.configured
+
+    def complete(self, model, messages, max_tokens):
+        self._dispatcher.acquire(self._backend)
+        try:
+            return self._dispatcher.executor.submit(
+                self._backend.complete, model, messages, max_tokens).result()
+        finally:
+            self._dispatcher.release(self._backend)
+
+    def stream(self, model, messages, max_tokens):
+        """Holds a slot until the stream is closed; the request is opened on the pool"""
+        self._dispatcher.acquire(self._backend)
+        try:
+            stream = self._dispatcher.executor.submit(
+                self._backend.stream, model, messages, max_tokens).result()
+        except BaseException:
+            self._dispatcher.release(self._backend)
+            raise
+        return _SlotStream(stream, self._dispatcher, self._backend)
+
+
+class _SlotStream:
+    def __init__(self, stream, dispatcher, backend):
+        self._stream = stream
+        self._dispatcher = dispatcher
+        self._backend = backend
+        self._closed = False
+
+    def __iter__(self):
+        return iter(self._stream)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            try:
+                self._stream.close()
+            finally:
+                self._dispatcher.release(self._backend)
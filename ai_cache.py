@@ -0,0 +1,97 @@
+"""Persistent cache of AI answers and summaries.
+
+An entry is keyed by SHA-256 of (kind, model, normalized prompt, exact
+context sent to the model). The context embeds the text of every card,
+attachment and message used, so editing any of them changes the key and the
+next request misses; nothing has to be invalidated explicitly. Entries expire
+after ``ttl`` seconds and the least recently used are evicted beyond
+``max_entries``. Hit and miss counters live in the database so every worker
+reports the same numbers.
+"""
+import re
+import json
+import hashlib
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, AIResponseCache, AICacheStat
+
+
+def normalize_prompt(prompt):
+    """Case and whitespace differences don't make a different question"""
+    return re.sub(r'\s+', ' ', prompt or '').strip().casefold()
+
+
+def cache_key(kind, model, prompt, context):
+    payload = json.dumps([kind, model, normalize_prompt(prompt),
+                          hashlib.sha256((context or '').encode('utf-8')).hexdigest()],
+                         ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _count(kind, field):
+    updated = AICacheStat.query.filter_by(kind=kind).update(
+        {field: getattr(AICacheStat, field) + 1}, synchronize_session=False)
+    if not updated:
+        db.session.add(AICacheStat(kind=kind, hits=int(field == 'hits'), misses=int(field == 'misses')))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another worker created the row first
+        db.session.rollback()
+        _count(kind, field)
+
+
+def lookup(kind, key, ttl):
+    """Cached response for ``key`` or None; counts the hit or miss"""
+    cutoff = datetime.utcnow() - timedelta(seconds=ttl)
+    entry = AIResponseCache.query.filter(AIResponseCache.cache_key == key,
+                                         AIResponseCache.created_at >= cutoff).first()
+    if entry is None:
+        _count(kind, 'misses')
+        return None
+    response = entry.response
+    entry.hits = (entry.hits or 0) + 1
+    entry.last_used_at = datetime.utcnow()
+    _count(kind, 'hits')
+    return response
+
+
+def store(kind, key, model, response, ttl, max_entries):
+    """Save a fresh response, dropping expired and least recently used entries"""
+    cutoff = datetime.utcnow() - timedelta(seconds=ttl)
+    try:
+        AIResponseCache.query.filter(db.or_(AIResponseCache.cache_key == key,
+                                            AIResponseCache.created_at < cutoff))\
+            .delete(synchronize_session=False)
+        db.session.add(AIResponseCache(cache_key=key, kind=kind, model=model, response=response))
+        db.session.flush()
+        excess = AIResponseCache.query.count() - max_entries
+        if excess > 0:
+            oldest = db.session.query(AIResponseCache.id)\
+                .order_by(AIResponseCache.last_used_at.asc(), AIResponseCache.id.asc()).limit(excess)
+            AIResponseCache.query.filter(AIResponseCache.id.in_(oldest.scalar_subquery()))\
+                .delete(synchronize_session=False)
+        db.session.commit()
+    except IntegrityError:
+        # The same answer was stored concurrently by another request
+        db.session.rollback()
+
+
+def stats():
+    kinds = {}
+    for row in AICacheStat.query.all():
+        total = row.hits + row.misses
+        kinds[row.kind] = {'hits': row.hits, 'misses': row.misses,
+                           'hit_rate': round(row.hits / total, 4) if total else 0.0}
+    hits = sum(k['hits'] for k in kinds.values())
+    misses = sum(k['misses'] for k in kinds.values())
+    return {
+        'entries': AIResponseCache.query.count(),
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / (hits + misses), 4) if hits + misses else 0.0,
+        'kinds': kinds,
+    }
+
@@ -0,0 +1,140 @@
+"""Question-aware context for the AI assistant.
+
+Rather than pasting every card of a project into the prompt, the project's
+text is split into passages (card text, extracted attachment text, related
+chat messages), each passage is scored against the question with BM25 over
+the same terms the chat search uses, and the best passages are packed into
+the prompt until a token budget is spent.
+
+Callers may add a per-passage ``boost`` (the semantic index's similarity)
+so paraphrases rank too. When the question shares no terms with the project
+("总结一下进度") and nothing is boosted every score is zero and passages keep
+the order they were given in, so callers pass the most relevant-by-default
+material (recently updated cards) first.
+"""
+import math
+import re
+from collections import Counter
+
+from chat_search import tokenize
+
+_CJK_RE = re.compile('[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]')
+
+
+def estimate_tokens(text):
+    """Rough model token count: about one per CJK character, four other characters per token"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+class Passage:
+    """A piece of project text that can go into the prompt.
+
+    ``source`` is ('card' | 'attachment' | 'message', id); ``label`` is the
+    line prefix that tells the model where the text comes from.
+    """
+    __slots__ = ('source', 'card_id', 'label', 'text', 'tokens', 'terms', 'boost', 'score', 'order')
+
+    def __init__(self, source, card_id, label, text):
+        self.source = source
+        self.card_id = card_id
+        self.label = label
+        self.text = text
+        self.tokens = estimate_tokens(label) + estimate_tokens(text) + 2
+        self.terms = Counter(tokenize(label) + tokenize(text))
+        self.boost = 0.0  # Added to the lexical score, e.g. weighted semantic similarity
+        self.score = 0.0
+        self.order = 0
+
+
+def split_passages(source, card_id, label, text, max_tokens):
+    """Passages of at most about ``max_tokens`` each, split at line breaks where possible"""
+    text = (text or '').strip()
+    if estimate_tokens(text) <= max_tokens:
+        return [Passage(source, card_id, label, text)]
+    chunks = []
+    current = []
+    size = 0
+    for line in text.splitlines():
+        line_tokens = estimate_tokens(line)
+        if current and size + line_tokens > max_tokens:
+            chunks.append('\n'.join(current))
+            current, size = [], 0
+        while line_tokens > max_tokens:
+            # A single overlong line: cut it proportionally
+            cut = max(1, len(line) * max_tokens // line_tokens)
+            chunks.append(line[:cut])
+            line = line[cut:]
+            line_tokens = estimate_tokens(line)
+        if line.strip():
+            current.append(line)
+            size += line_tokens
+    if current:
+        chunks.append('\n'.join(current))
+    return [Passage(source, card_id, label, chunk) for chunk in chunks]
+
+
+def rank(question, passages, k1=1.2, b=0.75):
+    """Score ``passages`` against ``question`` (BM25 plus each passage's boost); best first, stable on ties"""
+    query_terms = set(tokenize(question))
+    count = len(passages)
+    if not count:
+        return []
+    average_length = sum(sum(p.terms.values()) for p in passages) / count or 1
+    frequency = Counter(term for p in passages for term in query_terms if term in p.terms)
+    for order, passage in enumerate(passages):
+        passage.order = order
+        length = sum(passage.terms.values())
+        score = passage.boost
+        for term in query_terms:
+            tf = passage.terms.get(term)
+            if not tf:
+                continue
+            idf = math.log(1 + (count - frequency[term] + 0.5) / (frequency[term] + 0.5))
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / average_length))
+        passage.score = score
+    return sorted(passages, key=lambda p: (-p.score, p.order))
+
+
+def pack(ranked, budget):
+    """Greedily take the best passages that fit in ``budget`` tokens; (chosen, tokens used)"""
+    chosen = []
+    used = 0
+    for passage in ranked:
+        if used + passage.tokens > budget:
+            continue
+        chosen.append(passage)
+        used += passage.tokens
+    return chosen, used
+
+
+def build_context(header, question, passages, budget):
+    """Prompt context under ``budget`` tokens plus a report of what went into it.
+
+    ``header`` (project name and description) is always included.
+    """
+    header_tokens = estimate_tokens(header)
+    chosen, tokens = pack(rank(question, passages), max(budget - header_tokens, 0))
+    # Present passages in their natural order, not by score
+    chosen.sort(key=lambda p: p.order)
+    lines = [header]
+    lines.extend(f'- {p.label}: {p.text}' for p in chosen)
+    # A card counts as used when its own text or one of its attachments is
+    used = {'cards': [], 'attachments': [], 'messages': []}
+    for p in chosen:
+        kind, source_id = p.source
+        if kind == 'attachment' and source_id not in used['attachments']:
+            used['attachments'].append(source_id)
+        elif kind == 'message':
+            used['messages'].append(source_id)
+        if p.card_id is not None and p.card_id not in used['cards']:
+            used['cards'].append(p.card_id)
+    report = {
+        **used,
+        'tokens': header_tokens + tokens,
+        'passages': len(chosen),
+        'omitted': len(passages) - len(chosen),
+    }
+    return '\n'.join(lines), report
@@ -1,43 +1,224 @@
 import os
 import uuid
 import json
-import shutil
+import hashlib
 import time
 import jwt as pyjwt
-import requests
-from datetime import datetime
+from datetime import datetime, timedelta
 from functools import wraps
+from urllib.parse import quote
 
-from flask import Flask, request, jsonify, send_from_directory, render_template
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-from flask_socketio import SocketIO, emit, join_room, leave_room
+from flask import Flask, Blueprint, Response, current_app, has_app_context, request, jsonify, send_from_directory, send_file, render_template, stream_with_context
+from flask_jwt_extended import JWTManager, create_access_token, decode_token, jwt_required, get_jwt_identity
+from flask_socketio import SocketIO, ConnectionRefusedError, emit, join_room, leave_room
 from werkzeug.utils import secure_filename
-import markdown
+from sqlalchemy.exc import IntegrityError
 import bleach
 
 from config import config
-from models import db, User, Project, Card, Category, Attachment, ChatMessage, FileVersion, project_members, UnreadStatus
-
-app = Flask(__name__)
-env = os.environ.get('FLASK_ENV', 'development')
-app.config.from_object(config.get(env, config['default']))
+from models import db, User, Project, Card, Category, Attachment, ChatMessage, FileVersion, OnlyOfficeCallback, AIJob, project_members, UnreadStatus, user_dict_cache
+from derivatives import (file_digest, derivative_path, supports_derivatives,
+                         generate_derivatives, generate_derivatives_once)
+from archive import stream_zip, archive_name, unique_archive_names
+from extraction import SANDBOXED_TYPES, limits_for, run_sandboxed
+from storage import atomic_replace, stream_to_temp, copy_atomic, link_or_copy
+from onlyoffice_client import OnlyOfficeClient, DropBatcher
+from locks import file_lock, LockTimeout
+from cache import LRUCache
+from fanout import client_manager_for
+from board_events import BoardEventCoalescer, changed_fields, change
+from presence import SocketRegistry, PresenceRegistry, TypingCoalescer
+from group_commit import GroupCommitter
+from chat_archive import (archive_old_messages, archived_after, archived_before, archived_count,
+                          archived_messages, delete_project_archive, find_archived, row_to_dict,
+                          iter_archived)
+import chat_search
+from ai_context import build_context, split_passages, estimate_tokens
+import ai_cache
+import map_reduce
+from map_reduce import SUMMARY_INSTRUCTION, MAP_INSTRUCTION
+from ai_backend import AIDispatcher, AIBusy
+import semantic_index
+from semantic_index import SemanticIndex, embedder_from_config
+from markdown_render import MarkdownRenderer
+
+# Extensions are created unbound and attached in create_app(), so gunicorn can
+# import this module once in the master (preload_app) and fork cheap workers.
+bp = Blueprint('main', __name__)
+jwt = JWTManager()
+socketio = SocketIO()
+
+def create_app(config_name=None):
+    """Application factory.
+    
+    Only builds the app object - it touches neither the filesystem nor the
+    database, so it is safe to call at import time in the gunicorn master.
+    Run init_db() once per deployment to create tables and upload folders.
+    """
+    app = Flask(__name__)
+    config_name = config_name or os.environ.get('FLASK_ENV', 'development')
+    app.config.from_object(config.get(config_name, config['default']))
+    
+    # Initialize extensions
+    db.init_app(app)
+    jwt.init_app(app)
+    # With a message queue, emits reach clients connected to any worker or node
+    socketio_options = {}
+    client_manager = client_manager_for(app.config['SOCKETIO_MESSAGE_QUEUE'],
+                                        app.config['SOCKETIO_CHANNEL'])
+    if client_manager:
+        socketio_options['client_manager'] = client_manager
+    socketio.init_app(app, cors_allowed_origins="*", async_mode='eventlet', **socketio_options)
+    
+    onlyoffice = OnlyOfficeClient.from_config(app.config)
+    app.extensions['onlyoffice'] = onlyoffice
+    app.extensions['onlyoffice_drops'] = DropBatcher(onlyoffice, socketio.start_background_task)
+    app.extensions['onlyoffice_configs'] = LRUCache(app.config['ONLYOFFICE_CONFIG_CACHE_SIZE'])
+    app.extensions['board_events'] = BoardEventCoalescer(
+        socketio.emit, socketio.start_background_task, app.config['BOARD_EVENT_WINDOW'])
+    app.extensions['sockets'] = SocketRegistry()
+    app.extensions['presence'] = PresenceRegistry(app.config['PRESENCE_TTL'])
+    app.extensions['typing'] = TypingCoalescer(
+        socketio.emit, socketio.start_background_task,
+        app.config['TYPING_WINDOW'], app.config['TYPING_INTERVAL'])
+    app.extensions['ai'] = AIDispatcher(app.config['AI_MAX_CONCURRENCY'], app.config['AI_QUEUE_TIMEOUT'])
+    app.extensions['markdown'] = MarkdownRenderer(app.config['MARKDOWN_CACHE_SIZE'])
+    app.extensions['semantic'] = SemanticIndex(app.config['SEMANTIC_INDEX_FOLDER'], embedder_from_config(app.config))
+    app.extensions['chat_ingest'] = GroupCommitter(
+        insert_chat_messages, app.config['CHAT_COMMIT_WINDOW'], app.config['CHAT_COMMIT_MAX_ROWS'])
+    user_dict_cache.maxsize = app.config['USER_CACHE_SIZE']
+    user_dict_cache.ttl = app.config['USER_CACHE_TTL']
+    
+    app.register_blueprint(bp)
+    
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Create upload folders and database tables."""
+        init_db(app)
+        print('Database initialized.')
+    
+    @app.cli.command('archive-chat')
+    def archive_chat_command():
+        """Move chat older than CHAT_ARCHIVE_AFTER_DAYS into compressed segments."""
+        print(f'Archived {run_chat_archiver(app)} chat messages.')
+    
+    @app.cli.command('reindex-semantic')
+    def reindex_semantic_command():
+        """Rebuild every project's semantic card index."""
+        with app.app_context():
+            for (project_id,) in db.session.query(Project.id).all():
+                rebuild_semantic_index(project_id)
+                print(f'Indexed project {project_id}.')
+    
+    @app.cli.command('reindex-chat')
+    def reindex_chat_command():
+        """Rebuild the chat full-text search index."""
+        print(f'Indexed {reindex_chat_messages(app)} chat messages.')
+    
+    return app
+
+def init_db(app):
+    """Create upload folders and any missing tables (idempotent)"""
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    for subdir in ('attachments', 'chat', 'versions', 'locks'):
+        os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], subdir), exist_ok=True)
+    os.makedirs(app.config['DERIVATIVE_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['CHAT_ARCHIVE_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['SEMANTIC_INDEX_FOLDER'], exist_ok=True)
+    
+    with app.app_context():
+        db.create_all()
+        # The FTS table is created outside the ORM; fill it once on creation
+        if chat_search.available(db.session) and chat_search.ensure_index(db.session):
+            db.session.commit()
+            reindex_chat_messages(app)
+
+def dispose_db_pools(app):
+    """Drop pooled DB connections inherited from a parent process.
+    
+    Called from gunicorn's post_fork hook: close=False discards the parent's
+    sockets without closing them, so the master's connections are never
+    shared with (or torn down by) a worker.
+    """
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
 
-# Ensure upload folder exists
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'attachments'), exist_ok=True)
-os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'chat'), exist_ok=True)
+# Allowed file extensions
+ALLOWED_EXTENSIONS = {'txt', 'md', 'pdf', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx', 'png', 'jpg', 'jpeg', 'gif', 'zip', 'rar'}
 
-# Initialize extensions
-db.init_app(app)
-jwt = JWTManager(app)
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
+def run_chat_archiver(app):
+    """Archive old chat once; returns messages moved (0 if another worker is at it)"""
+    days = app.config['CHAT_ARCHIVE_AFTER_DAYS']
+    if not days:
+        return 0
+    lock_path = os.path.join(app.config['UPLOAD_FOLDER'], 'locks', 'chat_archive.lock')
+    try:
+        with file_lock(lock_path, timeout=0), app.app_context():
+            try:
+                cutoff = datetime.utcnow() - timedelta(days=days)
+                return archive_old_messages(app.config['CHAT_ARCHIVE_FOLDER'], cutoff)
+            except Exception:
+                db.session.rollback()
+                raise
+    except LockTimeout:
+        return 0
+
+def reindex_chat_messages(app, batch_size=2000):
+    """Rebuild the chat search index from the hot table and the archive"""
+    folder = app.config['CHAT_ARCHIVE_FOLDER']
+    count = 0
+    with app.app_context():
+        chat_search.ensure_index(db.session)
+        chat_search.clear(db.session)
+        last_id = 0
+        while True:
+            rows = db.session.query(ChatMessage.id, ChatMessage.project_id, ChatMessage.content,
+                                    ChatMessage.file_name)\
+                .filter(ChatMessage.id > last_id).order_by(ChatMessage.id).limit(batch_size).all()
+            if not rows:
+                break
+            chat_search.index_messages(db.session, rows)
+            count += len(rows)
+            last_id = rows[-1][0]
+        batch = []
+        for row in iter_archived(folder):
+            batch.append((row['id'], row['project_id'], row['content'], row['file_name']))
+            if len(batch) >= batch_size:
+                chat_search.index_messages(db.session, batch)
+                count += len(batch)
+                batch = []
+        chat_search.index_messages(db.session, batch)
+        count += len(batch)
+        db.session.commit()
+    return count
+
+def _chat_archiver_loop(app):
+    while True:
+        socketio.sleep(app.config['CHAT_ARCHIVE_INTERVAL'])
+        try:
+            moved = run_chat_archiver(app)
+            if moved:
+                print(f"Archived {moved} chat messages")
+        except Exception as e:
+            print(f"Chat archive error: {e}")
 
-# Create tables
-with app.app_context():
-    db.create_all()
+def _presence_loop(app):
+    presence = app.extensions['presence']
+    while True:
+        socketio.sleep(app.config['PRESENCE_HEARTBEAT'])
+        try:
+            with app.app_context():
+                for room, user_id in presence.heartbeat():
+                    socketio.emit('presence', {'project_id': int(room.split('_', 1)[1]), 'joined': [], 'left': [user_id]}, room=room)
+        except Exception as e:
+            print(f"Presence heartbeat error: {e}")
 
-# Allowed file extensions
-ALLOWED_EXTENSIONS = {'txt', 'md', 'pdf', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx', 'png', 'jpg', 'jpeg', 'gif', 'zip', 'rar'}
+def start_background_jobs(app):
+    """Start periodic jobs - once per worker process, after the app is loaded"""
+    if app.config['CHAT_ARCHIVE_AFTER_DAYS'] and app.config['CHAT_ARCHIVE_INTERVAL']:
+        socketio.start_background_task(_chat_archiver_loop, app)
+    socketio.start_background_task(_presence_loop, app)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -61,74 +242,130 @@ def get_file_type(filename):
             return 'other'
     return 'other'
 
-def extract_file_content(file_path, file_type, max_content_length=50000):
+def extract_file_content(file_path, file_type, max_content_length=None):
     """Extract text content from a file for full-text search.
     
-    Returns extracted text, limited to max_content_length characters.
+    Returns a (content, error) tuple. Office and PDF parsing runs in a
+    resource-limited subprocess (see extraction.py), so a hostile file can
+    only fail its own extraction; error carries the reason in that case.
     Designed to fail gracefully and not block file operations.
     """
-    try:
-        content = None
-        
-        if file_type == 'text':
+    limits = limits_for(file_type, current_app.config.get('EXTRACTION_LIMITS'))
+    if max_content_length:
+        limits['max_chars'] = max_content_length
+    
+    if file_type == 'text':
+        try:
             with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                content = f.read(max_content_length)
-        
-        elif file_type == 'word':
-            from docx import Document
-            doc = Document(file_path)
-            content = '\n'.join([para.text for para in doc.paragraphs])
-        
-        elif file_type == 'excel':
-            import openpyxl
-            wb = openpyxl.load_workbook(file_path, data_only=True, read_only=True)
-            text_parts = []
-            for sheet_name in wb.sheetnames[:5]:  # Limit to first 5 sheets
-                ws = wb[sheet_name]
-                row_count = 0
-                for row in ws.iter_rows(values_only=True):
-                    row_count += 1
-                    if row_count > 1000:  # Limit rows per sheet
-                        break
-                    for cell in row:
-                        if cell is not None:
-                            text_parts.append(str(cell))
-            wb.close()
-            content = ' '.join(text_parts)
-        
-        elif file_type == 'powerpoint':
-            from pptx import Presentation
-            prs = Presentation(file_path)
-            text_parts = []
-            for slide in prs.slides[:50]:  # Limit to first 50 slides
-                for shape in slide.shapes:
-                    if hasattr(shape, 'text'):
-                        text_parts.append(shape.text)
-            content = '\n'.join(text_parts)
-        
-        elif file_type == 'pdf':
-            from PyPDF2 import PdfReader
-            reader = PdfReader(file_path)
-            text_parts = []
-            for page in reader.pages[:50]:  # Limit to first 50 pages
-                text = page.extract_text()
-                if text:
-                    text_parts.append(text)
-            content = '\n'.join(text_parts)
-        
-        # Truncate to max length if needed
-        if content and len(content) > max_content_length:
-            content = content[:max_content_length]
-        
-        return content
-    except Exception as e:
+                return f.read(limits['max_chars']), None
+        except OSError as e:
+            return None, str(e)
+    
+    if file_type not in SANDBOXED_TYPES:
+        return None, None
+    
+    content, error = run_sandboxed('text', file_path, file_type, limits)
+    if error:
         # Log but don't fail - content indexing is optional
-        print(f"Content extraction skipped for {file_path}: {e}")
-        return None
+        print(f"Content extraction skipped for {file_path}: {error}")
+    return content, error
+
+def schedule_derivatives(source_path, file_type):
+    """Render thumbnails / first-page previews for an upload in the background"""
+    if not supports_derivatives(file_type):
+        return
+    socketio.start_background_task(
+        generate_derivatives_once,
+        current_app.config['DERIVATIVE_FOLDER'],
+        source_path,
+        file_type,
+        current_app.config['THUMBNAIL_SIZES']
+    )
+
+def serve_derivative(source_path, file_type, digest=None):
+    """Serve a cached thumbnail for a file, rendering it on first request.
+
+    Derivatives are keyed by the file's content hash, so they can be cached by
+    clients for a long time; the hash doubles as the ETag.
+    """
+    size_name = request.args.get('size', 'md')
+    sizes = current_app.config['THUMBNAIL_SIZES']
+    if size_name not in sizes:
+        return jsonify({'error': '无效的缩略图尺寸'}), 400
+    
+    if not supports_derivatives(file_type) or not os.path.isfile(source_path):
+        return jsonify({'error': '没有可用的缩略图'}), 404
+    
+    folder = current_app.config['DERIVATIVE_FOLDER']
+    digest = digest or file_digest(source_path)
+    thumb_path = derivative_path(folder, digest, size_name)
+    
+    if not os.path.exists(thumb_path):
+        # Not rendered yet (e.g. uploaded before thumbnails existed) - render once inline
+        try:
+            rendered = generate_derivatives(folder, source_path, file_type, digest, sizes)
+        except Exception as e:
+            print(f"Thumbnail generation failed for {source_path}: {e}")
+            rendered = False
+        if not rendered:
+            return jsonify({'error': '没有可用的缩略图'}), 404
+    
+    response = send_file(
+        thumb_path,
+        mimetype='image/jpeg',
+        etag=f"{digest}_{size_name}",
+        max_age=current_app.config['THUMBNAIL_CACHE_MAX_AGE']
+    )
+    # Thumbnails of private attachments: browser cache only, never shared proxies
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+def attachment_content_hash(attachment, file_path):
+    """Return the stored content hash, back-filling it for attachments that predate hashing"""
+    if not attachment.content_hash and os.path.exists(file_path):
+        attachment.content_hash = file_digest(file_path)
+    return attachment.content_hash
+
+def record_attachment_write(attachment, file_path):
+    """Refresh size and content hash after an attachment was rewritten in place"""
+    attachment.file_size = os.path.getsize(file_path)
+    attachment.content_hash = file_digest(file_path)
+    db.session.commit()
+    # The built-in editor keeps the doc key, so make OnlyOffice re-fetch the file
+    current_app.extensions['onlyoffice_drops'].queue(attachment_doc_key(attachment))
+
+def reindex_attachment_content(attachment, file_path):
+    """Re-extract an attachment's search text, writing only if the text changed"""
+    try:
+        extracted_content, extraction_error = extract_file_content(file_path, attachment.file_type)
+        if extraction_error != attachment.extraction_error:
+            attachment.extraction_error = extraction_error
+        if extracted_content and extracted_content != attachment.content:
+            attachment.content = extracted_content
+        if db.session.is_modified(attachment):
+            db.session.commit()
+    except Exception as extract_error:
+        db.session.rollback()
+        print(f"Content extraction error (non-critical): {extract_error}")
+
+def bump_project_revision(project_id):
+    """Advance a project's board revision in the current transaction; returns the new value"""
+    db.session.execute(
+        db.update(Project).where(Project.id == project_id)
+        # Keep updated_at: the revision tracks board changes, not project edits
+        .values(revision=Project.revision + 1, updated_at=Project.updated_at)
+    )
+    return db.session.query(Project.revision).filter_by(id=project_id).scalar()
+
+def publish_board_changes(project_id, revision, changes):
+    """Queue typed board changes for the project's room (call after commit)"""
+    if changes:
+        current_app.extensions['board_events'].publish(project_id, revision, changes)
 
 # ================== AUTH ROUTES ==================
 
-@app.route('/api/auth/register', methods=['POST'])
+@bp.route('/api/auth/register', methods=['POST'])
 def register():
     data = request.get_json()
     
@@ -158,7 +395,7 @@ def register():
         'access_token': access_token
     }), 201
 
-@app.route('/api/auth/login', methods=['POST'])
+@bp.route('/api/auth/login', methods=['POST'])
 def login():
     data = request.get_json()
     
@@ -177,7 +414,7 @@ def login():
         'access_token': access_token
     })
 
-@app.route('/api/auth/me', methods=['GET'])
+@bp.route('/api/auth/me', methods=['GET'])
 @jwt_required()
 def get_current_user():
     user_id = int(get_jwt_identity())
@@ -188,7 +425,7 @@ def get_current_user():
 
 # ================== PROJECT ROUTES ==================
 
-@app.route('/api/projects', methods=['GET'])
+@bp.route('/api/projects', methods=['GET'])
 @jwt_required()
 def get_projects():
     user_id = int(get_jwt_identity())
@@ -216,7 +453,7 @@ def get_projects():
         
     return jsonify(result)
 
-@app.route('/api/projects/<int:project_id>/read', methods=['POST'])
+@bp.route('/api/projects/<int:project_id>/read', methods=['POST'])
 @jwt_required()
 def mark_project_read(project_id):
     user_id = int(get_jwt_identity())
@@ -231,7 +468,7 @@ def mark_project_read(project_id):
     db.session.commit()
     return jsonify({'success': True})
 
-@app.route('/api/projects/<int:project_id>/columns', methods=['PUT'])
+@bp.route('/api/projects/<int:project_id>/columns', methods=['PUT'])
 @jwt_required()
 def update_layout(project_id):
     user_id = int(get_jwt_identity())
@@ -262,10 +499,12 @@ def update_layout(project_id):
              return jsonify({'error': f'无法删除包含卡片的列: {", ".join(removed)}'}), 400
 
     project.columns = columns
+    revision = bump_project_revision(project_id)
     db.session.commit()
+    publish_board_changes(project_id, revision, [change('project', 'updated', project_id, {'columns': columns})])
     return jsonify(project.to_dict())
 
-@app.route('/api/projects', methods=['POST'])
+@bp.route('/api/projects', methods=['POST'])
 @jwt_required()
 def create_project():
     user_id = int(get_jwt_identity())
@@ -290,7 +529,7 @@ def create_project():
     
     return jsonify(project.to_dict()), 201
 
-@app.route('/api/projects/<int:project_id>', methods=['GET'])
+@bp.route('/api/projects/<int:project_id>', methods=['GET'])
 @jwt_required()
 def get_project(project_id):
     user_id = int(get_jwt_identity())
@@ -302,7 +541,7 @@ def get_project(project_id):
     
     return jsonify(project.to_dict(include_cards=True))
 
-@app.route('/api/projects/<int:project_id>', methods=['PUT'])
+@bp.route('/api/projects/<int:project_id>', methods=['PUT'])
 @jwt_required()
 def update_project(project_id):
     user_id = int(get_jwt_identity())
@@ -320,10 +559,14 @@ def update_project(project_id):
     if 'columns' in data:
         project.columns = data['columns']
     
+    fields = changed_fields(project)
+    revision = bump_project_revision(project_id) if fields else None
     db.session.commit()
+    if fields:
+        publish_board_changes(project_id, revision, [change('project', 'updated', project_id, fields)])
     return jsonify(project.to_dict())
 
-@app.route('/api/projects/<int:project_id>', methods=['DELETE'])
+@bp.route('/api/projects/<int:project_id>', methods=['DELETE'])
 @jwt_required()
 def delete_project(project_id):
     user_id = int(get_jwt_identity())
@@ -332,13 +575,18 @@ def delete_project(project_id):
     if project.owner_id != user_id:
         return jsonify({'error': '只有项目所有者可以删除项目'}), 403
     
+    delete_project_archive(current_app.config['CHAT_ARCHIVE_FOLDER'], project_id)
+    if chat_search.available(db.session):
+        chat_search.delete_project(db.session, project_id)
+    AIJob.query.filter_by(project_id=project_id).delete()
+    current_app.extensions['semantic'].drop(project_id)
     db.session.delete(project)
     db.session.commit()
     return jsonify({'message': '项目已删除'})
 
 # ================== MEMBER ROUTES ==================
 
-@app.route('/api/projects/<int:project_id>/invite', methods=['POST'])
+@bp.route('/api/projects/<int:project_id>/invite', methods=['POST'])
 @jwt_required()
 def invite_member(project_id):
     user_id = int(get_jwt_identity())
@@ -365,7 +613,7 @@ def invite_member(project_id):
     
     return jsonify({'message': f'{username} 已加入项目', 'user': invitee.to_dict()})
 
-@app.route('/api/projects/<int:project_id>/members', methods=['GET'])
+@bp.route('/api/projects/<int:project_id>/members', methods=['GET'])
 @jwt_required()
 def get_members(project_id):
     user_id = int(get_jwt_identity())
@@ -378,7 +626,7 @@ def get_members(project_id):
 
 # ================== CARD ROUTES ==================
 
-@app.route('/api/projects/<int:project_id>/cards', methods=['GET'])
+@bp.route('/api/projects/<int:project_id>/cards', methods=['GET'])
 @jwt_required()
 def get_cards(project_id):
     user_id = int(get_jwt_identity())
@@ -387,10 +635,11 @@ def get_cards(project_id):
     if not any(m.id == user_id for m in project.members):
         return jsonify({'error': '无权访问'}), 403
     
-    cards = Card.query.filter_by(project_id=project_id).order_by(Card.position).all()
+    cards = Card.query.filter_by(project_id=project_id)\
+        .options(db.selectinload(Card.assignees)).order_by(Card.position).all()
     return jsonify([c.to_dict() for c in cards])
 
-@app.route('/api/projects/<int:project_id>/cards', methods=['POST'])
+@bp.route('/api/projects/<int:project_id>/cards', methods=['POST'])
 @jwt_required()
 def create_card(project_id):
     user_id = int(get_jwt_identity())
@@ -437,11 +686,14 @@ def create_card(project_id):
                 card.categories.append(category)
     
     db.session.add(card)
+    revision = bump_project_revision(project_id)
     db.session.commit()
     
-    return jsonify(card.to_dict()), 201
+    card_data = card.to_dict()
+    publish_board_changes(project_id, revision, [change('card', 'created', card.id, card_data)])
+    return jsonify(card_data), 201
 
-@app.route('/api/cards/<int:card_id>', methods=['GET'])
+@bp.route('/api/cards/<int:card_id>', methods=['GET'])
 @jwt_required()
 def get_card(card_id):
     user_id = int(get_jwt_identity())
@@ -453,7 +705,7 @@ def get_card(card_id):
     
     return jsonify(card.to_dict())
 
-@app.route('/api/cards/<int:card_id>', methods=['PUT'])
+@bp.route('/api/cards/<int:card_id>', methods=['PUT'])
 @jwt_required()
 def update_card(card_id):
     user_id = int(get_jwt_identity())
@@ -480,6 +732,9 @@ def update_card(card_id):
     if 'due_date' in data:
         card.due_date = datetime.fromisoformat(data['due_date']) if data['due_date'] else None
     
+    # Read before the lookups below autoflush and clear the change history
+    fields = changed_fields(card)
+    
     # Update assignees
     if 'assignee_ids' in data:
         card.assignees = []
@@ -496,10 +751,18 @@ def update_card(card_id):
             if category and category.project_id == project.id:
                 card.categories.append(category)
     
+    if 'assignee_ids' in data:
+        fields['assignees'] = [u.to_dict() for u in card.assignees]
+    if 'category_ids' in data:
+        fields['categories'] = [c.to_dict() for c in card.categories]
+    
+    revision = bump_project_revision(project.id) if fields else None
     db.session.commit()
+    if fields:
+        publish_board_changes(project.id, revision, [change('card', 'updated', card.id, fields)])
     return jsonify(card.to_dict())
 
-@app.route('/api/cards/<int:card_id>', methods=['DELETE'])
+@bp.route('/api/cards/<int:card_id>', methods=['DELETE'])
 @jwt_required()
 def delete_card(card_id):
     user_id = int(get_jwt_identity())
@@ -511,15 +774,18 @@ def delete_card(card_id):
     
     # Delete associated attachments files
     for attachment in card.attachments:
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'attachments', attachment.filename)
+        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'attachments', attachment.filename)
         if os.path.exists(file_path):
             os.remove(file_path)
     
+    project_id = card.project_id
     db.session.delete(card)
+    revision = bump_project_revision(project_id)
     db.session.commit()
+    publish_board_changes(project_id, revision, [change('card', 'deleted', card_id)])
     return jsonify({'message': '卡片已删除'})
 
-@app.route('/api/cards/reorder', methods=['POST'])
+@bp.route('/api/cards/reorder', methods=['POST'])
 @jwt_required()
 def reorder_cards():
     user_id = int(get_jwt_identity())
@@ -528,6 +794,7 @@ def reorder_cards():
     if not data or not data.get('cards'):
         return jsonify({'error': '无效数据'}), 400
     
+    changes_by_project = {}
     for card_data in data['cards']:
         card = Card.query.get(card_data['id'])
         if card:
@@ -535,13 +802,22 @@ def reorder_cards():
             if any(m.id == user_id for m in project.members):
                 card.column = card_data.get('column', card.column)
                 card.position = card_data.get('position', card.position)
-    
+                # Before the next lookup autoflushes this card
+                fields = changed_fields(card)
+                if fields:
+                    changes_by_project.setdefault(project.id, []).append(
+                        change('card', 'updated', card.id, fields))
+    
+    # One revision per project, however many cards moved
+    revisions = {pid: bump_project_revision(pid) for pid in changes_by_project}
     db.session.commit()
+    for pid, changes in changes_by_project.items():
+        publish_board_changes(pid, revisions[pid], changes)
     return jsonify({'message': '卡片顺序已更新'})
 
 # ================== SEARCH ROUTE ==================
 
-@app.route('/api/projects/<int:project_id>/cards/search', methods=['GET'])
+@bp.route('/api/projects/<int:project_id>/cards/search', methods=['GET'])
 @jwt_required()
 def search_cards(project_id):
     user_id = int(get_jwt_identity())
@@ -593,12 +869,143 @@ def search_cards(project_id):
     if assignee_id:
         query = query.filter(Card.assignees.any(id=int(assignee_id)))
     
-    cards = query.order_by(Card.position).all()
+    cards = query.options(db.selectinload(Card.assignees)).order_by(Card.position).all()
     return jsonify([c.to_dict() for c in cards])
 
+@bp.route('/api/projects/<int:project_id>/cards/similar', methods=['GET'])
+@jwt_required()
+def similar_cards(project_id):
+    """Cards whose text (or attachments) is closest to ?q=<text> or to ?card_id=<id>"""
+    user_id = int(get_jwt_identity())
+    project = Project.query.get_or_404(project_id)
+    
+    if not any(m.id == user_id for m in project.members):
+        return jsonify({'error': '无权访问'}), 403
+    
+    index = project_semantic_index(project_id)
+    if index is None:
+        return jsonify({'error': '语义索引不可用，请安装 numpy'}), 503
+    
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    card_id = request.args.get('card_id', type=int)
+    if card_id:
+        card = Card.query.filter_by(id=card_id, project_id=project_id).first()
+        if not card:
+            return jsonify({'error': '卡片不存在'}), 404
+        text = card_index_text(card.title, card.content, card.content_type)
+    else:
+        text = request.args.get('q', '').strip()
+        if not text:
+            return jsonify({'error': '请输入搜索内容'}), 400
+    
+    # Rows are cards and attachments; a card ranks by its best row
+    scores = index.card_scores(project_id, text, k=limit * 4 + 1)
+    scores.pop(card_id, None)
+    ranked = sorted(scores.items(), key=lambda item: -item[1])[:limit]
+    cards = {c.id: c for c in Card.query.filter(Card.id.in_([cid for cid, _ in ranked]))
+             .options(db.selectinload(Card.assignees)).all()} if ranked else {}
+    return jsonify([{'card': cards[cid].to_dict(), 'score': round(score, 4)}
+                    for cid, score in ranked if cid in cards])
+
+def card_index_text(title, content, content_type):
+    """Plain text of a card for indexing and prompts"""
+    if content_type == 'html':
+        content = bleach.clean(content or '', tags=[], strip=True)
+    return f"{title}\n{content or ''}"
+
+def semantic_index_items(project_id):
+    items = [('card', card_id, card_id, card_index_text(title, content, content_type))
+             for card_id, title, content, content_type in db.session.query(
+                 Card.id, Card.title, Card.content, Card.content_type).filter_by(project_id=project_id)]
+    items += [('attachment', attachment_id, card_id, f"{filename}\n{content or ''}")
+              for attachment_id, card_id, filename, content in db.session.query(
+                  Attachment.id, Attachment.card_id, Attachment.original_filename, Attachment.content)
+              .join(Card).filter(Card.project_id == project_id)]
+    return items
+
+def rebuild_semantic_index(project_id):
+    current_app.extensions['semantic'].build(project_id, semantic_index_items(project_id))
+
+def project_semantic_index(project_id):
+    """The semantic index with this project's vectors built, or None without numpy"""
+    if not semantic_index.available:
+        return None
+    index = current_app.extensions['semantic']
+    # Built on first use; concurrent first requests wait for a single build
+    index.ensure(project_id, lambda: semantic_index_items(project_id))
+    return index
+
+# Card and attachment text changes reach the semantic index once committed:
+# collected after each flush (while history is still available), applied
+# after commit, dropped on rollback.
+SEMANTIC_FIELDS = {Card: ('title', 'content', 'content_type'), Attachment: ('original_filename', 'content')}
+
+def _text_changed(obj):
+    state = db.inspect(obj)
+    return any(state.attrs[name].history.has_changes() for name in SEMANTIC_FIELDS[type(obj)])
+
+def _attachment_project_id(session, attachment):
+    # New attachments usually carry only card_id; pending objects don't lazy-load
+    if attachment.card is not None:
+        return attachment.card.project_id
+    return session.query(Card.project_id).filter_by(id=attachment.card_id).scalar()
+
+@db.event.listens_for(db.session, 'after_flush')
+def _collect_semantic_changes(session, flush_context):
+    if not semantic_index.available:
+        return
+    pending = session.info.setdefault('semantic_pending', [])
+    for obj in session.deleted:
+        if isinstance(obj, Card):
+            pending.append((obj.project_id, 'delete_card', obj.id))
+        elif isinstance(obj, Attachment):
+            project_id = _attachment_project_id(session, obj)
+            if project_id is not None:
+                pending.append((project_id, 'delete', ('attachment', obj.id)))
+    for obj in list(session.new) + list(session.dirty):
+        if type(obj) not in SEMANTIC_FIELDS or (obj not in session.new and not _text_changed(obj)):
+            continue
+        if isinstance(obj, Card):
+            pending.append((obj.project_id, 'upsert',
+                            ('card', obj.id, obj.id, card_index_text(obj.title, obj.content, obj.content_type))))
+        else:
+            project_id = _attachment_project_id(session, obj)
+            if project_id is None:
+                continue
+            pending.append((project_id, 'upsert',
+                            ('attachment', obj.id, obj.card_id, f"{obj.original_filename}\n{obj.content or ''}")))
+
+@db.event.listens_for(db.session, 'after_commit')
+def _apply_semantic_changes(session):
+    pending = session.info.pop('semantic_pending', None)
+    if not pending or not has_app_context():
+        return
+    by_project = {}
+    for project_id, op, arg in pending:
+        ops = by_project.setdefault(project_id, {'upserts': {}, 'deletes': [], 'deleted_cards': []})
+        if op == 'upsert':
+            ops['upserts'][arg[:2]] = arg  # Last write of an item wins
+        elif op == 'delete':
+            ops['upserts'].pop(arg, None)
+            ops['deletes'].append(arg)
+        else:
+            ops['upserts'] = {key: u for key, u in ops['upserts'].items() if u[2] != arg}
+            ops['deleted_cards'].append(arg)
+    index = current_app.extensions['semantic']
+    for project_id, ops in by_project.items():
+        try:
+            index.apply(project_id, list(ops['upserts'].values()), ops['deletes'], ops['deleted_cards'])
+        except Exception as e:
+            # The index is derived data; a failed update is fixed by reindex-semantic
+            print(f"Semantic index update error (project {project_id}): {e}")
+
+@db.event.listens_for(db.session, 'after_rollback')
+def _drop_semantic_changes(session):
+    session.info.pop('semantic_pending', None)
+
 # ================== CATEGORY ROUTES ==================
 
-@app.route('/api/projects/<int:project_id>/categories', methods=['GET'])
+@bp.route('/api/projects/<int:project_id>/categories', methods=['GET'])
 @jwt_required()
 def get_categories(project_id):
     user_id = int(get_jwt_identity())
@@ -610,7 +1017,7 @@ def get_categories(project_id):
     categories = Category.query.filter_by(project_id=project_id).all()
     return jsonify([c.to_dict() for c in categories])
 
-@app.route('/api/projects/<int:project_id>/categories', methods=['POST'])
+@bp.route('/api/projects/<int:project_id>/categories', methods=['POST'])
 @jwt_required()
 def create_category(project_id):
     user_id = int(get_jwt_identity())
@@ -631,11 +1038,14 @@ def create_category(project_id):
     )
     
     db.session.add(category)
+    revision = bump_project_revision(project_id)
     db.session.commit()
     
-    return jsonify(category.to_dict()), 201
+    category_data = category.to_dict()
+    publish_board_changes(project_id, revision, [change('category', 'created', category.id, category_data)])
+    return jsonify(category_data), 201
 
-@app.route('/api/categories/<int:category_id>', methods=['PUT'])
+@bp.route('/api/categories/<int:category_id>', methods=['PUT'])
 @jwt_required()
 def update_category(category_id):
     user_id = int(get_jwt_identity())
@@ -652,10 +1062,14 @@ def update_category(category_id):
     if 'color' in data:
         category.color = data['color']
     
+    fields = changed_fields(category)
+    revision = bump_project_revision(project.id) if fields else None
     db.session.commit()
+    if fields:
+        publish_board_changes(project.id, revision, [change('category', 'updated', category.id, fields)])
     return jsonify(category.to_dict())
 
-@app.route('/api/categories/<int:category_id>', methods=['DELETE'])
+@bp.route('/api/categories/<int:category_id>', methods=['DELETE'])
 @jwt_required()
 def delete_category(category_id):
     user_id = int(get_jwt_identity())
@@ -665,13 +1079,16 @@ def delete_category(category_id):
     if not any(m.id == user_id for m in project.members):
         return jsonify({'error': '无权删除类别'}), 403
     
+    project_id = project.id
     db.session.delete(category)
+    revision = bump_project_revision(project_id)
     db.session.commit()
+    publish_board_changes(project_id, revision, [change('category', 'deleted', category_id)])
     return jsonify({'message': '类别已删除'})
 
 # ================== ATTACHMENT ROUTES ==================
 
-@app.route('/api/cards/<int:card_id>/attachments', methods=['POST'])
+@bp.route('/api/cards/<int:card_id>/attachments', methods=['POST'])
 @jwt_required()
 def upload_attachment(card_id):
     user_id = int(get_jwt_identity())
@@ -694,12 +1111,12 @@ def upload_attachment(card_id):
             ext = original_filename.rsplit('.', 1)[1].lower() if '.' in original_filename else ''
             unique_filename = f"{uuid.uuid4().hex}.{ext}" if ext else uuid.uuid4().hex
             
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'attachments', unique_filename)
+            file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'attachments', unique_filename)
             file.save(file_path)
             
             # Extract text content from file for search
             file_type = get_file_type(original_filename)
-            extracted_content = extract_file_content(file_path, file_type)
+            extracted_content, extraction_error = extract_file_content(file_path, file_type)
             
             attachment = Attachment(
                 card_id=card_id,
@@ -707,15 +1124,18 @@ def upload_attachment(card_id):
                 original_filename=original_filename,
                 file_type=file_type,
                 file_size=os.path.getsize(file_path),
-                content=extracted_content
+                content_hash=file_digest(file_path),
+                content=extracted_content,
+                extraction_error=extraction_error
             )
             db.session.add(attachment)
             attachments.append(attachment)
+            schedule_derivatives(file_path, file_type)
     
     db.session.commit()
     return jsonify([a.to_dict() for a in attachments]), 201
 
-@app.route('/api/attachments/<int:attachment_id>', methods=['GET'])
+@bp.route('/api/attachments/<int:attachment_id>', methods=['GET'])
 @jwt_required()
 def download_attachment(attachment_id):
     user_id = int(get_jwt_identity())
@@ -727,13 +1147,77 @@ def download_attachment(attachment_id):
         return jsonify({'error': '无权下载附件'}), 403
     
     return send_from_directory(
-        os.path.join(app.config['UPLOAD_FOLDER'], 'attachments'),
+        os.path.join(current_app.config['UPLOAD_FOLDER'], 'attachments'),
         attachment.filename,
         as_attachment=True,
         download_name=attachment.original_filename
     )
 
-@app.route('/api/attachments/<int:attachment_id>/content', methods=['GET'])
+def zip_response(entries, download_name):
+    """Stream (arcname, file_path) entries to the client as a ZIP archive"""
+    response = Response(stream_with_context(stream_zip(entries)), mimetype='application/zip')
+    response.headers['Content-Disposition'] = (
+        f"attachment; filename=\"attachments.zip\"; filename*=UTF-8''{quote(download_name)}"
+    )
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@bp.route('/api/cards/<int:card_id>/attachments.zip', methods=['GET'])
+@jwt_required()
+def download_card_attachments_zip(card_id):
+    """Download all attachments of a card as one streamed ZIP"""
+    user_id = int(get_jwt_identity())
+    card = Card.query.get_or_404(card_id)
+    project = card.project
+    
+    if not any(m.id == user_id for m in project.members):
+        return jsonify({'error': '无权下载附件'}), 403
+    
+    attachments = card.attachments.order_by(Attachment.id).all()
+    if not attachments:
+        return jsonify({'error': '此卡片没有附件'}), 404
+    
+    attachments_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'attachments')
+    names = unique_archive_names([archive_name(a.original_filename) for a in attachments])
+    entries = [(name, os.path.join(attachments_dir, a.filename)) for name, a in zip(names, attachments)]
+    
+    return zip_response(entries, f"{archive_name(card.title)}.zip")
+
+@bp.route('/api/projects/<int:project_id>/attachments.zip', methods=['GET'])
+@jwt_required()
+def download_project_attachments_zip(project_id):
+    """Download all attachments of a project as one streamed ZIP, one folder per card"""
+    user_id = int(get_jwt_identity())
+    project = Project.query.get_or_404(project_id)
+    
+    if not any(m.id == user_id for m in project.members):
+        return jsonify({'error': '无权下载附件'}), 403
+    
+    rows = db.session.query(Attachment, Card.id, Card.title)\
+        .join(Card, Attachment.card_id == Card.id)\
+        .filter(Card.project_id == project_id)\
+        .order_by(Card.column, Card.position, Card.id, Attachment.id)\
+        .all()
+    if not rows:
+        return jsonify({'error': '此项目没有附件'}), 404
+    
+    attachments_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'attachments')
+    names = unique_archive_names([
+        f"{card_id}_{archive_name(card_title)}/{archive_name(a.original_filename)}"
+        for a, card_id, card_title in rows
+    ])
+    entries = [(name, os.path.join(attachments_dir, a.filename)) for name, (a, _, _) in zip(names, rows)]
+    
+    return zip_response(entries, f"{archive_name(project.name)}.zip")
+
+@bp.route('/api/attachments/<int:attachment_id>/thumbnail', methods=['GET'])
+def get_attachment_thumbnail(attachment_id):
+    """Serve a size-bucketed thumbnail for image and PDF attachments"""
+    attachment = Attachment.query.get_or_404(attachment_id)
+    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'attachments', attachment.filename)
+    return serve_derivative(file_path, attachment.file_type, attachment.content_hash)
+
+@bp.route('/api/attachments/<int:attachment_id>/content', methods=['GET'])
 @jwt_required()
 def get_attachment_content(attachment_id):
     user_id = int(get_jwt_identity())
@@ -744,66 +1228,23 @@ def get_attachment_content(attachment_id):
     if not any(m.id == user_id for m in project.members):
         return jsonify({'error': '无权访问附件'}), 403
     
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'attachments', attachment.filename)
+    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'attachments', attachment.filename)
     
     if attachment.file_type == 'text':
         with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
             content = f.read()
         return jsonify({'content': content, 'type': 'text'})
     
-    elif attachment.file_type == 'word':
-        try:
-            from docx import Document
-            doc = Document(file_path)
-            content = '\n\n'.join([para.text for para in doc.paragraphs])
-            return jsonify({'content': content, 'type': 'word'})
-        except Exception as e:
-            return jsonify({'error': str(e)}), 500
-    
-    elif attachment.file_type == 'excel':
-        try:
-            import openpyxl
-            wb = openpyxl.load_workbook(file_path, data_only=True)
-            sheets = {}
-            for sheet_name in wb.sheetnames:
-                ws = wb[sheet_name]
-                data = []
-                for row in ws.iter_rows(values_only=True):
-                    data.append([str(cell) if cell is not None else '' for cell in row])
-                sheets[sheet_name] = data
-            return jsonify({'content': sheets, 'type': 'excel'})
-        except Exception as e:
-            return jsonify({'error': str(e)}), 500
-    
-    elif attachment.file_type == 'powerpoint':
-        try:
-            from pptx import Presentation
-            prs = Presentation(file_path)
-            slides = []
-            for slide in prs.slides:
-                slide_content = []
-                for shape in slide.shapes:
-                    if hasattr(shape, 'text'):
-                        slide_content.append(shape.text)
-                slides.append('\n'.join(slide_content))
-            return jsonify({'content': slides, 'type': 'powerpoint'})
-        except Exception as e:
-            return jsonify({'error': str(e)}), 500
-    
-    elif attachment.file_type == 'pdf':
-        try:
-            from PyPDF2 import PdfReader
-            reader = PdfReader(file_path)
-            pages = []
-            for page in reader.pages:
-                pages.append(page.extract_text() or '')
-            return jsonify({'content': pages, 'type': 'pdf'})
-        except Exception as e:
-            return jsonify({'error': str(e)}), 500
+    elif attachment.file_type in SANDBOXED_TYPES:
+        limits = limits_for(attachment.file_type, current_app.config.get('EXTRACTION_LIMITS'))
+        content, error = run_sandboxed('preview', file_path, attachment.file_type, limits)
+        if error:
+            return jsonify({'error': f'无法解析文件: {error}'}), 500
+        return jsonify({'content': content, 'type': attachment.file_type})
     
     return jsonify({'error': '不支持的文件类型'}), 400
 
-@app.route('/api/attachments/<int:attachment_id>/content', methods=['PUT'])
+@bp.route('/api/attachments/<int:attachment_id>/content', methods=['PUT'])
 @jwt_required()
 def update_attachment_content(attachment_id):
     user_id = int(get_jwt_identity())
@@ -820,26 +1261,23 @@ def update_attachment_content(attachment_id):
     if content is None:
         return jsonify({'error': '没有内容'}), 400
     
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'attachments', attachment.filename)
+    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'attachments', attachment.filename)
     
     if attachment.file_type == 'text':
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(content)
-        return jsonify({'message': '文件已保存'})
+        def write(tmp_path):
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(content)
     
     elif attachment.file_type == 'word':
-        try:
+        def write(tmp_path):
             from docx import Document
             doc = Document()
             for para in content.split('\n\n'):
                 doc.add_paragraph(para)
-            doc.save(file_path)
-            return jsonify({'message': '文件已保存'})
-        except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            doc.save(tmp_path)
     
     elif attachment.file_type == 'excel':
-        try:
+        def write(tmp_path):
             import openpyxl
             wb = openpyxl.Workbook()
             for sheet_name, data in content.items():
@@ -851,14 +1289,27 @@ def update_attachment_content(attachment_id):
                 for row_idx, row in enumerate(data, 1):
                     for col_idx, value in enumerate(row, 1):
                         ws.cell(row=row_idx, column=col_idx, value=value)
-            wb.save(file_path)
-            return jsonify({'message': '文件已保存'})
-        except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            wb.save(tmp_path)
+    
+    else:
+        return jsonify({'error': '此文件类型不支持在线编辑'}), 400
     
-    return jsonify({'error': '此文件类型不支持在线编辑'}), 400
+    try:
+        # Serialize with OnlyOffice saves and restores of this attachment in any worker
+        with attachment_write_lock(attachment_id):
+            db.session.refresh(attachment)
+            with atomic_replace(file_path) as tmp_path:
+                write(tmp_path)
+            record_attachment_write(attachment, file_path)
+    except LockTimeout:
+        db.session.rollback()
+        return jsonify({'error': '文件正在保存中，请稍后重试'}), 409
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+    return jsonify({'message': '文件已保存'})
 
-@app.route('/api/attachments/<int:attachment_id>', methods=['DELETE'])
+@bp.route('/api/attachments/<int:attachment_id>', methods=['DELETE'])
 @jwt_required()
 def delete_attachment(attachment_id):
     user_id = int(get_jwt_identity())
@@ -870,12 +1321,12 @@ def delete_attachment(attachment_id):
         return jsonify({'error': '无权删除附件'}), 403
     
     # Delete the physical file
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'attachments', attachment.filename)
+    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'attachments', attachment.filename)
     if os.path.exists(file_path):
         os.remove(file_path)
     
     # Also delete any version files
-    versions_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'versions')
+    versions_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'versions')
     for version in attachment.versions.all():
         version_path = os.path.join(versions_dir, version.file_path)
         if os.path.exists(version_path):
@@ -894,30 +1345,81 @@ def delete_attachment(attachment_id):
 
 def generate_onlyoffice_token(payload):
     """Generate JWT token for OnlyOffice Document Server"""
-    secret = app.config.get('ONLYOFFICE_JWT_SECRET', 'teamwork-onlyoffice-secret-key')
+    secret = current_app.config.get('ONLYOFFICE_JWT_SECRET', 'teamwork-onlyoffice-secret-key')
     return pyjwt.encode(payload, secret, algorithm='HS256')
 
+def attachment_write_lock(attachment_id):
+    """Cross-worker lock serializing every write to one attachment and its versions"""
+    return file_lock(
+        os.path.join(current_app.config['UPLOAD_FOLDER'], 'locks', f"attachment_{attachment_id}.lock"),
+        timeout=current_app.config['ATTACHMENT_LOCK_TIMEOUT']
+    )
+
+def next_version_number(attachment_id):
+    """Allocate the next version number - call with attachment_write_lock held.
+    
+    The lock makes max()+1 safe between workers on this host; the unique
+    (attachment_id, version_number) constraint catches anything else.
+    """
+    current = db.session.query(db.func.max(FileVersion.version_number))\
+        .filter(FileVersion.attachment_id == attachment_id).scalar()
+    return (current or 0) + 1
+
+def onlyoffice_client():
+    """The app's pooled OnlyOffice Document Server client"""
+    return current_app.extensions['onlyoffice']
+
+def editor_config_cache():
+    """Per-worker cache of signed OnlyOffice editor configs"""
+    return current_app.extensions['onlyoffice_configs']
+
+def attachment_doc_key(attachment):
+    """OnlyOffice document key - changes whenever the file is replaced"""
+    # Use millisecond precision to ensure key changes even if modifications happen in same second
+    return f"{attachment.id}_{int(attachment.uploaded_at.timestamp() * 1000)}"
+
 def drop_onlyoffice_cache(doc_key):
     """Tell OnlyOffice to drop cached document so restored version is shown"""
+    return onlyoffice_client().drop(doc_key)
+
+def claim_onlyoffice_callback(key, status, url):
+    """Record a callback delivery, returning its dedupe key or None if already handled.
+    
+    Deliveries are identified by (key, status, url), so an OnlyOffice retry of
+    a save we already processed is acknowledged without creating a second
+    version. The unique constraint makes this safe across workers.
+    """
+    dedupe_key = hashlib.sha256(f"{key}|{status}|{url}".encode('utf-8')).hexdigest()
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config['ONLYOFFICE_CALLBACK_DEDUP_TTL'])
+    
     try:
-        onlyoffice_url = app.config.get('ONLYOFFICE_URL', 'http://localhost:8080').rstrip('/')
-        command_url = f"{onlyoffice_url}/coauthoring/CommandService.ashx"
-        
-        payload = {"c": "drop", "key": doc_key}
-        
-        # Add JWT token if configured
-        secret = app.config.get('ONLYOFFICE_JWT_SECRET')
-        if secret:
-            payload["token"] = pyjwt.encode(payload, secret, algorithm='HS256')
-        
-        response = requests.post(command_url, json=payload, timeout=5)
-        return response.status_code == 200
+        OnlyOfficeCallback.query.filter(OnlyOfficeCallback.created_at < cutoff).delete()
+        db.session.add(OnlyOfficeCallback(dedupe_key=dedupe_key))
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+    return dedupe_key
+
+def release_onlyoffice_callback(dedupe_key):
+    """Forget a failed delivery so OnlyOffice's retry gets processed"""
+    try:
+        OnlyOfficeCallback.query.filter_by(dedupe_key=dedupe_key).delete()
+        db.session.commit()
     except Exception as e:
-        print(f"Failed to drop OnlyOffice cache for key {doc_key}: {e}")
-        return False
+        db.session.rollback()
+        print(f"Failed to release OnlyOffice callback {dedupe_key}: {e}")
 
+def download_onlyoffice_file(url, directory):
+    """Stream a saved document from OnlyOffice into a temp file in directory.
+    
+    Returns (tmp_path, size, sha256). Memory use is constant regardless of
+    document size; the caller renames the temp file into place.
+    """
+    with onlyoffice_client().download(url) as response:
+        return stream_to_temp(response.iter_content(chunk_size=64 * 1024), directory)
 
-@app.route('/api/attachments/<int:attachment_id>/onlyoffice-config', methods=['GET'])
+@bp.route('/api/attachments/<int:attachment_id>/onlyoffice-config', methods=['GET'])
 @jwt_required()
 def get_onlyoffice_config(attachment_id):
     """Generate OnlyOffice editor configuration"""
@@ -944,13 +1446,18 @@ def get_onlyoffice_config(attachment_id):
     
     # Build file URL that OnlyOffice can access from Docker container
     # Use INTERNAL_URL config for Docker bridge access (not localhost which Docker can't reach)
-    internal_url = app.config.get('INTERNAL_URL', 'http://172.17.0.1:5000').rstrip('/')
+    internal_url = current_app.config.get('INTERNAL_URL', 'http://172.17.0.1:5000').rstrip('/')
     file_url = f"{internal_url}/api/attachments/{attachment_id}/download"
     callback_url = f"{internal_url}/api/onlyoffice/callback"
     
     # Create a unique document key (changes when file is modified)
-    # Use millisecond precision to ensure key changes even if modifications happen in same second
-    doc_key = f"{attachment_id}_{int(attachment.uploaded_at.timestamp() * 1000)}"
+    doc_key = attachment_doc_key(attachment)
+    
+    # Signed configs are reused until the file changes (new doc_key)
+    cache_key = ('attachment', attachment_id, doc_key, user.id, user.username)
+    cached = editor_config_cache().get(cache_key)
+    if cached:
+        return jsonify(cached)
     
     # Build OnlyOffice configuration
     config = {
@@ -992,28 +1499,30 @@ def get_onlyoffice_config(attachment_id):
     # Generate JWT token and add to config
     config["token"] = generate_onlyoffice_token(config)
     
-    return jsonify({
+    result = {
         'config': config,
-        'onlyoffice_url': app.config.get('ONLYOFFICE_URL', 'http://localhost:8080')
-    })
+        'onlyoffice_url': current_app.config.get('ONLYOFFICE_URL', 'http://localhost:8080')
+    }
+    editor_config_cache().set(cache_key, result)
+    return jsonify(result)
 
-@app.route('/api/attachments/<int:attachment_id>/download', methods=['GET'])
+@bp.route('/api/attachments/<int:attachment_id>/download', methods=['GET'])
 def download_attachment_for_onlyoffice(attachment_id):
     """Serve file for OnlyOffice to download"""
     attachment = Attachment.query.get_or_404(attachment_id)
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'attachments', attachment.filename)
+    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'attachments', attachment.filename)
     
     if not os.path.exists(file_path):
         return jsonify({'error': '文件不存在'}), 404
     
     return send_from_directory(
-        os.path.join(app.config['UPLOAD_FOLDER'], 'attachments'),
+        os.path.join(current_app.config['UPLOAD_FOLDER'], 'attachments'),
         attachment.filename,
         as_attachment=True,
         download_name=attachment.original_filename
     )
 
-@app.route('/api/onlyoffice/callback', methods=['POST'])
+@bp.route('/api/onlyoffice/callback', methods=['POST'])
 def onlyoffice_callback():
     """Handle OnlyOffice document save callback"""
     data = request.get_json()
@@ -1033,59 +1542,82 @@ def onlyoffice_callback():
     # 7 - error has occurred while force saving the document
     
     if status in [2, 6]:  # Ready to save or force save
+        download_url = data.get('url')
+        key = data.get('key')
+        users = data.get('users', [])
+        
+        if not download_url or not key:
+            return jsonify({'error': 1}), 200
+        
+        # OnlyOffice retries deliveries it didn't see acknowledged in time
+        claim = claim_onlyoffice_callback(key, status, download_url)
+        if not claim:
+            return jsonify({'error': 0}), 200
+        
+        tmp_path = None
         try:
-            download_url = data.get('url')
-            key = data.get('key')
-            users = data.get('users', [])
-            
-            if not download_url or not key:
-                return jsonify({'error': 1}), 200
-            
             # Parse attachment ID from key
             attachment_id = int(key.split('_')[0])
             attachment = Attachment.query.get(attachment_id)
             
             if not attachment:
+                release_onlyoffice_callback(claim)
                 return jsonify({'error': 1}), 200
             
-            # Create version backup before saving
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'attachments', attachment.filename)
-            versions_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'versions')
-            os.makedirs(versions_dir, exist_ok=True)
+            attachments_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'attachments')
+            file_path = os.path.join(attachments_dir, attachment.filename)
             
-            # Get current version number
-            last_version = FileVersion.query.filter_by(attachment_id=attachment_id).order_by(FileVersion.version_number.desc()).first()
-            new_version_num = (last_version.version_number + 1) if last_version else 1
+            # Stream the new file from OnlyOffice next to the live one
+            tmp_path, new_size, new_hash = download_onlyoffice_file(download_url, attachments_dir)
             
-            # Backup current file as version
-            if os.path.exists(file_path):
-                version_filename = f"{attachment_id}_v{new_version_num}_{attachment.filename}"
-                version_path = os.path.join(versions_dir, version_filename)
-                shutil.copy2(file_path, version_path)
+            # Serialize with other saves and restores of this attachment in any worker
+            with attachment_write_lock(attachment_id):
+                # Another worker may have saved while we were downloading
+                db.session.refresh(attachment)
                 
-                # Get user who made the edit
-                editor_id = int(users[0]) if users else None
+                # Force-saves often deliver byte-identical documents - skip the
+                # version backup and re-extraction entirely when nothing changed
+                current_hash = attachment_content_hash(attachment, file_path)
+                if current_hash == new_hash:
+                    os.remove(tmp_path)
+                    db.session.commit()  # Persist a back-filled hash, if any
+                    return jsonify({'error': 0}), 200
                 
-                # Create version record
-                file_version = FileVersion(
-                    attachment_id=attachment_id,
-                    version_number=new_version_num,
-                    file_path=version_filename,
-                    file_size=os.path.getsize(version_path),
-                    edited_by_id=editor_id or 1,
-                    change_summary=f"Version {new_version_num} saved via OnlyOffice"
-                )
-                db.session.add(file_version)
-            
-            # Download the new file from OnlyOffice
-            response = requests.get(download_url, timeout=30)
-            if response.status_code == 200:
-                with open(file_path, 'wb') as f:
-                    f.write(response.content)
+                versions_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'versions')
+                os.makedirs(versions_dir, exist_ok=True)
+                
+                new_version_num = next_version_number(attachment_id)
+                
+                # Keep the current file as a version. The live path is replaced by
+                # rename below, so a hard link preserves it without copying data.
+                version_path = None
+                if os.path.exists(file_path):
+                    version_filename = f"{attachment_id}_v{new_version_num}_{attachment.filename}"
+                    version_path = os.path.join(versions_dir, version_filename)
+                    link_or_copy(file_path, version_path)
+                    
+                    # Get user who made the edit
+                    editor_id = int(users[0]) if users else None
+                    
+                    # Create version record
+                    file_version = FileVersion(
+                        attachment_id=attachment_id,
+                        version_number=new_version_num,
+                        file_path=version_filename,
+                        file_size=os.path.getsize(version_path),
+                        edited_by_id=editor_id or 1,
+                        change_summary=f"Version {new_version_num} saved via OnlyOffice"
+                    )
+                    db.session.add(file_version)
+                
+                # Atomically swap in the new document - readers never see a partial file
+                os.replace(tmp_path, file_path)
+                tmp_path = None
                 
                 # Update attachment metadata and commit immediately
                 # This ensures the main save operation completes before content extraction
-                attachment.file_size = len(response.content)
+                attachment.file_size = new_size
+                attachment.content_hash = new_hash
                 attachment.uploaded_at = datetime.utcnow()
                 
                 try:
@@ -1093,27 +1625,28 @@ def onlyoffice_callback():
                 except Exception as commit_error:
                     db.session.rollback()
                     print(f"OnlyOffice commit error: {commit_error}")
+                    # Put the previous document back so file and metadata agree
+                    if version_path:
+                        copy_atomic(version_path, file_path)
+                        os.remove(version_path)
+                    release_onlyoffice_callback(claim)
                     return jsonify({'error': 1}), 200
-                
-                # Re-index content for search AFTER commit (non-blocking, separate transaction)
-                try:
-                    extracted_content = extract_file_content(file_path, attachment.file_type)
-                    if extracted_content:
-                        attachment.content = extracted_content
-                        db.session.commit()
-                except Exception as extract_error:
-                    db.session.rollback()
-                    print(f"Content extraction error (non-critical): {extract_error}")
+            
+            # Re-index content for search AFTER commit (non-blocking, separate transaction)
+            reindex_attachment_content(attachment, file_path)
             
             return jsonify({'error': 0}), 200
         except Exception as e:
             db.session.rollback()
             print(f"OnlyOffice callback error: {e}")
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            release_onlyoffice_callback(claim)
             return jsonify({'error': 1}), 200
     
     return jsonify({'error': 0}), 200
 
-@app.route('/api/attachments/<int:attachment_id>/versions', methods=['GET'])
+@bp.route('/api/attachments/<int:attachment_id>/versions', methods=['GET'])
 @jwt_required()
 def get_file_versions(attachment_id):
     """Get version history for an attachment"""
@@ -1128,7 +1661,7 @@ def get_file_versions(attachment_id):
     versions = FileVersion.query.filter_by(attachment_id=attachment_id).order_by(FileVersion.version_number.desc()).all()
     return jsonify({'versions': [v.to_dict() for v in versions]})
 
-@app.route('/api/attachments/<int:attachment_id>/restore/<int:version_id>', methods=['POST'])
+@bp.route('/api/attachments/<int:attachment_id>/restore/<int:version_id>', methods=['POST'])
 @jwt_required()
 def restore_file_version(attachment_id, version_id):
     """Restore a previous version of an attachment"""
@@ -1144,55 +1677,73 @@ def restore_file_version(attachment_id, version_id):
     if version.attachment_id != attachment_id:
         return jsonify({'error': '版本不匹配'}), 400
     
-    versions_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'versions')
+    versions_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'versions')
     version_path = os.path.join(versions_dir, version.file_path)
-    current_path = os.path.join(app.config['UPLOAD_FOLDER'], 'attachments', attachment.filename)
+    current_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'attachments', attachment.filename)
     
     if not os.path.exists(version_path):
         return jsonify({'error': '版本文件不存在'}), 404
     
-    # Calculate the OLD document key before restore (to invalidate OnlyOffice cache)
-    old_doc_key = f"{attachment_id}_{int(attachment.uploaded_at.timestamp() * 1000)}"
-    
-    # Create a new version of current file before restoring
-    last_version = FileVersion.query.filter_by(attachment_id=attachment_id).order_by(FileVersion.version_number.desc()).first()
-    new_version_num = (last_version.version_number + 1) if last_version else 1
-    
-    if os.path.exists(current_path):
-        backup_filename = f"{attachment_id}_v{new_version_num}_{attachment.filename}"
-        backup_path = os.path.join(versions_dir, backup_filename)
-        shutil.copy2(current_path, backup_path)
-        
-        backup_version = FileVersion(
-            attachment_id=attachment_id,
-            version_number=new_version_num,
-            file_path=backup_filename,
-            file_size=os.path.getsize(backup_path),
-            edited_by_id=user_id,
-            change_summary=f"Backup before restoring to version {version.version_number}"
-        )
-        db.session.add(backup_version)
-    
-    # Restore the old version
-    shutil.copy2(version_path, current_path)
-    attachment.file_size = os.path.getsize(current_path)
-    attachment.uploaded_at = datetime.utcnow()
-    db.session.commit()
+    try:
+        with attachment_write_lock(attachment_id):
+            db.session.refresh(attachment)
+            
+            # Calculate the OLD document key before restore (to invalidate OnlyOffice cache)
+            old_doc_key = attachment_doc_key(attachment)
+            
+            # Create a new version of current file before restoring
+            new_version_num = next_version_number(attachment_id)
+            
+            backup_path = None
+            if os.path.exists(current_path):
+                backup_filename = f"{attachment_id}_v{new_version_num}_{attachment.filename}"
+                backup_path = os.path.join(versions_dir, backup_filename)
+                link_or_copy(current_path, backup_path)
+                
+                backup_version = FileVersion(
+                    attachment_id=attachment_id,
+                    version_number=new_version_num,
+                    file_path=backup_filename,
+                    file_size=os.path.getsize(backup_path),
+                    edited_by_id=user_id,
+                    change_summary=f"Backup before restoring to version {version.version_number}"
+                )
+                db.session.add(backup_version)
+            
+            # Restore the old version
+            copy_atomic(version_path, current_path)
+            attachment.file_size = os.path.getsize(current_path)
+            attachment.content_hash = file_digest(current_path)
+            attachment.uploaded_at = datetime.utcnow()
+            try:
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                # Put the previous document back so file and metadata agree
+                if backup_path:
+                    copy_atomic(backup_path, current_path)
+                    os.remove(backup_path)
+                else:
+                    os.remove(current_path)
+                raise
+    except (LockTimeout, IntegrityError):
+        db.session.rollback()
+        return jsonify({'error': '文件正在保存中，请稍后重试'}), 409
     
     # Drop OnlyOffice cache so the restored version is shown
-    drop_onlyoffice_cache(old_doc_key)
+    cache_dropped = drop_onlyoffice_cache(old_doc_key)
     
     # Calculate new doc key for frontend
-    new_doc_key = f"{attachment_id}_{int(attachment.uploaded_at.timestamp() * 1000)}"
+    new_doc_key = attachment_doc_key(attachment)
     
     return jsonify({
         'message': f'已恢复到版本 {version.version_number}',
         'attachment': attachment.to_dict(),
         'new_doc_key': new_doc_key,
-        'cache_dropped': True
+        'cache_dropped': cache_dropped
     })
 
-@app.route('/api/attachments/<int:attachment_id>/save-version', methods=['POST'])
+@bp.route('/api/attachments/<int:attachment_id>/save-version', methods=['POST'])
 @jwt_required()
 def save_manual_version(attachment_id):
     """Manually save a version of the current file (independent of OnlyOffice)"""
@@ -1207,41 +1758,44 @@ def save_manual_version(attachment_id):
     data = request.get_json() or {}
     change_summary = data.get('summary', '手动保存版本')
     
-    current_path = os.path.join(app.config['UPLOAD_FOLDER'], 'attachments', attachment.filename)
+    current_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'attachments', attachment.filename)
     
     if not os.path.exists(current_path):
         return jsonify({'error': '文件不存在'}), 404
     
-    versions_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'versions')
+    versions_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'versions')
     os.makedirs(versions_dir, exist_ok=True)
     
-    # Get next version number
-    last_version = FileVersion.query.filter_by(attachment_id=attachment_id).order_by(FileVersion.version_number.desc()).first()
-    new_version_num = (last_version.version_number + 1) if last_version else 1
-    
-    # Create version backup
-    version_filename = f"{attachment_id}_v{new_version_num}_{attachment.filename}"
-    version_path = os.path.join(versions_dir, version_filename)
-    shutil.copy2(current_path, version_path)
-    
-    # Create version record
-    file_version = FileVersion(
-        attachment_id=attachment_id,
-        version_number=new_version_num,
-        file_path=version_filename,
-        file_size=os.path.getsize(version_path),
-        edited_by_id=user_id,
-        change_summary=change_summary
-    )
-    db.session.add(file_version)
-    db.session.commit()
+    try:
+        with attachment_write_lock(attachment_id):
+            new_version_num = next_version_number(attachment_id)
+            
+            # Create version backup
+            version_filename = f"{attachment_id}_v{new_version_num}_{attachment.filename}"
+            version_path = os.path.join(versions_dir, version_filename)
+            link_or_copy(current_path, version_path)
+            
+            # Create version record
+            file_version = FileVersion(
+                attachment_id=attachment_id,
+                version_number=new_version_num,
+                file_path=version_filename,
+                file_size=os.path.getsize(version_path),
+                edited_by_id=user_id,
+                change_summary=change_summary
+            )
+            db.session.add(file_version)
+            db.session.commit()
+    except (LockTimeout, IntegrityError):
+        db.session.rollback()
+        return jsonify({'error': '文件正在保存中，请稍后重试'}), 409
     
     return jsonify({
         'message': f'已保存版本 {new_version_num}',
         'version': file_version.to_dict()
     })
 
-@app.route('/api/projects/<int:project_id>/ai/ask', methods=['POST'])
+@bp.route('/api/projects/<int:project_id>/ai/ask', methods=['POST'])
 @jwt_required()
 def ai_ask(project_id):
     user_id = int(get_jwt_identity())
@@ -1256,36 +1810,70 @@ def ai_ask(project_id):
     if not question:
         return jsonify({'error': '请输入问题'}), 400
     
-    # Build context from project cards
-    cards = Card.query.filter_by(project_id=project_id).all()
-    context = f"项目名称: {project.name}\n项目描述: {project.description}\n\n卡片内容:\n"
-    for card in cards:
-        context += f"- [{card.column}] {card.title}: {card.content[:500]}\n"
+    # Only the project text most relevant to the question goes into the prompt
+    passages = ai_context_passages(project_id, question,
+                                   include_attachments=data.get('include_attachments', True),
+                                   include_chat=data.get('include_chat', False))
+    header = f"项目名称: {project.name}\n项目描述: {project.description or ''}\n\n相关内容:"
+    context, context_report = build_context(header, question, passages,
+                                            current_app.config['AI_CONTEXT_TOKENS'])
     
-    api_key = app.config.get('OPENAI_API_KEY')
-    if not api_key:
+    if not ai_backend().configured:
         return jsonify({'error': '请配置OpenAI API密钥'}), 400
     
-    try:
-        from openai import OpenAI
-        client = OpenAI(api_key=api_key)
-        
-        response = client.chat.completions.create(
-            model=app.config.get('OPENAI_MODEL', 'gpt-3.5-turbo'),
-            messages=[
-                {"role": "system", "content": f"你是一个项目助手。根据以下项目信息回答用户的问题:\n\n{context}"},
-                {"role": "user", "content": question}
-            ],
-            max_tokens=1000
-        )
-        
-        answer = response.choices[0].message.content
-        return jsonify({'answer': answer})
-    
-    except Exception as e:
-        return jsonify({'error': f'AI请求失败: {str(e)}'}), 500
-
-@app.route('/api/projects/<int:project_id>/ai/summarize', methods=['POST'])
+    model = current_app.config.get('OPENAI_MODEL', 'gpt-3.5-turbo')
+    system_prompt = f"你是一个项目助手。根据以下项目信息回答用户的问题:\n\n{context}"
+    # Same question over the same context: reuse the answer
+    cache_key = ai_cache.cache_key('ask', model, question, system_prompt)
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": question}
+    ]
+    return ai_completion('ask', 'answer', model, messages, 1000, cache_key, data,
+                         {'context': context_report})
+
+def ai_context_passages(project_id, question, include_attachments=True, include_chat=False):
+    """Candidate passages for the /ai/ask context, most recently updated cards first"""
+    max_tokens = current_app.config['AI_PASSAGE_TOKENS']
+    passages = []
+    cards = db.session.query(Card.id, Card.title, Card.column, Card.content, Card.content_type)\
+        .filter_by(project_id=project_id).order_by(Card.updated_at.desc(), Card.id.desc()).all()
+    titles = {}
+    for card_id, title, column, content, content_type in cards:
+        titles[card_id] = title
+        if content_type == 'html':
+            content = bleach.clean(content or '', tags=[], strip=True)
+        passages += split_passages(('card', card_id), card_id, f"[{column}] {title}", content, max_tokens)
+    
+    if include_attachments:
+        attachments = db.session.query(Attachment.id, Attachment.card_id, Attachment.original_filename,
+                                       Attachment.content)\
+            .join(Card).filter(Card.project_id == project_id, Attachment.content.isnot(None)).all()
+        for attachment_id, card_id, filename, content in attachments:
+            label = f"附件 {filename} (卡片: {titles.get(card_id, '')})"
+            passages += split_passages(('attachment', attachment_id), card_id, label, content, max_tokens)
+    
+    if include_chat and chat_search.available(db.session):
+        ids = chat_search.search(db.session, project_id, question,
+                                 current_app.config['AI_CONTEXT_MESSAGES'], any_term=True)
+        messages = ChatMessage.query.filter(ChatMessage.id.in_(ids)).all() if ids else []
+        User.prime_cache(m.user_id for m in messages)
+        for m in sorted(messages, key=lambda m: (m.created_at, m.id)):
+            author = (User.cached_dict(m.user_id) or {}).get('username', '')
+            text = m.content or m.file_name or ''
+            passages += split_passages(('message', m.id), None, f"聊天 {author}", text, max_tokens)
+    
+    # Semantic similarity catches paraphrases the lexical scorer misses
+    index = project_semantic_index(project_id)
+    if index is not None:
+        weight = current_app.config['AI_SEMANTIC_WEIGHT']
+        similarity = {(kind, item_id): score
+                      for kind, item_id, _, score in index.search(project_id, question, k=50)}
+        for passage in passages:
+            passage.boost = weight * similarity.get(passage.source, 0.0)
+    return passages
+
+@bp.route('/api/projects/<int:project_id>/ai/summarize', methods=['POST'])
 @jwt_required()
 def ai_summarize(project_id):
     user_id = int(get_jwt_identity())
@@ -1305,48 +1893,204 @@ def ai_summarize(project_id):
     if not cards:
         return jsonify({'error': '未找到指定卡片'}), 404
     
-    content = "\n\n".join([f"## {card.title}\n{card.content}" for card in cards])
+    order = {card_id: i for i, card_id in enumerate(card_ids)}
+    cards.sort(key=lambda card: order.get(card.id, 0))
+    texts = [f"## {card.title}\n{card.content}" for card in cards]
+    content = "\n\n".join(texts)
     
-    api_key = app.config.get('OPENAI_API_KEY')
-    if not api_key:
+    if not ai_backend().configured:
         return jsonify({'error': '请配置OpenAI API密钥'}), 400
     
-    try:
-        from openai import OpenAI
-        client = OpenAI(api_key=api_key)
+    model = current_app.config.get('OPENAI_MODEL', 'gpt-3.5-turbo')
+    # Too much for one prompt: summarize in chunks as a background job
+    if data.get('mode') == 'map_reduce' or estimate_tokens(content) > current_app.config['AI_SUMMARY_DIRECT_TOKENS']:
+        cache_key = ai_cache.cache_key('summarize', model, 'map_reduce', content)
+        cached = cached_ai_response('summarize', cache_key, data)
+        if cached is not None:
+            return jsonify({'summary': cached, 'cached': True})
+        job = AIJob(id=uuid.uuid4().hex, project_id=project_id, user_id=user_id, kind='summarize')
+        db.session.add(job)
+        db.session.commit()
+        socketio.start_background_task(run_summary_job, current_app._get_current_object(),
+                                       job.id, model, texts, cache_key)
+        return jsonify({'job': job.to_dict()}), 202
+    
+    cache_key = ai_cache.cache_key('summarize', model, SUMMARY_INSTRUCTION, content)
+    messages = [
+        {"role": "system", "content": SUMMARY_INSTRUCTION},
+        {"role": "user", "content": content}
+    ]
+    return ai_completion('summarize', 'summary', model, messages, 2000, cache_key, data)
+
+def run_summary_job(app, job_id, model, texts, cache_key):
+    """Background map-reduce summary; progress and result are written to the AIJob row"""
+    with app.app_context():
+        job = AIJob.query.get(job_id)
+        job.status = 'running'
+        db.session.commit()
+        backend = ai_backend()
         
-        response = client.chat.completions.create(
-            model=app.config.get('OPENAI_MODEL', 'gpt-3.5-turbo'),
-            messages=[
-                {"role": "system", "content": "请将以下内容总结成一份文档，保持结构清晰、内容完整。"},
+        def complete(instruction, content):
+            return backend.complete(model, [
+                {"role": "system", "content": instruction},
                 {"role": "user", "content": content}
-            ],
-            max_tokens=2000
-        )
+            ], 1000 if instruction == MAP_INSTRUCTION else 2000)
+        
+        def progress(done, total, stage):
+            job.progress_done, job.progress_total, job.stage = done, total, stage
+            db.session.commit()
         
-        summary = response.choices[0].message.content
-        return jsonify({'summary': summary})
+        try:
+            summary = map_reduce.summarize(complete, texts, app.config['AI_SUMMARY_CHUNK_TOKENS'],
+                                           app.config['AI_SUMMARY_PARALLELISM'], progress)
+        except Exception as e:
+            print(f"AI summary job {job_id} failed: {e}")
+            db.session.rollback()
+            job.status = 'failed'
+            job.error = f'AI请求失败: {str(e)}'[:500]
+            db.session.commit()
+            return
+        job.status = 'done'
+        job.result = summary
+        db.session.commit()
+        store_ai_response('summarize', cache_key, model, summary)
+
+@bp.route('/api/ai/jobs/<job_id>', methods=['GET'])
+@jwt_required()
+def get_ai_job(job_id):
+    user_id = int(get_jwt_identity())
+    job = AIJob.query.get_or_404(job_id)
+    
+    if job.user_id != user_id:
+        return jsonify({'error': '无权访问'}), 403
     
+    # The worker running it was restarted: the job will never finish
+    stale = datetime.utcnow() - timedelta(seconds=current_app.config['AI_JOB_STALE_AFTER'])
+    if job.status in ('queued', 'running') and job.updated_at < stale:
+        job.status = 'failed'
+        job.error = '任务已中断，请重试'
+        db.session.commit()
+    return jsonify(job.to_dict())
+
+def ai_backend():
+    return current_app.extensions['ai'].for_config(current_app.config)
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def sse_response(events):
+    # X-Accel-Buffering stops nginx from holding events back until the end
+    return Response(stream_with_context(events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def ai_completion(kind, field, model, messages, max_tokens, cache_key, data, extra=None):
+    """Answer with ``{field: text, 'cached': bool, **extra}``, reusing a cached response.
+    
+    With ``"stream": true`` in the request the same body arrives as Server-Sent
+    Events instead: ``start`` (carrying ``extra``), ``delta`` events with text
+    as the model produces it, then ``done`` with the full body (or ``error``).
+    """
+    extra = extra or {}
+    streaming = bool(data.get('stream'))
+    cached = cached_ai_response(kind, cache_key, data)
+    if cached is not None:
+        body = {field: cached, 'cached': True, **extra}
+        if streaming:
+            return sse_response(iter([sse_event('start', extra), sse_event('delta', {'text': cached}),
+                                      sse_event('done', body)]))
+        return jsonify(body)
+    
+    backend = ai_backend()
+    if streaming:
+        return sse_response(stream_ai_completion(kind, field, model, messages, max_tokens,
+                                                 cache_key, backend, extra))
+    try:
+        text = backend.complete(model, messages, max_tokens)
+        store_ai_response(kind, cache_key, model, text)
+        return jsonify({field: text, 'cached': False, **extra})
+    
+    except AIBusy:
+        return jsonify({'error': 'AI服务繁忙，请稍后重试'}), 503
     except Exception as e:
         return jsonify({'error': f'AI请求失败: {str(e)}'}), 500
 
-@app.route('/api/ai/config', methods=['PUT'])
+def stream_ai_completion(kind, field, model, messages, max_tokens, cache_key, backend, extra):
+    """SSE events for a streamed completion.
+    
+    If the client goes away the next write fails and closes this generator;
+    closing the upstream stream then stops the model generating (and billing)
+    tokens nobody will read.
+    """
+    yield sse_event('start', extra)
+    # Don't hold a pooled DB connection for the whole generation
+    db.session.close()
+    parts = []
+    stream = None
+    try:
+        stream = backend.stream(model, messages, max_tokens)
+        for delta in stream:
+            parts.append(delta)
+            yield sse_event('delta', {'text': delta})
+    except AIBusy:
+        yield sse_event('error', {'error': 'AI服务繁忙，请稍后重试'})
+        return
+    except Exception as e:
+        yield sse_event('error', {'error': f'AI请求失败: {str(e)}'})
+        return
+    finally:
+        if stream is not None:
+            stream.close()
+    
+    text = ''.join(parts)
+    store_ai_response(kind, cache_key, model, text)
+    yield sse_event('done', {field: text, 'cached': False, **extra})
+
+def cached_ai_response(kind, cache_key, data):
+    """Stored response for ``cache_key``, or None (also when the request asks to refresh)"""
+    ttl = current_app.config['AI_CACHE_TTL']
+    if not ttl or data.get('refresh'):
+        return None
+    try:
+        return ai_cache.lookup(kind, cache_key, ttl)
+    except Exception as e:
+        # A cache failure must never cost the user their answer
+        db.session.rollback()
+        print(f"AI cache lookup error: {e}")
+        return None
+
+def store_ai_response(kind, cache_key, model, response):
+    ttl = current_app.config['AI_CACHE_TTL']
+    if not ttl or not response:
+        return
+    try:
+        ai_cache.store(kind, cache_key, model, response, ttl, current_app.config['AI_CACHE_MAX_ENTRIES'])
+    except Exception as e:
+        db.session.rollback()
+        print(f"AI cache store error: {e}")
+
+@bp.route('/api/ai/cache', methods=['GET'])
+@jwt_required()
+def ai_cache_stats():
+    """Hit/miss metrics of the AI response cache (all workers)"""
+    return jsonify(ai_cache.stats())
+
+@bp.route('/api/ai/config', methods=['PUT'])
 @jwt_required()
 def update_ai_config():
     data = request.get_json()
     
     if data.get('api_base'):
-        app.config['OPENAI_API_BASE'] = data['api_base']
+        current_app.config['OPENAI_API_BASE'] = data['api_base']
     if data.get('api_key'):
-        app.config['OPENAI_API_KEY'] = data['api_key']
+        current_app.config['OPENAI_API_KEY'] = data['api_key']
     if data.get('model'):
-        app.config['OPENAI_MODEL'] = data['model']
+        current_app.config['OPENAI_MODEL'] = data['model']
     
     return jsonify({'message': 'AI配置已更新'})
 
 # ================== CHAT ROUTES ==================
 
-@app.route('/api/projects/<int:project_id>/messages', methods=['GET'])
+@bp.route('/api/projects/<int:project_id>/messages', methods=['GET'])
 @jwt_required()
 def get_messages(project_id):
     user_id = int(get_jwt_identity())
@@ -1355,21 +2099,146 @@ def get_messages(project_id):
     if not any(m.id == user_id for m in project.members):
         return jsonify({'error': '无权访问'}), 403
     
-    # Pagination
-    page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 50, type=int)
-    
-    messages = ChatMessage.query.filter_by(project_id=project_id)\
-        .order_by(ChatMessage.created_at.desc())\
-        .paginate(page=page, per_page=per_page, error_out=False)
-    
-    return jsonify({
-        'messages': [m.to_dict() for m in reversed(messages.items)],
-        'has_more': messages.has_next,
-        'total': messages.total
+    # Keyset pagination on (created_at, id): ?before=<id> pages back through
+    # history, ?after=<id> fetches newer messages, ?around=<id> centres a page
+    # on one message (search results jump there), none gives the latest page.
+    # Every page is an index range scan, however deep the scroll.
+    per_page = min(max(request.args.get('per_page', 50, type=int), 1), 100)
+    before_id = request.args.get('before', type=int)
+    after_id = request.args.get('after', type=int)
+    around_id = request.args.get('around', type=int)
+    if sum(name in request.args for name in ('before', 'after', 'around')) > 1:
+        return jsonify({'error': 'before、after 和 around 只能指定一个'}), 400
+    
+    anchor = None
+    anchor_id = before_id or after_id or around_id
+    if anchor_id:
+        anchor = chat_message_key(project_id, anchor_id)
+        if not anchor:
+            return jsonify({'error': '无效的消息游标'}), 400
+    
+    # One extra row tells us whether another page exists - no COUNT(*) needed
+    result = {}
+    if around_id:
+        half = per_page // 2
+        older = chat_messages_before(project_id, anchor, half + 1)
+        # Starting just below the anchor's key makes the anchor the first row
+        newer = chat_messages_after(project_id, (anchor[0], anchor[1] - 1), per_page - half + 1)
+        has_more = len(older) > half
+        result['has_more_after'] = len(newer) > per_page - half
+        messages = older[:half][::-1] + newer[:per_page - half]
+    elif after_id:
+        messages = chat_messages_after(project_id, anchor, per_page + 1)
+        has_more = len(messages) > per_page
+        messages = messages[:per_page]
+    else:
+        messages = chat_messages_before(project_id, anchor, per_page + 1)
+        has_more = len(messages) > per_page
+        messages = messages[:per_page][::-1]
+    
+    # Authors come from the shared user cache; misses are loaded in one query.
+    # Hot rows are ChatMessage objects, archived ones plain dicts.
+    User.prime_cache(m['user_id'] if isinstance(m, dict) else m.user_id for m in messages)
+    messages = [row_to_dict(m) if isinstance(m, dict) else m.to_dict() for m in messages]
+    
+    result.update({
+        'messages': messages,
+        'has_more': has_more,
+        'oldest_id': messages[0]['id'] if messages else None,
+        'newest_id': messages[-1]['id'] if messages else None,
     })
+    # Counting the whole room is expensive - only do it when asked
+    if request.args.get('include_total') in ('1', 'true'):
+        result['total'] = ChatMessage.query.filter_by(project_id=project_id).count() + archived_count(project_id)
+    return jsonify(result)
 
-@app.route('/api/projects/<int:project_id>/messages', methods=['POST'])
+@bp.route('/api/projects/<int:project_id>/messages/search', methods=['GET'])
+@jwt_required()
+def search_messages(project_id):
+    """Ranked full-text search over message text and file names.
+    
+    Each result carries a ``cursor``: GET /messages?around=<cursor> loads the
+    conversation around it.
+    """
+    user_id = int(get_jwt_identity())
+    project = Project.query.get_or_404(project_id)
+    
+    if not any(m.id == user_id for m in project.members):
+        return jsonify({'error': '无权访问'}), 403
+    
+    query_text = request.args.get('q', '').strip()
+    if not chat_search.match_expression(query_text):
+        return jsonify({'error': '请输入搜索关键词'}), 400
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 50)
+    page = max(request.args.get('page', 1, type=int), 1)
+    offset = (page - 1) * per_page
+    
+    if chat_search.available(db.session):
+        ids = chat_search.search(db.session, project_id, query_text, per_page + 1, offset)
+        has_more = len(ids) > per_page
+        ids = ids[:per_page]
+        hot = {m.id: m for m in ChatMessage.query.filter(ChatMessage.id.in_(ids)).all()} if ids else {}
+        missing = [i for i in ids if i not in hot]
+        cold = archived_messages(current_app.config['CHAT_ARCHIVE_FOLDER'], project_id, missing) if missing else {}
+        # An id can linger in the index only if its message vanished - skip it
+        messages = [hot.get(i) or cold.get(i) for i in ids if i in hot or i in cold]
+    else:
+        # No FTS index on this database: substring match over recent messages
+        pattern = f"%{query_text}%"
+        messages = ChatMessage.query.filter(
+            ChatMessage.project_id == project_id,
+            db.or_(ChatMessage.content.ilike(pattern), ChatMessage.file_name.ilike(pattern))
+        ).order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc())\
+            .offset(offset).limit(per_page + 1).all()
+        has_more = len(messages) > per_page
+        messages = messages[:per_page]
+    
+    User.prime_cache(m['user_id'] if isinstance(m, dict) else m.user_id for m in messages)
+    results = []
+    for m in messages:
+        data = row_to_dict(m) if isinstance(m, dict) else m.to_dict()
+        results.append({'message': data, 'cursor': data['id']})
+    return jsonify({'results': results, 'page': page, 'has_more': has_more})
+
+def chat_message_key(project_id, message_id):
+    """(created_at, id) of a hot or archived message of the project, or None"""
+    key = db.session.query(ChatMessage.created_at, ChatMessage.id)\
+        .filter_by(id=message_id, project_id=project_id).first()
+    if key:
+        return tuple(key)
+    # Scrolled past the hot window - the cursor may be an archived message
+    return find_archived(current_app.config['CHAT_ARCHIVE_FOLDER'], project_id, message_id)
+
+def chat_messages_before(project_id, key, limit):
+    """Up to ``limit`` messages older than ``key`` (None: the latest), newest first.
+    
+    Archived messages are all older than the hot table, so this reads hot
+    rows first and continues into the archive.
+    """
+    query = ChatMessage.query.filter_by(project_id=project_id)
+    if key:
+        query = query.filter(db.or_(
+            ChatMessage.created_at < key[0],
+            db.and_(ChatMessage.created_at == key[0], ChatMessage.id < key[1])
+        ))
+    messages = query.order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc()).limit(limit).all()
+    if len(messages) < limit:
+        oldest = (messages[-1].created_at, messages[-1].id) if messages else key
+        messages += archived_before(current_app.config['CHAT_ARCHIVE_FOLDER'], project_id,
+                                    oldest, limit - len(messages))
+    return messages
+
+def chat_messages_after(project_id, key, limit):
+    """Up to ``limit`` messages newer than ``key``, oldest first (archive, then hot rows)"""
+    messages = archived_after(current_app.config['CHAT_ARCHIVE_FOLDER'], project_id, key, limit)
+    if len(messages) < limit:
+        messages += ChatMessage.query.filter_by(project_id=project_id).filter(db.or_(
+            ChatMessage.created_at > key[0],
+            db.and_(ChatMessage.created_at == key[0], ChatMessage.id > key[1])
+        )).order_by(ChatMessage.created_at.asc(), ChatMessage.id.asc()).limit(limit - len(messages)).all()
+    return messages
+
+@bp.route('/api/projects/<int:project_id>/messages', methods=['POST'])
 @jwt_required()
 def post_message(project_id):
     user_id = int(get_jwt_identity())
@@ -1392,39 +2261,76 @@ def post_message(project_id):
         ext = original_filename.rsplit('.', 1)[1].lower() if '.' in original_filename else ''
         unique_filename = f"{uuid.uuid4().hex}.{ext}" if ext else uuid.uuid4().hex
         
-        save_path = os.path.join(app.config['UPLOAD_FOLDER'], 'chat', unique_filename)
+        save_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'chat', unique_filename)
         file.save(save_path)
         file_path = unique_filename
         file_name = original_filename
+        schedule_derivatives(save_path, get_file_type(original_filename))
     
-    message = ChatMessage(
-        project_id=project_id,
-        user_id=user_id,
-        content=content,
-        file_path=file_path,
-        file_name=file_name
-    )
+    try:
+        messages = submit_chat_messages([{
+            'project_id': project_id,
+            'user_id': user_id,
+            'content': content,
+            'file_path': file_path,
+            'file_name': file_name
+        }])
+    except Exception as e:
+        print(f"Chat message insert error: {e}")
+        return jsonify({'error': '消息发送失败，请重试'}), 500
     
-    db.session.add(message)
-    db.session.commit()
+    return jsonify(messages[0]), 201
+
+@bp.route('/api/projects/<int:project_id>/messages:batch', methods=['POST'])
+@jwt_required()
+def post_messages_batch(project_id):
+    """Post several text messages at once (bots, log forwarders)"""
+    user_id = int(get_jwt_identity())
+    project = Project.query.get_or_404(project_id)
+    
+    if not any(m.id == user_id for m in project.members):
+        return jsonify({'error': '无权发送消息'}), 403
     
-    # Emit to socket room
-    socketio.emit('new_message', message.to_dict(), room=f'project_{project_id}')
+    data = request.get_json(silent=True) or {}
+    items = data.get('messages')
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': '请提供消息列表'}), 400
+    if len(items) > current_app.config['CHAT_BATCH_MAX']:
+        return jsonify({'error': f"单次最多发送 {current_app.config['CHAT_BATCH_MAX']} 条消息"}), 400
     
-    return jsonify(message.to_dict()), 201
+    rows = []
+    for item in items:
+        content = item.get('content') if isinstance(item, dict) else item
+        if not isinstance(content, str) or not content:
+            return jsonify({'error': '消息内容不能为空'}), 400
+        rows.append({'project_id': project_id, 'user_id': user_id, 'content': content})
+    
+    try:
+        messages = submit_chat_messages(rows)
+    except Exception as e:
+        print(f"Chat batch insert error: {e}")
+        return jsonify({'error': '消息发送失败，请重试'}), 500
+    
+    return jsonify({'messages': messages}), 201
 
-@app.route('/api/chat/files/<filename>', methods=['GET'])
+@bp.route('/api/chat/files/<filename>', methods=['GET'])
 def get_chat_file(filename):
     """Serve chat files - no auth required for direct file access"""
     return send_from_directory(
-        os.path.join(app.config['UPLOAD_FOLDER'], 'chat'),
+        os.path.join(current_app.config['UPLOAD_FOLDER'], 'chat'),
         filename
     )
 
-@app.route('/api/chat/files/<filename>/onlyoffice-config', methods=['GET'])
+@bp.route('/api/chat/files/<filename>/thumbnail', methods=['GET'])
+def get_chat_file_thumbnail(filename):
+    """Serve a thumbnail for a chat image or PDF - same access rules as the file itself"""
+    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'chat', secure_filename(filename))
+    return serve_derivative(file_path, get_file_type(filename))
+
+@bp.route('/api/chat/files/<filename>/onlyoffice-config', methods=['GET'])
 @jwt_required()
 def get_chat_file_onlyoffice_config(filename):
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'chat', filename)
+    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'chat', filename)
     if not os.path.exists(file_path):
         return jsonify({'error': '文件不存在'}), 404
         
@@ -1438,7 +2344,7 @@ def get_chat_file_onlyoffice_config(filename):
     if not document_type:
          return jsonify({'error': '不支持此类文件'}), 400
 
-    internal_url = app.config.get('INTERNAL_URL', 'http://172.17.0.1:5000').rstrip('/')
+    internal_url = current_app.config.get('INTERNAL_URL', 'http://172.17.0.1:5000').rstrip('/')
     file_url = f"{internal_url}/api/chat/files/{filename}"
     callback_url = f"{internal_url}/api/onlyoffice/chat/callback"
     
@@ -1447,6 +2353,12 @@ def get_chat_file_onlyoffice_config(filename):
     
     user_id = int(get_jwt_identity())
     user = User.query.get(user_id)
+    
+    # Signed configs are reused until the file changes (new mtime in doc_key)
+    cache_key = ('chat', filename, doc_key, user.id, user.username)
+    cached = editor_config_cache().get(cache_key)
+    if cached:
+        return jsonify(cached)
 
     config = {
         "document": {
@@ -1473,12 +2385,14 @@ def get_chat_file_onlyoffice_config(filename):
         
     config['token'] = generate_onlyoffice_token(config)
     
-    return jsonify({
+    result = {
         'config': config,
-        'onlyoffice_url': app.config.get('ONLYOFFICE_URL', 'http://localhost:8080')
-    })
+        'onlyoffice_url': current_app.config.get('ONLYOFFICE_URL', 'http://localhost:8080')
+    }
+    editor_config_cache().set(cache_key, result)
+    return jsonify(result)
 
-@app.route('/api/onlyoffice/chat/callback', methods=['POST'])
+@bp.route('/api/onlyoffice/chat/callback', methods=['POST'])
 def onlyoffice_chat_callback():
     data = request.get_json()
     if not data: return jsonify({'error': 1})
@@ -1488,67 +2402,184 @@ def onlyoffice_chat_callback():
         download_url = data.get('url')
         key = data.get('key')
         
-        if key and key.startswith('chat_'):
+        if key and download_url and key.startswith('chat_'):
              parts = key.split('_')
              if len(parts) >= 2:
-                 filename = parts[1]
-                 file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'chat', filename)
+                 filename = secure_filename(parts[1])
+                 chat_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'chat')
+                 file_path = os.path.join(chat_dir, filename)
+                 
+                 claim = claim_onlyoffice_callback(key, status, download_url)
+                 if not claim:
+                     return jsonify({'error': 0})
                  
                  try:
-                     response = requests.get(download_url, timeout=30)
-                     if response.status_code == 200:
-                         with open(file_path, 'wb') as f:
-                             f.write(response.content)
-                         return jsonify({'error': 0})
+                     tmp_path, _, _ = download_onlyoffice_file(download_url, chat_dir)
+                     os.replace(tmp_path, file_path)
+                     return jsonify({'error': 0})
                  except Exception as e:
                      print(f"Chat callback error: {e}")
+                     release_onlyoffice_callback(claim)
                      return jsonify({'error': 1})
                  
     return jsonify({'error': 0})
 
 # ================== WEBSOCKET HANDLERS ==================
 
+def submit_chat_messages(rows):
+    """Insert chat messages via the group committer; returns their dicts in order"""
+    return current_app.extensions['chat_ingest'].submit(rows)
+
+def insert_chat_messages(batches):
+    """Group-commit flush: one transaction for every queued request's messages.
+    
+    Runs in the leading request's context. Messages are inserted, broadcast
+    and returned in submission order.
+    """
+    messages = [[ChatMessage(**row) for row in rows] for rows in batches]
+    try:
+        for group in messages:
+            db.session.add_all(group)
+        db.session.flush()
+        # The search index is updated in the same transaction as the messages
+        if chat_search.available(db.session):
+            chat_search.index_messages(db.session, [
+                (m.id, m.project_id, m.content, m.file_name) for group in messages for m in group])
+        # Serialize before commit expires the rows (which would re-select each one)
+        User.prime_cache(m.user_id for group in messages for m in group)
+        results = [[m.to_dict() for m in group] for group in messages]
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    
+    by_room = {}
+    for group in results:
+        for data in group:
+            by_room.setdefault(data['project_id'], []).append(data)
+    for project_id, room_messages in by_room.items():
+        room = f'project_{project_id}'
+        if len(room_messages) == 1:
+            socketio.emit('new_message', room_messages[0], room=room)
+        else:
+            socketio.emit('new_messages', {'messages': room_messages}, room=room)
+    return results
+
+def is_project_member(project_id, user_id):
+    return db.session.query(project_members.c.user_id).filter_by(
+        project_id=project_id, user_id=user_id).first() is not None
+
+def socket_project(data):
+    """(user, project_id) for a socket event, or (None, None) if not allowed"""
+    sockets = current_app.extensions['sockets']
+    user = sockets.user(request.sid)
+    try:
+        project_id = int((data or {}).get('project_id'))
+    except (TypeError, ValueError):
+        return None, None
+    # Membership is checked once per socket and project, then cached
+    if user is None or not sockets.can_access(
+            request.sid, project_id, lambda: is_project_member(project_id, user['id'])):
+        return None, None
+    return user, project_id
+
+def leave_presence(room, sid, user_id):
+    current_app.extensions['typing'].forget(room, user_id)
+    if current_app.extensions['presence'].leave(room, sid, user_id):
+        socketio.emit('presence', {'project_id': int(room.split('_', 1)[1]), 'joined': [], 'left': [user_id]}, room=room)
+
+@socketio.on('connect')
+def on_connect(auth=None):
+    """Authenticate the socket once with the same JWT the REST API uses"""
+    token = (auth or {}).get('token') or request.args.get('token')
+    try:
+        user = User.query.get(int(decode_token(token)['sub']))
+    except Exception:
+        user = None
+    if not user:
+        raise ConnectionRefusedError('unauthorized')
+    current_app.extensions['sockets'].add(request.sid, {
+        'id': user.id, 'username': user.username, 'avatar_color': user.avatar_color
+    })
+
+@socketio.on('disconnect')
+def on_disconnect():
+    for room, user_id in current_app.extensions['presence'].rooms_of(request.sid):
+        leave_presence(room, request.sid, user_id)
+    current_app.extensions['sockets'].remove(request.sid)
+
 @socketio.on('join')
 def on_join(data):
-    room = f"project_{data['project_id']}"
+    user, project_id = socket_project(data)
+    if not user:
+        emit('error', {'error': '无权访问'})
+        return
+    room = f"project_{project_id}"
     join_room(room)
-    emit('user_joined', {'user_id': data.get('user_id')}, room=room)
+    presence = current_app.extensions['presence']
+    if presence.join(room, request.sid, user):
+        emit('presence', {'project_id': project_id, 'joined': [user], 'left': []}, room=room, include_self=False)
+    emit('presence_state', {'project_id': project_id, 'users': presence.users(room)})
 
 @socketio.on('leave')
 def on_leave(data):
-    room = f"project_{data['project_id']}"
+    user, project_id = socket_project(data)
+    if not user:
+        return
+    room = f"project_{project_id}"
     leave_room(room)
-    emit('user_left', {'user_id': data.get('user_id')}, room=room)
+    leave_presence(room, request.sid, user['id'])
 
 @socketio.on('typing')
 def on_typing(data):
-    room = f"project_{data['project_id']}"
-    emit('user_typing', {'user_id': data.get('user_id'), 'username': data.get('username')}, room=room, include_self=False)
+    user, project_id = socket_project(data)
+    if not user:
+        return
+    room = f"project_{project_id}"
+    # Only sockets in the room may type there; throttled and batched per room
+    if current_app.extensions['presence'].is_present(room, request.sid, user['id']):
+        current_app.extensions['typing'].typing(room, user)
 
 # ================== MARKDOWN HELPER ==================
 
-@app.route('/api/render-markdown', methods=['POST'])
+@bp.route('/api/render-markdown', methods=['POST'])
 def render_markdown():
     data = request.get_json()
     content = data.get('content', '')
-    
-    # Convert markdown to HTML
-    html = markdown.markdown(content, extensions=['tables', 'fenced_code', 'codehilite'])
-    
-    # Sanitize HTML
-    allowed_tags = ['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'br', 'hr', 
-                    'strong', 'em', 'a', 'ul', 'ol', 'li', 'code', 'pre',
-                    'blockquote', 'table', 'thead', 'tbody', 'tr', 'th', 'td',
-                    'img', 'span', 'div']
-    allowed_attrs = {'a': ['href', 'title'], 'img': ['src', 'alt'], '*': ['class']}
-    
-    clean_html = bleach.clean(html, tags=allowed_tags, attributes=allowed_attrs)
-    
-    return jsonify({'html': clean_html})
+    if not isinstance(content, str):
+        return jsonify({'error': '渲染内容格式错误'}), 400
+    return jsonify({'html': current_app.extensions['markdown'].render(content)})
+
+@bp.route('/api/render-markdown:batch', methods=['POST'])
+@jwt_required()
+def render_markdown_batch():
+    """Render many documents in one call: {'items': [{'id', 'content'}]} -> {'results': [{'id', 'html'}]}"""
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    if not isinstance(items, list):
+        return jsonify({'error': '缺少渲染内容'}), 400
+    if len(items) > current_app.config['MARKDOWN_BATCH_MAX']:
+        return jsonify({'error': f"一次最多渲染 {current_app.config['MARKDOWN_BATCH_MAX']} 条"}), 400
+    
+    item_limit = current_app.config['MARKDOWN_ITEM_MAX_CHARS']
+    total = 0
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get('content', ''), str):
+            return jsonify({'error': '渲染内容格式错误'}), 400
+        size = len(item.get('content', ''))
+        if size > item_limit:
+            return jsonify({'error': f"单条内容不能超过 {item_limit} 个字符"}), 400
+        total += size
+    if total > current_app.config['MARKDOWN_BATCH_MAX_CHARS']:
+        return jsonify({'error': f"内容总长度不能超过 {current_app.config['MARKDOWN_BATCH_MAX_CHARS']} 个字符"}), 400
+    
+    renderer = current_app.extensions['markdown']
+    return jsonify({'results': [{'id': item.get('id'), 'html': renderer.render(item.get('content', ''))}
+                                for item in items]})
 
 # ================== HEALTH CHECK ENDPOINTS ==================
 
-@app.route('/health')
+@bp.route('/health')
 def health_check():
     """Health check endpoint for load balancers and monitoring.
     Returns 200 if the application is running.
@@ -1559,7 +2590,7 @@ def health_check():
         'service': 'teamwork'
     }), 200
 
-@app.route('/ready')
+@bp.route('/ready')
 def readiness_check():
     """Readiness check endpoint that verifies database connectivity.
     Returns 200 if ready to serve requests, 503 if not.
@@ -1583,9 +2614,13 @@ def readiness_check():
 
 # ================== MAIN PAGE ==================
 
-@app.route('/')
+@bp.route('/')
 def index():
     return render_template('index.html')
 
+app = create_app()
+
 if __name__ == '__main__':
+    init_db(app)
+    start_background_jobs(app)
     socketio.run(app, debug=True, host='0.0.0.0', port=5000)
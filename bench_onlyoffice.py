@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+"""Load test for the OnlyOffice save path - no Document Server needed.
+
+Runs the app in-process on a throwaway database and upload folder, plays the
+Document Server with onlyoffice_stub.py and fires a weighted mix of status
+1/2/4/6 callbacks (plus optional version restores) at a fixed rate. Reports
+latency percentiles per operation, version-creation throughput, disk I/O and
+error rates, so regressions in onlyoffice_callback, restore_file_version and
+version storage show up before production.
+
+    python bench_onlyoffice.py --count 500 --rate 50 --concurrency 16 --size-kb 512
+    python bench_onlyoffice.py --mix 2=3,6=3,1=1,4=1,restore=1 --json result.json
+
+Nothing under ./uploads or ./instance is touched unless --database-url points there.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from onlyoffice_stub import OnlyOfficeStub
+
+DEFAULT_MIX = '1=1,2=3,4=1,6=3,restore=1'
+
+
+def parse_mix(spec):
+    """'2=3,6=1,restore=1' -> ([op, ...], [weight, ...])"""
+    ops, weights = [], []
+    for part in spec.split(','):
+        name, _, weight = part.strip().partition('=')
+        op = name if name == 'restore' else int(name)
+        if op not in (1, 2, 4, 6, 'restore'):
+            raise ValueError(f"unsupported operation in --mix: {name}")
+        ops.append(op)
+        weights.append(float(weight or 1))
+    return ops, weights
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def read_proc_io():
+    """Bytes this process read from / wrote to storage (Linux only, else zeros)"""
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                counters[name] = int(value)
+    except OSError:
+        pass
+    return {'read_bytes': counters.get('read_bytes', 0),
+            'write_bytes': counters.get('write_bytes', 0)}
+
+
+def disk_usage(folder):
+    """Bytes on disk under ``folder``, counting hard-linked files once"""
+    seen = set()
+    total = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            st = os.lstat(os.path.join(root, name))
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            total += st.st_size
+    return total
+
+
+def make_document(size):
+    # Text rather than random bytes keeps search re-extraction cheap and
+    # makes every payload unique, so the unchanged-content shortcut never hits
+    return os.urandom(max(1, size // 2)).hex().encode()
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.stub = None
+        self.server = None
+        self.workdir = None
+        self.results = defaultdict(list)   # op -> [(seconds, outcome)]
+        self.lock = threading.Lock()
+        self.seq = 0
+
+    # ---- setup -------------------------------------------------------------
+
+    def setup(self):
+        args = self.args
+        self.workdir = tempfile.mkdtemp(prefix='teamwork-bench-')
+        self.stub = OnlyOfficeStub().start()
+
+        # Config reads these at import time, so they must be set before app is imported
+        os.environ['DATABASE_URL'] = args.database_url or f"sqlite:///{os.path.join(self.workdir, 'bench.db')}"
+        os.environ['ONLYOFFICE_URL'] = self.stub.url
+
+        from werkzeug.serving import make_server, WSGIRequestHandler
+        from flask_jwt_extended import create_access_token
+        import app as appmod
+        from models import db, User, Project, Card, Attachment
+
+        app = appmod.create_app(args.config)
+        app.config['UPLOAD_FOLDER'] = os.path.join(self.workdir, 'uploads')
+        app.config['DERIVATIVE_FOLDER'] = os.path.join(self.workdir, 'uploads', 'derivatives')
+        # The threaded dev server has no eventlet hub to run background tasks on
+        drops = app.extensions['onlyoffice_drops']
+        drops.spawn = lambda fn: threading.Thread(target=fn, daemon=True).start()
+        appmod.init_db(app)
+        self.app = app
+        self.db = db
+
+        attachments_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'attachments')
+        with app.app_context():
+            user = User(username='bench', email='bench@example.com')
+            user.set_password('bench')
+            db.session.add(user)
+            db.session.flush()
+            project = Project(name='Bench', owner_id=user.id)
+            project.members.append(user)
+            db.session.add(project)
+            db.session.flush()
+            card = Card(project_id=project.id, title='Bench')
+            db.session.add(card)
+            db.session.flush()
+
+            self.attachment_ids = []
+            for i in range(args.attachments):
+                filename = f"bench_{i}.txt"
+                body = make_document(args.size_kb * 1024)
+                with open(os.path.join(attachments_dir, filename), 'wb') as f:
+                    f.write(body)
+                attachment = Attachment(card_id=card.id, filename=filename,
+                                        original_filename=filename, file_type='text',
+                                        file_size=len(body))
+                db.session.add(attachment)
+                db.session.flush()
+                self.attachment_ids.append(attachment.id)
+            db.session.commit()
+            self.user_id = user.id
+            self.token = create_access_token(identity=str(user.id))
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        self.server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+
+        import requests
+        self.http = requests.Session()
+        self.http.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency))
+
+    def teardown(self):
+        if self.server:
+            self.server.shutdown()
+        if self.stub:
+            self.stub.stop()
+        if self.workdir and not self.args.keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    # ---- operations --------------------------------------------------------
+
+    def doc_key(self, attachment_id):
+        # The callback only parses the attachment id from the key
+        return f"{attachment_id}_{int(time.time() * 1000)}"
+
+    def callback(self, status, attachment_id):
+        url = None
+        name = None
+        if status in (2, 6):
+            with self.lock:
+                self.seq += 1
+                name = f"{attachment_id}_{self.seq}.txt"
+            url = self.stub.add_file(name, make_document(self.args.size_kb * 1024))
+        try:
+            code, reply = self.stub.send_callback(
+                self.base_url + '/api/onlyoffice/callback', self.doc_key(attachment_id),
+                status, url=url, users=[str(self.user_id)])
+        finally:
+            if name:
+                self.stub.remove_file(name)
+        return 'ok' if code == 200 and reply.get('error') == 0 else 'error'
+
+    def restore(self, attachment_id):
+        headers = {'Authorization': f"Bearer {self.token}"}
+        versions = self.http.get(f"{self.base_url}/api/attachments/{attachment_id}/versions",
+                                 headers=headers, timeout=60).json().get('versions', [])
+        if not versions:
+            return 'skipped'
+        version = random.choice(versions)
+        response = self.http.post(
+            f"{self.base_url}/api/attachments/{attachment_id}/restore/{version['id']}",
+            headers=headers, timeout=60)
+        if response.status_code == 409:
+            return 'conflict'  # Lost the race for the attachment lock - expected under load
+        return 'ok' if response.status_code == 200 else 'error'
+
+    def run_one(self, op):
+        attachment_id = random.choice(self.attachment_ids)
+        started = time.perf_counter()
+        try:
+            outcome = self.restore(attachment_id) if op == 'restore' else self.callback(op, attachment_id)
+        except Exception as e:
+            print(f"{op} failed: {e}")
+            outcome = 'error'
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.results[op].append((elapsed, outcome))
+
+    # ---- driver ------------------------------------------------------------
+
+    def count_versions(self):
+        from models import FileVersion
+        with self.app.app_context():
+            count = FileVersion.query.count()
+            self.db.session.remove()
+            return count
+
+    def run(self):
+        args = self.args
+        ops, weights = parse_mix(args.mix)
+        interval = 1.0 / args.rate if args.rate else 0
+
+        versions_before = self.count_versions()
+        io_before = read_proc_io()
+        started = time.perf_counter()
+
+        # Open loop: operations are issued on schedule whether or not earlier
+        # ones finished, so a slow save path shows up as growing latency
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            for i in range(args.count):
+                if interval:
+                    delay = started + i * interval - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                pool.submit(self.run_one, random.choices(ops, weights)[0])
+
+        elapsed = time.perf_counter() - started
+        io_after = read_proc_io()
+        versions_created = self.count_versions() - versions_before
+
+        return self.report(elapsed, versions_created, io_before, io_after)
+
+    def report(self, elapsed, versions_created, io_before, io_after):
+        operations = {}
+        total = errors = 0
+        for op, samples in sorted(self.results.items(), key=lambda item: str(item[0])):
+            latencies = sorted(s for s, _ in samples)
+            outcomes = defaultdict(int)
+            for _, outcome in samples:
+                outcomes[outcome] += 1
+            total += len(samples)
+            errors += outcomes.get('error', 0)
+            operations[str(op) if op == 'restore' else f"status_{op}"] = {
+                'count': len(samples),
+                'outcomes': dict(outcomes),
+                'error_rate': outcomes.get('error', 0) / len(samples),
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'max_ms': latencies[-1] * 1000,
+            }
+        return {
+            'elapsed_s': elapsed,
+            'operations': operations,
+            'total': total,
+            'error_rate': errors / total if total else 0.0,
+            'achieved_rate': total / elapsed if elapsed else 0.0,
+            'versions_created': versions_created,
+            'versions_per_s': versions_created / elapsed if elapsed else 0.0,
+            'disk_read_bytes': io_after['read_bytes'] - io_before['read_bytes'],
+            'disk_write_bytes': io_after['write_bytes'] - io_before['write_bytes'],
+            'upload_folder_bytes': disk_usage(self.app.config['UPLOAD_FOLDER']),
+            'settings': {k: v for k, v in vars(self.args).items() if k != 'json'},
+        }
+
+
+def print_report(result):
+    print(f"\n{result['total']} operations in {result['elapsed_s']:.2f}s "
+          f"({result['achieved_rate']:.1f}/s), error rate {result['error_rate']:.2%}")
+    print(f"{'operation':<12}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}  outcomes")
+    for name, op in result['operations'].items():
+        outcomes = ', '.join(f"{k}={v}" for k, v in sorted(op['outcomes'].items()))
+        print(f"{name:<12}{op['count']:>7}{op['p50_ms']:>10.1f}{op['p95_ms']:>10.1f}"
+              f"{op['p99_ms']:>10.1f}{op['max_ms']:>10.1f}  {outcomes}")
+    print(f"versions created: {result['versions_created']} ({result['versions_per_s']:.1f}/s)")
+    print(f"disk I/O: read {result['disk_read_bytes'] / 1048576:.1f} MiB, "
+          f"write {result['disk_write_bytes'] / 1048576:.1f} MiB; "
+          f"upload folder {result['upload_folder_bytes'] / 1048576:.1f} MiB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the OnlyOffice save/restore path')
+    parser.add_argument('--count', type=int, default=200, help='operations to issue')
+    parser.add_argument('--rate', type=float, default=20, help='operations per second (0 = as fast as possible)')
+    parser.add_argument('--concurrency', type=int, default=8, help='operations in flight at most')
+    parser.add_argument('--size-kb', type=int, default=256, help='size of each saved document')
+    parser.add_argument('--attachments', type=int, default=4, help='attachments the load is spread over')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"weighted operations (default {DEFAULT_MIX})")
+    parser.add_argument('--config', default='production', help='config name passed to create_app')
+    parser.add_argument('--database-url', help='database to use instead of a temporary sqlite file')
+    parser.add_argument('--seed', type=int, help='random seed for a repeatable operation sequence')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary work directory')
+    args = parser.parse_args(argv)
+    parse_mix(args.mix)  # Fail on a bad mix before any setup
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    bench = Bench(args)
+    try:
+        bench.setup()
+        result = bench.run()
+    finally:
+        bench.teardown()
+
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 1 if result['error_rate'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
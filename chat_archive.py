@@ -0,0 +1,204 @@
+"""Cold storage for old chat messages.
+
+Messages older than ``CHAT_ARCHIVE_AFTER_DAYS`` are moved out of the hot
+``chat_messages`` table into gzip-compressed JSON-lines segments, one per
+project per month:
+
+    <CHAT_ARCHIVE_FOLDER>/<project_id>/<YYYY-MM>.jsonl.gz
+
+Each segment has a ChatArchiveSegment row (id and time range, message count)
+so readers only open the segments a page actually needs. A segment is
+written and renamed into place before its rows are deleted, so a crash in
+between only leaves rows that the next run merges in again (by id).
+"""
+import os
+import gzip
+import json
+import shutil
+from datetime import datetime
+
+from cache import LRUCache
+from models import db, ChatMessage, ChatArchiveSegment, User
+from storage import atomic_replace
+
+# Decoded segments, keyed by (path, mtime): a rewritten segment is reloaded
+_segments = LRUCache(maxsize=32)
+
+
+def segment_path(folder, project_id, month):
+    return os.path.join(folder, str(project_id), f"{month}.jsonl.gz")
+
+
+def _row(message):
+    return {
+        'id': message.id,
+        'project_id': message.project_id,
+        'user_id': message.user_id,
+        'content': message.content,
+        'file_path': message.file_path,
+        'file_name': message.file_name,
+        'created_at': message.created_at.isoformat(),
+    }
+
+
+def read_segment(path):
+    """[(created_at, id, row), ...] sorted oldest first"""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return []
+    cache_key = (path, mtime)
+    entries = _segments.get(cache_key)
+    if entries is None:
+        entries = []
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                row = json.loads(line)
+                entries.append((datetime.fromisoformat(row['created_at']), row['id'], row))
+        entries.sort(key=lambda e: (e[0], e[1]))
+        _segments.set(cache_key, entries)
+    return entries
+
+
+def _write_segment(path, rows):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with atomic_replace(path) as tmp_path:
+        with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=6) as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False))
+                f.write('\n')
+
+
+def archive_project_month(folder, project_id, month, messages):
+    """Merge ``messages`` (ChatMessage rows of one project and month) into their segment"""
+    path = segment_path(folder, project_id, month)
+    merged = {entry[1]: entry[2] for entry in read_segment(path)}
+    for message in messages:
+        merged[message.id] = _row(message)
+    rows = sorted(merged.values(), key=lambda r: (r['created_at'], r['id']))
+    _write_segment(path, rows)
+
+    segment = ChatArchiveSegment.query.filter_by(project_id=project_id, month=month).first()
+    if not segment:
+        segment = ChatArchiveSegment(project_id=project_id, month=month)
+        db.session.add(segment)
+    segment.message_count = len(rows)
+    segment.first_id = min(r['id'] for r in rows)
+    segment.last_id = max(r['id'] for r in rows)
+    segment.first_at = datetime.fromisoformat(rows[0]['created_at'])
+    segment.last_at = datetime.fromisoformat(rows[-1]['created_at'])
+
+    ChatMessage.query.filter(ChatMessage.id.in_([m.id for m in messages]))\
+        .delete(synchronize_session=False)
+    db.session.commit()
+
+
+def archive_old_messages(folder, cutoff, batch_size=5000):
+    """Move messages created before ``cutoff`` into segments; returns how many moved"""
+    moved = 0
+    while True:
+        # Oldest first, one project-month at a time, bounded per transaction
+        first = ChatMessage.query.filter(ChatMessage.created_at < cutoff)\
+            .order_by(ChatMessage.created_at, ChatMessage.id).first()
+        if not first:
+            return moved
+        month = first.created_at.strftime('%Y-%m')
+        month_start = first.created_at.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        next_month = (month_start.replace(year=month_start.year + 1, month=1)
+                      if month_start.month == 12 else month_start.replace(month=month_start.month + 1))
+        messages = ChatMessage.query.filter(
+            ChatMessage.project_id == first.project_id,
+            ChatMessage.created_at >= month_start,
+            ChatMessage.created_at < min(next_month, cutoff),
+        ).order_by(ChatMessage.created_at, ChatMessage.id).limit(batch_size).all()
+        archive_project_month(folder, first.project_id, month, messages)
+        moved += len(messages)
+
+
+def delete_project_archive(folder, project_id):
+    """Drop a deleted project's segments (the caller commits)"""
+    ChatArchiveSegment.query.filter_by(project_id=project_id).delete(synchronize_session=False)
+    shutil.rmtree(os.path.join(folder, str(project_id)), ignore_errors=True)
+
+
+def _segments_for(project_id, newest_first):
+    order = ChatArchiveSegment.month.desc() if newest_first else ChatArchiveSegment.month.asc()
+    return ChatArchiveSegment.query.filter_by(project_id=project_id).order_by(order).all()
+
+
+def find_archived(folder, project_id, message_id):
+    """(created_at, id) of an archived message, or None"""
+    for segment in ChatArchiveSegment.query.filter(
+            ChatArchiveSegment.project_id == project_id,
+            ChatArchiveSegment.first_id <= message_id,
+            ChatArchiveSegment.last_id >= message_id).all():
+        for created_at, entry_id, _ in read_segment(segment_path(folder, project_id, segment.month)):
+            if entry_id == message_id:
+                return created_at, entry_id
+    return None
+
+
+def archived_messages(folder, project_id, message_ids):
+    """{id: row} for the archived messages among ``message_ids``"""
+    wanted = set(message_ids)
+    found = {}
+    for segment in ChatArchiveSegment.query.filter(
+            ChatArchiveSegment.project_id == project_id,
+            ChatArchiveSegment.first_id <= max(wanted),
+            ChatArchiveSegment.last_id >= min(wanted)).all():
+        for _, entry_id, row in read_segment(segment_path(folder, project_id, segment.month)):
+            if entry_id in wanted:
+                found[entry_id] = row
+    return found
+
+
+def iter_archived(folder):
+    """Every archived row, segment by segment"""
+    for segment in ChatArchiveSegment.query.order_by(
+            ChatArchiveSegment.project_id, ChatArchiveSegment.month).all():
+        for _, _, row in read_segment(segment_path(folder, segment.project_id, segment.month)):
+            yield row
+
+
+def archived_before(folder, project_id, key, limit):
+    """Up to ``limit`` archived rows older than ``key`` = (created_at, id), newest first.
+
+    ``key`` None means "from the newest archived message".
+    """
+    result = []
+    for segment in _segments_for(project_id, newest_first=True):
+        if key is not None and segment.first_at > key[0]:
+            continue
+        for created_at, entry_id, row in reversed(read_segment(segment_path(folder, project_id, segment.month))):
+            if key is None or (created_at, entry_id) < key:
+                result.append(row)
+                if len(result) >= limit:
+                    return result
+    return result
+
+
+def archived_after(folder, project_id, key, limit):
+    """Up to ``limit`` archived rows newer than ``key`` = (created_at, id), oldest first"""
+    result = []
+    for segment in _segments_for(project_id, newest_first=False):
+        if segment.last_at < key[0]:
+            continue
+        for created_at, entry_id, row in read_segment(segment_path(folder, project_id, segment.month)):
+            if (created_at, entry_id) > key:
+                result.append(row)
+                if len(result) >= limit:
+                    return result
+    return result
+
+
+def archived_count(project_id):
+    return db.session.query(db.func.coalesce(db.func.sum(ChatArchiveSegment.message_count), 0))\
+        .filter_by(project_id=project_id).scalar()
+
+
+def row_to_dict(row):
+    """Archived row in the same shape as ChatMessage.to_dict()"""
+    data = dict(row)
+    data['user'] = User.cached_dict(row['user_id'])
+    data['archived'] = True
+    return data
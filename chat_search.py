@@ -0,0 +1,130 @@
+"""Full-text search over chat messages (content and attachment names).
+
+Backed by an SQLite FTS5 table whose rowid is the message id. SQLite's own
+tokenizers treat a run of Chinese/Japanese/Korean text as one huge token, so
+text is tokenized here before indexing:
+
+- CJK runs become overlapping bigrams, plus the run's last character on its
+  own; a query for a CJK phrase is the phrase of its bigrams, which matches
+  exactly where the text contains it, and a single character is a prefix
+  query that finds it anywhere in a run.
+- Everything else becomes lower-cased words.
+
+The index is maintained as messages are inserted and is independent of the
+hot/archive split, so archived messages stay searchable. On other databases
+``available()`` is False and callers fall back to a plain LIKE search.
+"""
+import re
+
+from sqlalchemy import text
+
+TABLE = 'chat_search'
+
+_CJK = '぀-ヿ㐀-䶿一-鿿가-힯豈-﫿'
+_TOKEN_RE = re.compile(f'([{_CJK}]+)|((?:(?![{_CJK}])[^\\W_])+)')
+
+
+def _tokens(value, for_query=False):
+    """[(token, is_cjk_run_part, run_id)] in text order"""
+    result = []
+    for run_id, match in enumerate(_TOKEN_RE.finditer(value or '')):
+        cjk, word = match.groups()
+        if word:
+            result.append((word.lower(), False, run_id))
+            continue
+        if len(cjk) == 1:
+            result.append((cjk, True, run_id))
+            continue
+        for i in range(len(cjk) - 1):
+            result.append((cjk[i:i + 2], True, run_id))
+        if not for_query:
+            # Lets a single-character query find a run's last character
+            result.append((cjk[-1], True, run_id))
+    return result
+
+
+def tokenize(value):
+    """Index terms of ``value``: CJK bigrams and lower-cased words"""
+    return [token for token, _, _ in _tokens(value)]
+
+
+def index_terms(*values):
+    """Space-separated terms stored in the FTS table for a message"""
+    return ' '.join(token for value in values for token in tokenize(value))
+
+
+def match_expression(query, any_term=False):
+    """FTS5 MATCH expression for a user query, or None if it has no searchable terms.
+
+    Every term must match unless ``any_term`` (used to find related messages
+    for a natural-language question).
+    """
+    groups = {}
+    order = []
+    for token, is_cjk, run_id in _tokens(query, for_query=True):
+        if run_id not in groups:
+            groups[run_id] = (is_cjk, [])
+            order.append(run_id)
+        groups[run_id][1].append(token)
+    if not order:
+        return None
+    if any_term:
+        return ' OR '.join(f'"{token}"' for run_id in order for token in groups[run_id][1])
+    parts = []
+    for i, run_id in enumerate(order):
+        is_cjk, tokens = groups[run_id]
+        if is_cjk and len(tokens[0]) == 1:
+            parts.append(f'"{tokens[0]}"*')
+        elif is_cjk:
+            parts.append('"' + ' '.join(tokens) + '"')
+        else:
+            # Prefix-match the last word so results follow the user as they type
+            suffix = '*' if i == len(order) - 1 else ''
+            parts.append(f'"{tokens[0]}"{suffix}')
+    return ' AND '.join(parts)
+
+
+def available(session):
+    return session.get_bind().dialect.name == 'sqlite'
+
+
+def ensure_index(session):
+    """Create the FTS table if missing; returns True if it was just created"""
+    exists = session.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=:name"), {'name': TABLE}).first()
+    if exists:
+        return False
+    session.execute(text(
+        f"CREATE VIRTUAL TABLE {TABLE} USING fts5(terms, project_id UNINDEXED, tokenize='unicode61')"))
+    return True
+
+
+def index_messages(session, rows):
+    """Add ``rows`` of (message_id, project_id, content, file_name); the caller commits"""
+    params = [{'id': message_id, 'project_id': project_id, 'terms': index_terms(content, file_name)}
+              for message_id, project_id, content, file_name in rows]
+    if params:
+        session.execute(text(
+            f"INSERT OR REPLACE INTO {TABLE} (rowid, terms, project_id) VALUES (:id, :terms, :project_id)"),
+            params)
+
+
+def clear(session):
+    session.execute(text(f"DELETE FROM {TABLE}"))
+
+
+def delete_project(session, project_id):
+    session.execute(text(f"DELETE FROM {TABLE} WHERE project_id = :project_id"),
+                    {'project_id': project_id})
+
+
+def search(session, project_id, query, limit, offset=0, any_term=False):
+    """[message_id, ...] best match first (BM25, newer first on ties)"""
+    expression = match_expression(query, any_term)
+    if not expression:
+        return []
+    rows = session.execute(text(
+        f"SELECT rowid FROM {TABLE} WHERE {TABLE} MATCH :expression AND project_id = :project_id "
+        f"ORDER BY bm25({TABLE}), rowid DESC LIMIT :limit OFFSET :offset"),
+        {'expression': expression, 'project_id': project_id, 'limit': limit, 'offset': offset})
+    return [row[0] for row in rows]
@@ -8,14 +8,101 @@ class Config:
     JWT_ACCESS_TOKEN_EXPIRES = 86400  # 24 hours
     UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
     MAX_CONTENT_LENGTH = 50 * 1024 * 1024  # 50MB max file size
+    
+    # Thumbnails / first-page previews, cached by content hash
+    DERIVATIVE_FOLDER = os.path.join(UPLOAD_FOLDER, 'derivatives')
+    THUMBNAIL_SIZES = {'sm': 160, 'md': 480, 'lg': 1280}  # Max edge in pixels
+    THUMBNAIL_CACHE_MAX_AGE = 365 * 24 * 3600  # Content-addressed, safe to cache for a year
+    # Socket.IO fan-out between workers/nodes: redis://host:6379/0,
+    # unix:///path/to/dir (one host, no broker) or memory:// (tests). See fanout.py.
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE') or ''
+    SOCKETIO_CHANNEL = os.environ.get('SOCKETIO_CHANNEL') or 'teamwork'
+    # Board changes to one project within this many seconds go out as one event
+    BOARD_EVENT_WINDOW = 0.05
+    # Chat older than this many days moves to compressed per-project monthly
+    # segments (0 disables); checked every CHAT_ARCHIVE_INTERVAL seconds
+    CHAT_ARCHIVE_FOLDER = os.path.join(UPLOAD_FOLDER, 'archive', 'chat')
+    CHAT_ARCHIVE_AFTER_DAYS = int(os.environ.get('CHAT_ARCHIVE_AFTER_DAYS') or 180)
+    CHAT_ARCHIVE_INTERVAL = 3600
+    # Chat group commit: messages posted within CHAT_COMMIT_WINDOW seconds of
+    # each other share one transaction (up to CHAT_COMMIT_MAX_ROWS rows)
+    CHAT_COMMIT_WINDOW = 0.005
+    CHAT_COMMIT_MAX_ROWS = 500
+    CHAT_BATCH_MAX = 200  # Messages per POST /messages:batch request
+    # Typing notices: batched per room over TYPING_WINDOW seconds, at most one
+    # per user every TYPING_INTERVAL seconds (clients show them for 2s)
+    TYPING_WINDOW = 0.3
+    TYPING_INTERVAL = 1.5
+    # Presence is shared by workers through the database: each worker refreshes
+    # its sockets every PRESENCE_HEARTBEAT seconds, and sockets of a worker that
+    # died are dropped (and reported offline) after PRESENCE_TTL seconds
+    PRESENCE_HEARTBEAT = 30
+    PRESENCE_TTL = 90
+    
+    # Serialized users reused across chat, member and assignee payloads (per worker)
+    USER_CACHE_SIZE = 4096
+    USER_CACHE_TTL = 300  # Seconds; bounds staleness of profile changes made by other workers
     OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY') or ''
     OPENAI_MODEL = os.environ.get('OPENAI_MODEL') or 'gpt-3.5-turbo'
+    OPENAI_API_BASE = os.environ.get('OPENAI_API_BASE') or ''  # OpenAI-compatible gateway; empty for api.openai.com
+    OPENAI_TIMEOUT = 60   # Seconds per completion request
+    OPENAI_RETRIES = 2
+    # Completions (and open streams) in flight per worker; callers wait up to
+    # AI_QUEUE_TIMEOUT seconds for a slot, then get 503
+    AI_MAX_CONCURRENCY = 8
+    AI_QUEUE_TIMEOUT = 30
+    AI_BACKEND = os.environ.get('AI_BACKEND') or 'openai'  # 'fake' answers locally (tests, development)
+    # /ai/ask packs the passages most relevant to the question into this many
+    # (estimated) prompt tokens; long texts are split into passages first
+    AI_CONTEXT_TOKENS = int(os.environ.get('AI_CONTEXT_TOKENS') or 3000)
+    AI_PASSAGE_TOKENS = 300
+    AI_CONTEXT_MESSAGES = 30  # Related chat messages considered when include_chat is set
+    # Per-project vector index of card and attachment text (needs numpy);
+    # powers /cards/similar and adds AI_SEMANTIC_WEIGHT x cosine to /ai/ask ranking
+    SEMANTIC_INDEX_FOLDER = os.path.join(UPLOAD_FOLDER, 'semantic')
+    SEMANTIC_EMBEDDER = 'hashing'
+    SEMANTIC_DIM = 512
+    AI_SEMANTIC_WEIGHT = 2.0
+    # Answers and summaries are reused for the same model, prompt and context
+    AI_CACHE_TTL = int(os.environ.get('AI_CACHE_TTL') or 7 * 24 * 3600)  # Seconds; 0 disables
+    AI_CACHE_MAX_ENTRIES = 5000
+    # Summaries beyond AI_SUMMARY_DIRECT_TOKENS run as a background map-reduce
+    # job: chunks of AI_SUMMARY_CHUNK_TOKENS, AI_SUMMARY_PARALLELISM at a time
+    AI_SUMMARY_DIRECT_TOKENS = 6000
+    AI_SUMMARY_CHUNK_TOKENS = 3000
+    AI_SUMMARY_PARALLELISM = 4
+    AI_JOB_STALE_AFTER = 600  # Seconds without progress before a job counts as lost (worker restarted)
+    
+    # Sandboxed document parsing (see extraction.py for all keys and defaults).
+    # 'default' applies to every format; per-type entries override it.
+    EXTRACTION_LIMITS = {
+        'default': {'cpu_seconds': 10, 'memory_mb': 512, 'timeout': 20},
+        'excel': {'memory_mb': 768},
+        'pdf': {'cpu_seconds': 20, 'timeout': 30},
+    }
     
     # OnlyOffice Document Server settings
     ONLYOFFICE_URL = os.environ.get('ONLYOFFICE_URL') or 'http://localhost:8080'
     ONLYOFFICE_JWT_SECRET = os.environ.get('ONLYOFFICE_JWT_SECRET') or 'teamwork-onlyoffice-secret-key'
     # Internal URL for OnlyOffice to access Flask (Docker bridge IP or host.docker.internal)
     INTERNAL_URL = os.environ.get('INTERNAL_URL') or 'http://172.17.0.1:5000'
+    # Pooled Document Server client: per-call timeouts, retries and circuit breaker
+    ONLYOFFICE_TIMEOUT = 5              # Seconds for connect / Command Service calls
+    ONLYOFFICE_DOWNLOAD_TIMEOUT = 60    # Read timeout while streaming saved documents
+    ONLYOFFICE_RETRIES = 2              # Extra attempts on connection errors and 5xx
+    ONLYOFFICE_POOL_SIZE = 10           # Keep-alive connections per worker
+    ONLYOFFICE_BREAKER_THRESHOLD = 5    # Consecutive failures before failing fast
+    ONLYOFFICE_BREAKER_RESET = 30       # Seconds before a trial call is let through
+    # Signed editor configs kept per worker, keyed by document key and user
+    ONLYOFFICE_CONFIG_CACHE_SIZE = 1024
+    MARKDOWN_CACHE_SIZE = 2048  # Rendered documents kept per worker, keyed by content hash
+    MARKDOWN_BATCH_MAX = 200  # Documents per POST /api/render-markdown:batch
+    MARKDOWN_ITEM_MAX_CHARS = 100000  # Per document in a batch
+    MARKDOWN_BATCH_MAX_CHARS = 1000000  # All documents of a batch together
+    # Seconds to wait for another worker's save/restore of the same attachment
+    ATTACHMENT_LOCK_TIMEOUT = 30
+    # How long a processed save callback is remembered to swallow OnlyOffice retries
+    ONLYOFFICE_CALLBACK_DEDUP_TTL = 24 * 3600
     
     # SQLAlchemy connection pool settings for concurrent access
     SQLALCHEMY_ENGINE_OPTIONS = {
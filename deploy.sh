@@ -234,10 +234,14 @@ INTERNAL_URL=http://172.17.0.1:$FLASK_PORT
 # Optional: OpenAI API (for AI features)
 # OPENAI_API_KEY=your-api-key-here
 # OPENAI_MODEL=gpt-3.5-turbo
+# OPENAI_API_BASE=http://127.0.0.1:8000/v1
 
 # Gunicorn Configuration (Production)
 GUNICORN_WORKERS=4
 GUNICORN_BIND=0.0.0.0:$FLASK_PORT
+
+# Real-time event fan-out between the workers (use redis://host:6379/0 across nodes)
+SOCKETIO_MESSAGE_QUEUE=unix://$APP_DIR/run/socketio
 EOF
     
     log "Environment file created: $ENV_FILE"
@@ -286,12 +290,52 @@ if [ -f "$APP_DIR/migrate_content_column.py" ]; then
     python3 "$APP_DIR/migrate_content_column.py" || warn "Migration script failed (may already be applied)"
 fi
 
+# Run content hash migration if needed
+if [ -f "$APP_DIR/migrate_content_hash.py" ]; then
+    log "Running database migrations (content hash)..."
+    python3 "$APP_DIR/migrate_content_hash.py" || warn "Content hash migration failed (may already be applied)"
+fi
+
+# Run extraction error migration if needed
+if [ -f "$APP_DIR/migrate_extraction_error.py" ]; then
+    log "Running database migrations (extraction error)..."
+    python3 "$APP_DIR/migrate_extraction_error.py" || warn "Extraction error migration failed (may already be applied)"
+fi
+
+# Run version number uniqueness migration if needed
+if [ -f "$APP_DIR/migrate_version_unique.py" ]; then
+    log "Running database migrations (version numbers)..."
+    python3 "$APP_DIR/migrate_version_unique.py" || warn "Version number migration failed"
+fi
+
+# Run project revision migration if needed
+if [ -f "$APP_DIR/migrate_project_revision.py" ]; then
+    log "Running database migrations (project revision)..."
+    python3 "$APP_DIR/migrate_project_revision.py" || warn "Project revision migration failed (may already be applied)"
+fi
+
+# Run chat message id migration if needed
+if [ -f "$APP_DIR/migrate_chat_ids.py" ]; then
+    log "Running database migrations (chat message ids)..."
+    python3 "$APP_DIR/migrate_chat_ids.py" || warn "Chat message id migration failed"
+fi
+
+# Run chat index migration if needed
+if [ -f "$APP_DIR/migrate_chat_indexes.py" ]; then
+    log "Running database migrations (chat indexes)..."
+    python3 "$APP_DIR/migrate_chat_indexes.py" || warn "Chat index migration failed"
+fi
+
 # Run columns and unread status migration
 if [ -f "$APP_DIR/migrate_columns.py" ]; then
     log "Running database migrations (columns/unread)..."
     python3 "$APP_DIR/migrate_columns.py" || warn "Column migration script failed"
 fi
 
+# Upload folders and the chat search index (gunicorn only does this itself
+# when it preloads the app)
+python3 -m flask --app app init-db || warn "init-db failed"
+
 log "Database initialized."
 
 # ============================================================
@@ -0,0 +1,181 @@
+"""Thumbnail and preview derivatives for images and PDF attachments.
+
+Derivatives are content-addressed: every rendition is stored under the SHA-256
+of the source file, so identical uploads share thumbnails and a file that is
+edited in place naturally gets fresh ones without any explicit invalidation.
+"""
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+
+# Image types we can thumbnail directly; PDFs get a first-page render
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+DERIVATIVE_FILE_TYPES = {'image', 'pdf'}
+
+_digest_cache = {}
+_digest_cache_lock = threading.Lock()
+_DIGEST_CACHE_MAX = 4096
+
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """Return the SHA-256 hex digest of a file.
+
+    Results are memoized per (path, mtime, size) so repeated thumbnail
+    requests for the same file don't re-read it from disk.
+    """
+    st = os.stat(path)
+    cache_key = (path, st.st_mtime_ns, st.st_size)
+    with _digest_cache_lock:
+        digest = _digest_cache.get(cache_key)
+    if digest:
+        return digest
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+
+    with _digest_cache_lock:
+        if len(_digest_cache) >= _DIGEST_CACHE_MAX:
+            _digest_cache.clear()
+        _digest_cache[cache_key] = digest
+    return digest
+
+
+def derivative_path(folder, digest, size_name):
+    """Location of a derivative, sharded by the first two hex digits."""
+    return os.path.join(folder, digest[:2], f"{digest}_{size_name}.jpg")
+
+
+def supports_derivatives(file_type):
+    return file_type in DERIVATIVE_FILE_TYPES
+
+
+def _render_pdf_first_page(path, max_side):
+    """Render page 1 of a PDF to a PIL image, or None if no renderer is available.
+
+    Uses PyMuPDF when installed, otherwise falls back to poppler's pdftoppm.
+    """
+    from PIL import Image
+
+    try:
+        import fitz
+    except ImportError:
+        fitz = None
+
+    if fitz is not None:
+        doc = fitz.open(path)
+        try:
+            if doc.page_count == 0:
+                return None
+            page = doc.load_page(0)
+            zoom = max_side / max(page.rect.width, page.rect.height, 1)
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            return Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+        finally:
+            doc.close()
+
+    pdftoppm = shutil.which('pdftoppm')
+    if not pdftoppm:
+        return None
+
+    tmp_dir = tempfile.mkdtemp(prefix='teamwork-pdf-')
+    try:
+        out_prefix = os.path.join(tmp_dir, 'page')
+        subprocess.run(
+            [pdftoppm, '-f', '1', '-l', '1', '-singlefile', '-png',
+             '-scale-to', str(max_side), path, out_prefix],
+            check=True, timeout=30, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        with Image.open(out_prefix + '.png') as page:
+            return page.convert('RGB')
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _open_source(source_path, file_type, max_side):
+    from PIL import Image, ImageOps
+
+    if file_type == 'pdf':
+        return _render_pdf_first_page(source_path, max_side)
+
+    img = Image.open(source_path)
+    # Let the JPEG decoder downscale while decoding - much cheaper for phone photos
+    img.draft('RGB', (max_side, max_side))
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        return background
+    return img.convert('RGB')
+
+
+def generate_derivatives(folder, source_path, file_type, digest, sizes):
+    """Render every size bucket for a source file that isn't cached yet.
+
+    ``sizes`` maps bucket names to the maximum edge length in pixels. The
+    source is decoded once at the largest missing size and then downscaled.
+    Files are written to a temp name and renamed so readers never see a
+    partial JPEG. Returns True if all requested buckets exist afterwards.
+    """
+    missing = {name: px for name, px in sizes.items()
+               if not os.path.exists(derivative_path(folder, digest, name))}
+    if not missing:
+        return True
+
+    img = _open_source(source_path, file_type, max(missing.values()))
+    if img is None:
+        return False
+
+    try:
+        os.makedirs(os.path.join(folder, digest[:2]), exist_ok=True)
+        for name, px in sorted(missing.items(), key=lambda item: -item[1]):
+            img.thumbnail((px, px))
+            target = derivative_path(folder, digest, name)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    img.save(f, 'JPEG', quality=82, optimize=True, progressive=True)
+                os.replace(tmp_path, target)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+    finally:
+        img.close()
+    return True
+
+
+def generate_derivatives_once(folder, source_path, file_type, sizes):
+    """Background-task entry point: hash the file and render its derivatives.
+
+    Concurrent requests for the same content are collapsed so a burst of
+    uploads or thumbnail misses only renders each file once per worker.
+    """
+    try:
+        digest = file_digest(source_path)
+    except OSError as e:
+        print(f"Derivative generation skipped for {source_path}: {e}")
+        return False
+
+    with _pending_lock:
+        if digest in _pending:
+            return False
+        _pending.add(digest)
+    try:
+        return generate_derivatives(folder, source_path, file_type, digest, sizes)
+    except Exception as e:
+        # Log but don't fail - thumbnails are optional
+        print(f"Derivative generation failed for {source_path}: {e}")
+        return False
+    finally:
+        with _pending_lock:
+            _pending.discard(digest)
@@ -0,0 +1,206 @@
+"""Sandboxed document parsing for search indexing and previews.
+
+Third-party parsers (python-docx, openpyxl, python-pptx, PyPDF2) run in a
+short-lived child process with CPU-time and address-space rlimits plus a
+wall-clock timeout, so a malformed PDF or a zip-bomb spreadsheet costs one
+killed subprocess instead of a pinned eventlet worker.
+
+The child is this file executed as a script; it never imports the Flask app.
+"""
+import os
+import sys
+import json
+import signal
+import subprocess
+
+try:
+    import resource
+except ImportError:  # Not available on Windows - run without rlimits
+    resource = None
+
+# Applied to every format unless overridden per file type in EXTRACTION_LIMITS
+DEFAULT_LIMITS = {
+    'cpu_seconds': 10,     # RLIMIT_CPU for the child
+    'memory_mb': 512,      # RLIMIT_AS for the child
+    'timeout': 20,         # Wall-clock seconds before the child is killed
+    'max_chars': 50000,    # Truncate extracted search text
+    'max_pages': 50,       # PDF pages indexed for search
+    'max_slides': 50,      # PowerPoint slides indexed for search
+    'max_sheets': 5,       # Excel sheets indexed for search
+    'max_rows': 1000,      # Excel rows per sheet indexed for search
+}
+
+SANDBOXED_TYPES = {'word', 'excel', 'powerpoint', 'pdf'}
+
+
+def limits_for(file_type, overrides=None):
+    """Merge the configured per-format overrides over the defaults."""
+    limits = dict(DEFAULT_LIMITS)
+    overrides = overrides or {}
+    limits.update(overrides.get('default', {}))
+    limits.update(overrides.get(file_type, {}))
+    return limits
+
+
+# ---------------------------------------------------------------- child side
+
+def extract_text(file_path, file_type, limits):
+    """Plain text for full-text search, truncated to limits['max_chars']."""
+    content = None
+
+    if file_type == 'word':
+        from docx import Document
+        doc = Document(file_path)
+        content = '\n'.join([para.text for para in doc.paragraphs])
+
+    elif file_type == 'excel':
+        import openpyxl
+        wb = openpyxl.load_workbook(file_path, data_only=True, read_only=True)
+        text_parts = []
+        for sheet_name in wb.sheetnames[:limits['max_sheets']]:
+            ws = wb[sheet_name]
+            for row in ws.iter_rows(values_only=True, max_row=limits['max_rows']):
+                for cell in row:
+                    if cell is not None:
+                        text_parts.append(str(cell))
+        wb.close()
+        content = ' '.join(text_parts)
+
+    elif file_type == 'powerpoint':
+        from pptx import Presentation
+        prs = Presentation(file_path)
+        text_parts = []
+        for slide in prs.slides[:limits['max_slides']]:
+            for shape in slide.shapes:
+                if hasattr(shape, 'text'):
+                    text_parts.append(shape.text)
+        content = '\n'.join(text_parts)
+
+    elif file_type == 'pdf':
+        from PyPDF2 import PdfReader
+        reader = PdfReader(file_path)
+        text_parts = []
+        for page in reader.pages[:limits['max_pages']]:
+            text = page.extract_text()
+            if text:
+                text_parts.append(text)
+        content = '\n'.join(text_parts)
+
+    if content and len(content) > limits['max_chars']:
+        content = content[:limits['max_chars']]
+    return content
+
+
+def extract_preview(file_path, file_type, limits):
+    """Structured content for the built-in viewer (paragraphs, sheets, slides, pages)."""
+    if file_type == 'word':
+        from docx import Document
+        doc = Document(file_path)
+        return '\n\n'.join([para.text for para in doc.paragraphs])
+
+    if file_type == 'excel':
+        import openpyxl
+        wb = openpyxl.load_workbook(file_path, data_only=True)
+        sheets = {}
+        for sheet_name in wb.sheetnames:
+            ws = wb[sheet_name]
+            sheets[sheet_name] = [[str(cell) if cell is not None else '' for cell in row]
+                                  for row in ws.iter_rows(values_only=True)]
+        return sheets
+
+    if file_type == 'powerpoint':
+        from pptx import Presentation
+        prs = Presentation(file_path)
+        slides = []
+        for slide in prs.slides:
+            slide_content = [shape.text for shape in slide.shapes if hasattr(shape, 'text')]
+            slides.append('\n'.join(slide_content))
+        return slides
+
+    if file_type == 'pdf':
+        from PyPDF2 import PdfReader
+        reader = PdfReader(file_path)
+        return [page.extract_text() or '' for page in reader.pages]
+
+    raise ValueError(f"unsupported file type: {file_type}")
+
+
+def _apply_rlimits(limits):
+    if resource is None:
+        return
+    cpu = int(limits['cpu_seconds'])
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+    memory = int(limits['memory_mb']) * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+
+
+def _child_main(argv):
+    mode, file_type, file_path, limits_json = argv
+    limits = json.loads(limits_json)
+    _apply_rlimits(limits)
+
+    try:
+        if mode == 'text':
+            result = extract_text(file_path, file_type, limits)
+        else:
+            result = extract_preview(file_path, file_type, limits)
+        payload = {'ok': True, 'result': result}
+    except MemoryError:
+        payload = {'ok': False, 'error': 'memory limit exceeded'}
+    except Exception as e:
+        payload = {'ok': False, 'error': f"{type(e).__name__}: {e}"[:300]}
+
+    sys.stdout.write(json.dumps(payload, ensure_ascii=False))
+    sys.stdout.flush()
+
+
+# --------------------------------------------------------------- parent side
+
+def _describe_exit(returncode):
+    if returncode < 0:
+        sig = -returncode
+        if sig == getattr(signal, 'SIGXCPU', None) or sig == signal.SIGKILL:
+            return 'CPU time limit exceeded'
+        return f"parser killed by signal {sig}"
+    return f"parser exited with status {returncode}"
+
+
+def run_sandboxed(mode, file_path, file_type, limits):
+    """Parse a file in a resource-limited child process.
+
+    ``mode`` is 'text' (search indexing) or 'preview'. Returns a
+    ``(result, error)`` tuple where exactly one side is meaningful; ``error``
+    is a short human-readable reason suitable for storing per attachment.
+    """
+    args = [sys.executable, os.path.abspath(__file__), mode, file_type, file_path, json.dumps(limits)]
+    try:
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                stdin=subprocess.DEVNULL, close_fds=True)
+    except OSError as e:
+        return None, f"could not start parser: {e}"
+
+    try:
+        stdout, _ = proc.communicate(timeout=limits['timeout'])
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        return None, f"timed out after {limits['timeout']}s"
+
+    if not stdout:
+        if proc.returncode == 1:
+            # The interpreter could not even allocate its error report
+            return None, 'memory limit exceeded'
+        return None, _describe_exit(proc.returncode)
+
+    try:
+        payload = json.loads(stdout)
+    except ValueError:
+        return None, _describe_exit(proc.returncode)
+
+    if not payload.get('ok'):
+        return None, payload.get('error') or 'extraction failed'
+    return payload.get('result'), None
+
+
+if __name__ == '__main__':
+    _child_main(sys.argv[1:])
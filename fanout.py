@@ -0,0 +1,219 @@
+"""Cross-process Socket.IO fan-out.
+
+Without a message queue, ``socketio.emit()`` in one gunicorn worker only
+reaches clients connected to that worker. The client managers here publish
+every emit to all workers (and nodes), each of which delivers it to its own
+clients. ``SOCKETIO_MESSAGE_QUEUE`` picks the backend:
+
+    redis://host:6379/0          Redis pub/sub - workers on any number of nodes
+                                 (needs the ``redis`` package)
+    unix:///run/teamwork/sio     UNIX datagram sockets in a directory - workers
+                                 on one host, no broker process
+    memory://                    in-process bus - several servers in one
+                                 process, for tests
+    (empty)                      no fan-out, single worker only
+
+Each event is pickled once and handed to a background sender through a
+queue, so the request that emitted it never waits on the broker.
+"""
+import os
+import uuid
+import errno
+import pickle
+import socket
+import threading
+from urllib.parse import urlparse
+
+import socketio
+
+try:
+    import redis
+except ImportError:  # Only needed for redis:// queues
+    redis = None
+
+# Largest event a unix:// peer accepts; chat and board events are far smaller
+MAX_DATAGRAM = 256 * 1024
+
+
+def _require_green_sockets(server, backend):
+    if server.async_mode != 'eventlet':
+        return
+    from eventlet.patcher import is_monkey_patched
+    if not is_monkey_patched('socket'):
+        raise RuntimeError(f'{backend} fan-out needs eventlet.monkey_patch() under eventlet')
+
+
+class QueuedPublisher:
+    """Mixin for PubSubManager subclasses: serialize once, publish off-request.
+
+    Subclasses implement ``_send(payload)`` for an already pickled message.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._host = (None, None)
+        self._sender_pid = None
+        self._sender_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    @property
+    def host_id(self):
+        # A fresh id per process. With preload_app the manager is created in the
+        # gunicorn master, and workers sharing its id would ignore each other's
+        # messages as their own.
+        pid, host_id = self._host
+        if pid != os.getpid():
+            pid, host_id = self._host = (os.getpid(), uuid.uuid4().hex)
+        return host_id
+
+    @host_id.setter
+    def host_id(self, value):
+        self._host = (os.getpid(), value)
+
+    def initialize(self):
+        self._start_sender()
+        super().initialize()
+
+    def _start_sender(self):
+        """Once per process, on the first emit or the first socket connect.
+
+        python-socketio calls initialize() on a worker's first connect, but
+        REST requests emit long before that.
+        """
+        pid = os.getpid()
+        if self._sender_pid == pid:
+            return
+        with self._sender_lock:
+            if self._sender_pid == pid:
+                return
+            self._prepare()
+            self._outbox = self.server.eio.create_queue()
+            self.server.start_background_task(self._sender)
+            self._sender_pid = pid
+
+    def _prepare(self):
+        """Per-process setup before anything is published"""
+
+    def _publish(self, data):
+        self._start_sender()
+        self._outbox.put(pickle.dumps(data))
+
+    def _sender(self):
+        while True:
+            payload = self._outbox.get()
+            try:
+                self._send(payload)
+            except Exception as e:
+                print(f"Socket.IO fan-out publish failed: {e}")
+
+    def _send(self, payload):
+        raise NotImplementedError
+
+
+class RedisFanout(QueuedPublisher, socketio.RedisManager):
+    name = 'redis'
+
+    def _prepare(self):
+        _require_green_sockets(self.server, 'Redis')
+
+    def _send(self, payload):
+        try:
+            self.redis.publish(self.channel, payload)
+        except redis.exceptions.RedisError:
+            # One reconnect attempt; the listener has its own retry loop
+            self._redis_connect()
+            self.redis.publish(self.channel, payload)
+
+
+class UnixSocketFanout(QueuedPublisher, socketio.PubSubManager):
+    """Broker-less fan-out between processes on one host.
+
+    Every process binds a datagram socket ``<channel>.<host_id>.sock`` in a
+    shared directory and publishes by sending to all the others. Sockets left
+    behind by dead workers are removed on the first failed send.
+    """
+    name = 'unix'
+
+    def __init__(self, directory, channel='socketio', write_only=False, logger=None):
+        self.directory = directory
+        self._send_sock = None
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+
+    def _prepare(self):
+        _require_green_sockets(self.server, 'UNIX socket')
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _socket_path(self, host_id):
+        return os.path.join(self.directory, f"{self.channel}.{host_id}.sock")
+
+    def _peers(self):
+        prefix = f"{self.channel}."
+        own = os.path.basename(self._socket_path(self.host_id))
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and name.endswith('.sock') and name != own:
+                yield os.path.join(self.directory, name)
+
+    def _send(self, payload):
+        if self._send_sock is None:
+            self._send_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        for path in self._peers():
+            try:
+                self._send_sock.sendto(payload, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except OSError as e:
+                if e.errno != errno.EMSGSIZE:
+                    raise
+                print(f"Socket.IO fan-out dropped a {len(payload)} byte event (too large)")
+                return
+
+    def _listen(self):
+        path = self._socket_path(self.host_id)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        try:
+            while True:
+                yield sock.recv(MAX_DATAGRAM)
+        finally:
+            sock.close()
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+class MemoryFanout(QueuedPublisher, socketio.PubSubManager):
+    """Fan-out between Socket.IO servers living in the same process (tests)."""
+    name = 'memory'
+
+    _subscribers = {}  # channel -> [queue, ...], shared by all instances
+    _lock = threading.Lock()
+
+    def _send(self, payload):
+        with self._lock:
+            queues = list(self._subscribers.get(self.channel, ()))
+        for queue in queues:
+            queue.put(payload)
+
+    def _listen(self):
+        queue = self.server.eio.create_queue()
+        with self._lock:
+            self._subscribers.setdefault(self.channel, []).append(queue)
+        while True:
+            yield queue.get()
+
+
+def client_manager_for(url, channel='socketio'):
+    """Build the client manager for a SOCKETIO_MESSAGE_QUEUE url, or None if unset"""
+    if not url:
+        return None
+    parsed = urlparse(url)
+    if parsed.scheme in ('redis', 'rediss'):
+        return RedisFanout(url, channel=channel)
+    if parsed.scheme == 'unix':
+        return UnixSocketFanout(parsed.path, channel=channel)
+    if parsed.scheme == 'memory':
+        return MemoryFanout(channel=channel)
+    raise ValueError(f"Unsupported SOCKETIO_MESSAGE_QUEUE: {url}")
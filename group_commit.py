@@ -0,0 +1,92 @@
+"""Group commit: batch writes from concurrent requests into one transaction.
+
+Each request submits its rows and blocks until they are committed. The first
+request to arrive becomes the leader: it waits ``window`` seconds for others
+to queue up, then writes everything queued in one call to ``flush`` and wakes
+the followers with their own results. If more rows arrived meanwhile, the
+oldest waiting request takes over as leader, so batches commit strictly in
+arrival order and no request flushes on behalf of others indefinitely.
+
+Under eventlet without monkey-patching nothing can queue behind a sleeping
+leader, so every request simply commits its own rows.
+"""
+import time
+import threading
+
+
+class _Waiter:
+    __slots__ = ('rows', 'done', 'lead', 'result', 'error')
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.done = threading.Event()
+        self.lead = False
+        self.result = None
+        self.error = None
+
+
+class GroupCommitter:
+    """``flush(list_of_row_lists)`` writes and commits, returning one result per row list."""
+
+    def __init__(self, flush, window=0.005, max_rows=500):
+        self.flush = flush
+        self.window = window
+        self.max_rows = max_rows
+        self._queue = []
+        self._leading = False
+        self._lock = threading.Lock()
+
+    def submit(self, rows):
+        """Queue ``rows`` and return their result once committed (re-raises flush errors)"""
+        waiter = _Waiter(rows)
+        with self._lock:
+            self._queue.append(waiter)
+            lead = not self._leading
+            self._leading = True
+
+        if lead:
+            time.sleep(self.window)
+            self._flush_queued()
+        else:
+            waiter.done.wait()
+            if waiter.lead:
+                # Handed leadership - our rows are at the head of the queue
+                waiter.done.clear()
+                self._flush_queued()
+
+        if waiter.error is not None:
+            raise waiter.error
+        return waiter.result
+
+    def _take_batch(self):
+        with self._lock:
+            size = 0
+            count = 0
+            for waiter in self._queue:
+                if count and size + len(waiter.rows) > self.max_rows:
+                    break
+                size += len(waiter.rows)
+                count += 1
+            batch, self._queue = self._queue[:count], self._queue[count:]
+            return batch
+
+    def _flush_queued(self):
+        batch = self._take_batch()
+        try:
+            results = self.flush([waiter.rows for waiter in batch])
+        except Exception as e:
+            for waiter in batch:
+                waiter.error = e
+        else:
+            for waiter, result in zip(batch, results):
+                waiter.result = result
+        finally:
+            for waiter in batch:
+                waiter.done.set()
+            with self._lock:
+                if self._queue:
+                    successor = self._queue[0]
+                    successor.lead = True
+                    successor.done.set()
+                else:
+                    self._leading = False
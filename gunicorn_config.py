@@ -2,6 +2,8 @@
 # Optimized for 100+ concurrent users with WebSocket support
 
 import os
+import sys
+import importlib
 import multiprocessing
 
 # Server socket
@@ -14,6 +16,27 @@ workers = int(os.environ.get('GUNICORN_WORKERS', 4))
 worker_class = 'eventlet'
 worker_connections = 1000  # Each eventlet worker can handle 1000 concurrent connections
 
+# Load the application once in the master and fork workers from it: imports
+# are shared copy-on-write and a worker recycled by max_requests starts
+# without re-importing Flask, SQLAlchemy and friends.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+# With preload_app the app is imported in the master, before the eventlet
+# worker gets to monkey-patch. Patch first so sockets and locks created at
+# import time are green in every worker.
+if worker_class == 'eventlet' and preload_app:
+    import eventlet
+    eventlet.monkey_patch()
+
+# Lazily imported by request handlers; warmed in the master when preloading
+PRELOAD_MODULES = (
+    'openai',
+    'PIL.Image',
+    'PIL.ImageOps',
+    'markdown.extensions.codehilite',
+    'pygments.formatters.html',
+)
+
 # Timeouts
 timeout = 120  # Longer timeout for file uploads and OnlyOffice operations
 graceful_timeout = 30
@@ -47,7 +70,12 @@ tmp_upload_dir = None
 # Hooks for application lifecycle
 def on_starting(server):
     """Called just before the master process is initialized."""
-    pass
+    # Create tables and upload folders once here instead of in every worker.
+    # Only when preloading: otherwise the master must not import the app,
+    # and `flask --app app init-db` (run by deploy.sh) does this instead.
+    if server.cfg.preload_app:
+        from app import app, init_db
+        init_db(app)
 
 def on_reload(server):
     """Called to recycle workers during a reload via SIGHUP."""
@@ -61,17 +89,33 @@ def worker_abort(worker):
     """Called when a worker receives SIGABRT."""
     pass
 
+def when_ready(server):
+    """Called just after the server is started."""
+    if server.cfg.preload_app:
+        for module in PRELOAD_MODULES:
+            try:
+                importlib.import_module(module)
+            except ImportError:
+                pass
+
 def pre_fork(server, worker):
     """Called just before a worker is forked."""
     pass
 
 def post_fork(server, worker):
     """Called just after a worker has been forked."""
-    pass
+    # Never share pooled DB sockets inherited from the master
+    teamwork = sys.modules.get('app')
+    if teamwork is not None and hasattr(teamwork, 'dispose_db_pools'):
+        teamwork.dispose_db_pools(teamwork.app)
 
 def post_worker_init(worker):
     """Called just after a worker has initialized the application."""
-    pass
+    # Periodic jobs (chat archiving) run in every worker; a file lock lets
+    # only one of them do the work at a time
+    teamwork = sys.modules.get('app')
+    if teamwork is not None and hasattr(teamwork, 'start_background_jobs'):
+        teamwork.start_background_jobs(teamwork.app)
 
 def worker_exit(server, worker):
     """Called just after a worker has been exited."""
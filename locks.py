@@ -0,0 +1,58 @@
+"""Cross-process locks for serializing writes between gunicorn workers.
+
+Uses flock(2) on a per-resource lock file, so it works across all workers
+on one host. Acquisition polls with LOCK_NB and a (green) sleep instead of
+blocking in the kernel, which would stall every greenlet on an eventlet
+worker.
+"""
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows - fall back to an in-process lock
+    fcntl = None
+
+_local_locks = {}
+_local_locks_guard = threading.Lock()
+
+
+class LockTimeout(Exception):
+    """The lock could not be acquired within the timeout."""
+
+
+@contextmanager
+def file_lock(path, timeout=30.0, poll_interval=0.01, max_poll_interval=0.2):
+    """Hold an exclusive lock on ``path`` (created if missing) for the block."""
+    if fcntl is None:
+        with _local_locks_guard:
+            lock = _local_locks.setdefault(path, threading.Lock())
+        if not lock.acquire(timeout=timeout):
+            raise LockTimeout(f"timed out waiting for {path}")
+        try:
+            yield
+        finally:
+            lock.release()
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise LockTimeout(f"timed out waiting for {path}")
+                time.sleep(poll_interval)
+                poll_interval = min(poll_interval * 2, max_poll_interval)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
@@ -0,0 +1,77 @@
+"""Map-reduce summarization for card sets too large for one prompt.
+
+Cards are packed into chunks of at most ``chunk_tokens`` (estimated) tokens;
+oversized cards are split first. Each chunk is summarized on its own, with
+at most ``parallelism`` completions in flight, then the partial summaries are
+summarized together. If the partial summaries themselves don't fit in one
+chunk they are reduced in rounds until they do.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from ai_context import estimate_tokens, split_passages
+
+SUMMARY_INSTRUCTION = "请将以下内容总结成一份文档，保持结构清晰、内容完整。"
+MAP_INSTRUCTION = "请总结以下卡片内容，保留关键事实、结论和待办事项。"
+REDUCE_INSTRUCTION = "以下是同一批卡片的分段摘要，请合并成一份结构清晰、内容完整的总结文档。"
+MAX_REDUCE_ROUNDS = 4  # Then the last round's groups are joined as they are
+
+
+def chunk_texts(texts, chunk_tokens):
+    """Pack ``texts`` in order into chunks of about ``chunk_tokens`` tokens each"""
+    pieces = []
+    for text in texts:
+        pieces += [p.text for p in split_passages(None, None, '', text, chunk_tokens)]
+    chunks = []
+    current = []
+    size = 0
+    for piece in pieces:
+        tokens = estimate_tokens(piece)
+        if current and size + tokens > chunk_tokens:
+            chunks.append('\n\n'.join(current))
+            current, size = [], 0
+        current.append(piece)
+        size += tokens
+    if current:
+        chunks.append('\n\n'.join(current))
+    return chunks
+
+
+def summarize(complete, texts, chunk_tokens, parallelism=4, progress=None):
+    """Summary of ``texts`` (one per card) using ``complete(instruction, content)``.
+
+    ``progress(done, total, stage)`` is called after every completion; the
+    total grows if the partial summaries need more than one reduce round.
+    """
+    chunks = chunk_texts(texts, chunk_tokens)
+    state = {'done': 0, 'total': len(chunks) + 1}
+
+    def step(stage):
+        state['done'] += 1
+        if progress:
+            progress(state['done'], state['total'], stage)
+
+    if len(chunks) == 1:
+        state['total'] = 1
+        summary = complete(SUMMARY_INSTRUCTION, chunks[0])
+        step('reduce')
+        return summary
+
+    with ThreadPoolExecutor(max_workers=max(1, parallelism)) as pool:
+        def run_all(instruction, items, stage):
+            # Up to ``parallelism`` calls in flight; results keep card order
+            futures = [pool.submit(complete, instruction, item) for item in items]
+            for future in as_completed(futures):
+                future.result()
+                step(stage)
+            return [future.result() for future in futures]
+
+        groups = chunk_texts(run_all(MAP_INSTRUCTION, chunks, 'map'), chunk_tokens)
+        for _ in range(MAX_REDUCE_ROUNDS):
+            if len(groups) == 1:
+                break
+            state['total'] += len(groups)
+            groups = chunk_texts(run_all(REDUCE_INSTRUCTION, groups, 'reduce'), chunk_tokens)
+
+    summary = complete(REDUCE_INSTRUCTION, '\n\n'.join(groups))
+    step('reduce')
+    return summary
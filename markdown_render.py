@@ -0,0 +1,58 @@
+"""Sanitized Markdown rendering with reused parsers and a result cache.
+
+Building a ``markdown.Markdown`` (with its extensions) and a bleach
+``Cleaner`` costs more than rendering a typical card. Neither is safe to use
+from two requests at once, so idle pairs wait in a small pool: a render
+borrows one, resets the parser and returns it, and only builds a new pair
+when every pooled one is busy. A pool rather than a thread-local, because
+eventlet makes thread-locals per greenlet, i.e. per request. Rendered HTML
+is cached by SHA-256 of the source, so the same card text is only rendered
+once per worker.
+"""
+import hashlib
+import threading
+
+import markdown
+from bleach.sanitizer import Cleaner
+
+from cache import LRUCache
+
+EXTENSIONS = ['tables', 'fenced_code', 'codehilite']
+ALLOWED_TAGS = ['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'br', 'hr',
+                'strong', 'em', 'a', 'ul', 'ol', 'li', 'code', 'pre',
+                'blockquote', 'table', 'thead', 'tbody', 'tr', 'th', 'td',
+                'img', 'span', 'div']
+ALLOWED_ATTRS = {'a': ['href', 'title'], 'img': ['src', 'alt'], '*': ['class']}
+
+
+class MarkdownRenderer:
+    def __init__(self, cache_size=2048, pool_size=8):
+        self.cache = LRUCache(maxsize=cache_size)
+        self.pool_size = pool_size
+        self._idle = []  # (parser, cleaner) pairs not in use
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return markdown.Markdown(extensions=EXTENSIONS), Cleaner(tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRS)
+
+    def _release(self, tools):
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(tools)
+
+    def render(self, content):
+        content = content or ''
+        key = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        html = self.cache.get(key)
+        if html is None:
+            parser, cleaner = tools = self._acquire()
+            try:
+                html = cleaner.clean(parser.convert(content))
+            finally:
+                parser.reset()
+                self._release(tools)
+            self.cache.set(key, html)
+        return html
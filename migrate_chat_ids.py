@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+import re
+import sqlite3
+import os
+
+db_path = os.path.join(os.path.dirname(__file__), 'instance', 'teamwork.db')
+print(f"Database path: {db_path}")
+
+if not os.path.exists(db_path):
+    print("ERROR: Database file not found!")
+    exit(1)
+
+conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+c = conn.cursor()
+
+c.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'chat_messages'")
+row = c.fetchone()
+if not row:
+    print("chat_messages table does not exist yet, nothing to migrate")
+    conn.close()
+    exit(0)
+
+# Without AUTOINCREMENT sqlite reuses the ids of deleted rows, and archiving
+# deletes the oldest messages - which can be all of them. Archived messages
+# and the search index are keyed by id, so ids must never come back.
+table_sql = row[0]
+if 'AUTOINCREMENT' in table_sql.upper():
+    print("chat_messages ids already never reused")
+else:
+    print("Rebuilding chat_messages with AUTOINCREMENT ids...")
+    new_sql = re.sub(r'\bid INTEGER NOT NULL,', 'id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,', table_sql, count=1)
+    new_sql = re.sub(r'\s*PRIMARY KEY \(id\),', '', new_sql, count=1)
+    new_sql = new_sql.replace('CREATE TABLE chat_messages', 'CREATE TABLE chat_messages_new', 1)
+    c.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'chat_messages' AND sql IS NOT NULL")
+    index_sql = [r[0] for r in c.fetchall()]
+
+    c.execute("BEGIN")
+    c.execute(new_sql)
+    c.execute("INSERT INTO chat_messages_new SELECT * FROM chat_messages")
+    c.execute("DROP TABLE chat_messages")
+    c.execute("ALTER TABLE chat_messages_new RENAME TO chat_messages")
+    for sql in index_sql:
+        c.execute(sql)
+    c.execute("COMMIT")
+    print(f"SUCCESS: chat_messages rebuilt ({len(index_sql)} indexes restored)")
+
+# Start new ids above every id handed out so far, including archived ones
+c.execute("SELECT MAX(id) FROM chat_messages")
+high = c.fetchone()[0] or 0
+c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'chat_archive_segments'")
+if c.fetchone():
+    c.execute("SELECT MAX(last_id) FROM chat_archive_segments")
+    high = max(high, c.fetchone()[0] or 0)
+c.execute("SELECT seq FROM sqlite_sequence WHERE name = 'chat_messages'")
+current = c.fetchone()
+if current is None:
+    c.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('chat_messages', ?)", (high,))
+elif current[0] < high:
+    c.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'chat_messages'", (high,))
+print(f"Next chat message id: {max(high, current[0] if current else 0) + 1}")
+
+conn.close()
+print("Done!")
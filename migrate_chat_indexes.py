@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+import sqlite3
+import os
+
+db_path = os.path.join(os.path.dirname(__file__), 'instance', 'teamwork.db')
+print(f"Database path: {db_path}")
+
+if not os.path.exists(db_path):
+    print("ERROR: Database file not found!")
+    exit(1)
+
+conn = sqlite3.connect(db_path, timeout=30)
+c = conn.cursor()
+
+# Indexes declared on ChatMessage; db.create_all() only adds them to new tables
+INDEXES = [
+    ('ix_chat_messages_file_path', 'chat_messages (file_path)'),
+    ('ix_chat_messages_project_created', 'chat_messages (project_id, created_at, id)'),
+]
+
+for name, target in INDEXES:
+    c.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+    print(f"Index {name} in place")
+
+conn.commit()
+conn.close()
+print("Done!")
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+import sqlite3
+import os
+
+db_path = os.path.join(os.path.dirname(__file__), 'instance', 'teamwork.db')
+print(f"Database path: {db_path}")
+
+if not os.path.exists(db_path):
+    print("ERROR: Database file not found!")
+    exit(1)
+
+conn = sqlite3.connect(db_path, timeout=30)
+c = conn.cursor()
+
+# Check current columns
+c.execute("PRAGMA table_info(attachments)")
+columns = [x[1] for x in c.fetchall()]
+print(f"Current columns: {columns}")
+
+if 'content_hash' not in columns:
+    print("Adding content_hash column...")
+    c.execute('ALTER TABLE attachments ADD COLUMN content_hash VARCHAR(64)')
+    conn.commit()
+    print("SUCCESS: content_hash column added!")
+    print("Existing attachments are hashed lazily on their next save.")
+else:
+    print("content_hash column already exists")
+
+conn.close()
+print("Done!")
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+import sqlite3
+import os
+
+db_path = os.path.join(os.path.dirname(__file__), 'instance', 'teamwork.db')
+print(f"Database path: {db_path}")
+
+if not os.path.exists(db_path):
+    print("ERROR: Database file not found!")
+    exit(1)
+
+conn = sqlite3.connect(db_path, timeout=30)
+c = conn.cursor()
+
+c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'file_versions'")
+if not c.fetchone():
+    print("file_versions table does not exist yet, nothing to migrate")
+    conn.close()
+    exit(0)
+
+# Concurrent saves may already have produced duplicate version numbers.
+# Keep the oldest row of each duplicate and move the rest to the end.
+c.execute("""
+    SELECT attachment_id, version_number FROM file_versions
+    GROUP BY attachment_id, version_number HAVING COUNT(*) > 1
+""")
+duplicates = c.fetchall()
+print(f"Duplicate version numbers found: {len(duplicates)}")
+
+for attachment_id, version_number in duplicates:
+    c.execute("""
+        SELECT id FROM file_versions WHERE attachment_id = ? AND version_number = ?
+        ORDER BY created_at, id
+    """, (attachment_id, version_number))
+    extra_ids = [row[0] for row in c.fetchall()[1:]]
+    for version_id in extra_ids:
+        c.execute("SELECT MAX(version_number) FROM file_versions WHERE attachment_id = ?", (attachment_id,))
+        next_number = (c.fetchone()[0] or 0) + 1
+        c.execute("UPDATE file_versions SET version_number = ? WHERE id = ?", (next_number, version_id))
+        print(f"Renumbered version row {version_id} of attachment {attachment_id} to {next_number}")
+
+c.execute("""
+    CREATE UNIQUE INDEX IF NOT EXISTS _attachment_version_uc
+    ON file_versions (attachment_id, version_number)
+""")
+conn.commit()
+print("SUCCESS: unique (attachment_id, version_number) index in place!")
+
+conn.close()
+print("Done!")
@@ -2,8 +2,16 @@ from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 
+from cache import LRUCache
+
 db = SQLAlchemy()
 
+# Serialized users shared by chat messages, project members and card assignees.
+# Per worker: entries are dropped when a user row changes in this process and
+# expire after the TTL so changes made in other workers show up too.
+# create_app() applies USER_CACHE_SIZE / USER_CACHE_TTL.
+user_dict_cache = LRUCache(maxsize=4096, ttl=300)
+
 # Association tables
 project_members = db.Table('project_members',
     db.Column('project_id', db.Integer, db.ForeignKey('projects.id'), primary_key=True),
@@ -44,13 +52,36 @@ class User(db.Model):
         return check_password_hash(self.password_hash, password)
     
     def to_dict(self):
-        return {
-            'id': self.id,
-            'username': self.username,
-            'email': self.email,
-            'avatar_color': self.avatar_color,
-            'created_at': self.created_at.isoformat()
-        }
+        data = user_dict_cache.get(self.id)
+        if data is None:
+            data = {
+                'id': self.id,
+                'username': self.username,
+                'email': self.email,
+                'avatar_color': self.avatar_color,
+                'created_at': self.created_at.isoformat()
+            }
+            user_dict_cache.set(self.id, data)
+        return dict(data)
+    
+    @staticmethod
+    def cached_dict(user_id):
+        """Serialized user from the cache, or None - never touches the database"""
+        data = user_dict_cache.get(user_id)
+        return dict(data) if data is not None else None
+    
+    @staticmethod
+    def prime_cache(user_ids):
+        """Load every uncached user in ``user_ids`` with a single query"""
+        missing = [uid for uid in set(user_ids) if uid is not None and user_dict_cache.get(uid) is None]
+        if missing:
+            for user in User.query.filter(User.id.in_(missing)).all():
+                user.to_dict()
+
+@db.event.listens_for(User, 'after_update')
+@db.event.listens_for(User, 'after_delete')
+def _invalidate_user_dict(mapper, connection, target):
+    user_dict_cache.pop(target.id)
 
 class Project(db.Model):
     __tablename__ = 'projects'
@@ -60,6 +91,7 @@ class Project(db.Model):
     description = db.Column(db.Text)
     columns = db.Column(db.JSON, default=['待办', '进行中', '已完成'])
     owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    revision = db.Column(db.Integer, nullable=False, default=0)  # Bumped by every board change
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -78,6 +110,7 @@ class Project(db.Model):
             'owner': self.owner.to_dict() if self.owner else None,
             'columns': self.columns or ['待办', '进行中', '已完成'],
             'members': [m.to_dict() for m in self.members],
+            'revision': self.revision,
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat()
         }
@@ -162,7 +195,9 @@ class Attachment(db.Model):
     original_filename = db.Column(db.String(300), nullable=False)
     file_type = db.Column(db.String(50))
     file_size = db.Column(db.Integer)
+    content_hash = db.Column(db.String(64), nullable=True)  # SHA-256 of the stored file
     content = db.Column(db.Text, nullable=True)  # Extracted text content for search
+    extraction_error = db.Column(db.String(300), nullable=True)  # Why search extraction failed, if it did
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     def to_dict(self):
@@ -173,17 +208,24 @@ class Attachment(db.Model):
             'original_filename': self.original_filename,
             'file_type': self.file_type,
             'file_size': self.file_size,
+            'extraction_error': self.extraction_error,
             'uploaded_at': self.uploaded_at.isoformat()
         }
 
 class ChatMessage(db.Model):
     __tablename__ = 'chat_messages'
+    __table_args__ = (
+        # Serves keyset pagination of a project's history and unread counts
+        db.Index('ix_chat_messages_project_created', 'project_id', 'created_at', 'id'),
+        # Archived messages and the search index are keyed by id - never reuse one
+        {'sqlite_autoincrement': True},
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     project_id = db.Column(db.Integer, db.ForeignKey('projects.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     content = db.Column(db.Text)
-    file_path = db.Column(db.String(500), nullable=True)
+    file_path = db.Column(db.String(500), nullable=True, index=True)  # Looked up by chat file editors
     file_name = db.Column(db.String(300), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
@@ -192,13 +234,44 @@ class ChatMessage(db.Model):
             'id': self.id,
             'project_id': self.project_id,
             'user_id': self.user_id,
-            'user': self.author.to_dict() if self.author else None,
+            'user': User.cached_dict(self.user_id) or (self.author.to_dict() if self.author else None),
             'content': self.content,
             'file_path': self.file_path,
             'file_name': self.file_name,
             'created_at': self.created_at.isoformat()
         }
 
+class ChatArchiveSegment(db.Model):
+    """One compressed month of a project's archived chat (see chat_archive.py)"""
+    __tablename__ = 'chat_archive_segments'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, nullable=False, index=True)  # Removed by delete_project along with the files
+    month = db.Column(db.String(7), nullable=False)  # YYYY-MM
+    message_count = db.Column(db.Integer, default=0)
+    first_id = db.Column(db.Integer)
+    last_id = db.Column(db.Integer)
+    first_at = db.Column(db.DateTime)
+    last_at = db.Column(db.DateTime)
+    
+    __table_args__ = (db.UniqueConstraint('project_id', 'month', name='_project_month_uc'),)
+
+class PresenceSocket(db.Model):
+    """A socket in a project room, shared by all workers (see presence.py)"""
+    __tablename__ = 'presence_sockets'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    room = db.Column(db.String(64), nullable=False)
+    sid = db.Column(db.String(64), nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    worker = db.Column(db.String(128), nullable=False, index=True)  # Process holding the socket
+    seen_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)  # Refreshed by its worker's heartbeat
+    
+    __table_args__ = (
+        db.UniqueConstraint('room', 'sid', name='_room_sid_uc'),
+        db.Index('ix_presence_sockets_room_user', 'room', 'user_id'),
+    )
+
 class FileVersion(db.Model):
     """Track version history for file attachments with OnlyOffice integration"""
     __tablename__ = 'file_versions'
@@ -216,6 +289,8 @@ class FileVersion(db.Model):
     attachment = db.relationship('Attachment', backref=db.backref('versions', lazy='dynamic', cascade='all, delete-orphan'))
     edited_by = db.relationship('User', backref='file_edits')
     
+    __table_args__ = (db.UniqueConstraint('attachment_id', 'version_number', name='_attachment_version_uc'),)
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -227,3 +302,63 @@ class FileVersion(db.Model):
             'created_at': self.created_at.isoformat()
         }
 
+
+class OnlyOfficeCallback(db.Model):
+    """OnlyOffice save callbacks already processed, so retried deliveries are not saved twice"""
+    __tablename__ = 'onlyoffice_callbacks'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    dedupe_key = db.Column(db.String(64), unique=True, nullable=False)  # SHA-256 of (key, status, url)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class AIResponseCache(db.Model):
+    """Stored AI answers and summaries, keyed by model, prompt and exact context (see ai_cache.py)"""
+    __tablename__ = 'ai_response_cache'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    cache_key = db.Column(db.String(64), unique=True, nullable=False)  # SHA-256 of (kind, model, prompt, context)
+    kind = db.Column(db.String(20), nullable=False)  # 'ask' or 'summarize'
+    model = db.Column(db.String(100))
+    response = db.Column(db.Text, nullable=False)
+    hits = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # Eviction order
+
+class AICacheStat(db.Model):
+    """Hit/miss counters of the AI response cache, shared by all workers"""
+    __tablename__ = 'ai_cache_stats'
+    
+    kind = db.Column(db.String(20), primary_key=True)
+    hits = db.Column(db.Integer, default=0, nullable=False)
+    misses = db.Column(db.Integer, default=0, nullable=False)
+
+class AIJob(db.Model):
+    """Long-running AI work (map-reduce summaries) with progress, polled via /api/ai/jobs/<id>"""
+    __tablename__ = 'ai_jobs'
+    
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex
+    project_id = db.Column(db.Integer, db.ForeignKey('projects.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # 'summarize'
+    status = db.Column(db.String(20), default='queued')  # queued, running, done, failed
+    stage = db.Column(db.String(20))  # map or reduce while running
+    progress_done = db.Column(db.Integer, default=0)
+    progress_total = db.Column(db.Integer, default=0)
+    result = db.Column(db.Text)
+    error = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'project_id': self.project_id,
+            'kind': self.kind,
+            'status': self.status,
+            'stage': self.stage,
+            'progress': {'done': self.progress_done or 0, 'total': self.progress_total or 0},
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'updated_at': self.updated_at.isoformat()
+        }
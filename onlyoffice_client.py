@@ -0,0 +1,245 @@
+"""HTTP client for the OnlyOffice Document Server.
+
+One client per app holds a pooled keep-alive ``requests.Session`` (created
+lazily per process, so forked workers never share sockets), retries
+transient failures with jittered exponential backoff, and trips a circuit
+breaker after repeated failures so a down Document Server fails fast instead
+of making every request wait out its timeout.
+"""
+import os
+import time
+import random
+import threading
+
+import jwt as pyjwt
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class OnlyOfficeUnavailable(Exception):
+    """Raised when the circuit breaker is open or retries are exhausted."""
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: closed -> open -> half-open -> closed.
+
+    Half-open admits a single trial call; everyone else is rejected until it
+    reports back. A probe that never reports (its caller died) is given up
+    after another ``reset_timeout``.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probe_started = None
+        self._lock = threading.Lock()
+
+    def _state(self, now):
+        if self._opened_at is None:
+            return 'closed'
+        if now - self._opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state(time.monotonic())
+
+    def allow(self):
+        """True if a call may go through; in half-open only for the one trial probe.
+
+        Every admitted call must end in record_success() or record_failure().
+        """
+        now = time.monotonic()
+        with self._lock:
+            state = self._state(now)
+            if state == 'closed':
+                return True
+            if state == 'open':
+                return False
+            if self._probe_started is not None and now - self._probe_started < self.reset_timeout:
+                return False
+            self._probe_started = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_started = None
+            if self._failures >= self.threshold:
+                # (Re-)open; in half-open a single failed probe re-arms the timer
+                self._opened_at = time.monotonic()
+
+
+class OnlyOfficeClient:
+    COMMAND_PATH = '/coauthoring/CommandService.ashx'
+
+    def __init__(self, base_url, jwt_secret=None, timeout=5, download_timeout=60,
+                 retries=2, backoff=0.2, pool_size=10,
+                 breaker_threshold=5, breaker_reset=30.0):
+        self.base_url = base_url.rstrip('/')
+        self.jwt_secret = jwt_secret
+        self.timeout = timeout
+        self.download_timeout = download_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+        self._session = None
+        self._session_pid = None
+        self._session_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config.get('ONLYOFFICE_URL', 'http://localhost:8080'),
+            jwt_secret=config.get('ONLYOFFICE_JWT_SECRET'),
+            timeout=config.get('ONLYOFFICE_TIMEOUT', 5),
+            download_timeout=config.get('ONLYOFFICE_DOWNLOAD_TIMEOUT', 60),
+            retries=config.get('ONLYOFFICE_RETRIES', 2),
+            pool_size=config.get('ONLYOFFICE_POOL_SIZE', 10),
+            breaker_threshold=config.get('ONLYOFFICE_BREAKER_THRESHOLD', 5),
+            breaker_reset=config.get('ONLYOFFICE_BREAKER_RESET', 30),
+        )
+
+    @property
+    def session(self):
+        # Built lazily and per process: a session created in the gunicorn
+        # master must not hand its pooled sockets to forked workers.
+        pid = os.getpid()
+        if self._session is None or self._session_pid != pid:
+            with self._session_lock:
+                if self._session is None or self._session_pid != pid:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+                    self._session_pid = pid
+        return self._session
+
+    def _sleep_before_retry(self, attempt):
+        # Full jitter: spreads retries from many workers over the window
+        time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+    def _request(self, method, url, **kwargs):
+        """Send a request with bounded retries behind the circuit breaker.
+
+        Connection errors, timeouts and 5xx responses are retried; anything
+        else is returned to the caller as-is.
+        """
+        if not self.breaker.allow():
+            raise OnlyOfficeUnavailable('OnlyOffice circuit breaker is open')
+
+        last_error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._sleep_before_retry(attempt - 1)
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                last_error = e
+                continue
+
+            if response.status_code >= 500:
+                last_error = requests.HTTPError(f"{response.status_code} from {url}", response=response)
+                response.close()
+                continue
+
+            self.breaker.record_success()
+            return response
+
+        # One failure per call, however many attempts it took
+        self.breaker.record_failure()
+        raise OnlyOfficeUnavailable(str(last_error))
+
+    def command(self, c, **params):
+        """Call the Command Service; returns the decoded JSON reply."""
+        payload = {'c': c, **params}
+        if self.jwt_secret:
+            payload['token'] = pyjwt.encode(dict(payload), self.jwt_secret, algorithm='HS256')
+        response = self._request('POST', self.base_url + self.COMMAND_PATH,
+                                 json=payload, timeout=self.timeout)
+        try:
+            return response.json()
+        finally:
+            response.close()
+
+    def drop(self, key):
+        """Ask the Document Server to drop its cached copy of a document key."""
+        try:
+            reply = self.command('drop', key=key)
+        except (OnlyOfficeUnavailable, ValueError) as e:
+            print(f"Failed to drop OnlyOffice cache for key {key}: {e}")
+            return False
+        # error 1 means the key isn't open anywhere - nothing cached to drop
+        return reply.get('error') in (0, 1)
+
+    def drop_many(self, keys):
+        """Drop several document keys over the pooled connection.
+
+        Stops early once the breaker opens instead of timing out on each key.
+        Returns a {key: dropped} dict.
+        """
+        results = {}
+        for key in dict.fromkeys(keys):
+            if self.breaker.state == 'open':
+                results[key] = False
+                continue
+            results[key] = self.drop(key)
+        return results
+
+    def download(self, url):
+        """Open a streaming GET for a document URL handed out by the Document Server.
+
+        The caller must close the returned response (use it as a context manager).
+        """
+        response = self._request('GET', url, stream=True,
+                                 timeout=(self.timeout, self.download_timeout))
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            response.close()
+            raise
+        return response
+
+
+class DropBatcher:
+    """Coalesce drop commands issued in quick succession into one flush.
+
+    ``spawn`` starts a background task (e.g. ``socketio.start_background_task``);
+    keys queued within ``delay`` seconds are deduplicated and sent together.
+    """
+
+    def __init__(self, client, spawn, delay=0.5):
+        self.client = client
+        self.spawn = spawn
+        self.delay = delay
+        self._keys = []
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def queue(self, key):
+        with self._lock:
+            self._keys.append(key)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self.spawn(self._flush_later)
+
+    def _flush_later(self):
+        time.sleep(self.delay)
+        with self._lock:
+            keys, self._keys = self._keys, []
+            self._scheduled = False
+        if keys:
+            self.client.drop_many(keys)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""Minimal stand-in for the OnlyOffice Document Server, for tests and local runs.
+
+Implements just what TeamWork talks to: the Command Service endpoint and
+plain file downloads (the ``url`` OnlyOffice puts in save callbacks), and
+can play the other direction too by POSTing status callbacks to the app.
+Failures can be injected to exercise retries and the circuit breaker.
+
+    stub = OnlyOfficeStub().start()
+    stub.add_file('doc.docx', b'...')          # -> stub.url + '/files/doc.docx'
+    stub.fail_next(3)                           # next 3 requests answer 503
+    client = OnlyOfficeClient(stub.url)
+    stub.send_callback(app_url + '/api/onlyoffice/callback', '12_1700000000000',
+                       2, url=stub.file_url('doc.docx'), users=['1'])
+    ...
+    stub.stop()
+
+Run standalone with ``python onlyoffice_stub.py --port 8080``.
+"""
+import json
+import argparse
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real server
+
+    @property
+    def stub(self):
+        return self.server.stub
+
+    def _send(self, status, body=b'', content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _injected_failure(self):
+        status = self.stub._take_failure()
+        if status is None:
+            return False
+        self._send(status, b'{"error": 3}')
+        return True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length)
+        if self._injected_failure():
+            return
+        if self.path != '/coauthoring/CommandService.ashx':
+            self._send(404, b'{}')
+            return
+        try:
+            command = json.loads(raw or b'{}')
+        except ValueError:
+            self._send(200, b'{"error": 5}')
+            return
+        with self.stub._lock:
+            self.stub.commands.append(command)
+        self._send(200, json.dumps({'error': 0, 'key': command.get('key')}).encode())
+
+    def do_GET(self):
+        if self._injected_failure():
+            return
+        if self.path == '/healthcheck':
+            self._send(200, b'true', 'text/plain')
+            return
+        name = self.path[len('/files/'):] if self.path.startswith('/files/') else None
+        body = self.stub.files.get(name)
+        if body is None:
+            self._send(404, b'{}')
+            return
+        self._send(200, body, 'application/octet-stream')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class OnlyOfficeStub:
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.files = {}
+        self.commands = []
+        self._failures = []
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self._server.server_address[1]}"
+
+    def file_url(self, name):
+        return f"{self.url}/files/{name}"
+
+    def add_file(self, name, data):
+        self.files[name] = data
+        return self.file_url(name)
+
+    def remove_file(self, name):
+        self.files.pop(name, None)
+
+    def send_callback(self, callback_url, key, status, url=None, users=None, timeout=60):
+        """POST a save-status callback the way the Document Server does.
+
+        Returns ``(http_status, reply_dict)``; the reply is ``{}`` if it isn't JSON.
+        """
+        payload = {'key': key, 'status': status, 'users': users or []}
+        if url:
+            payload['url'] = url
+        req = urllib.request.Request(callback_url, data=json.dumps(payload).encode(),
+                                     headers={'Content-Type': 'application/json'},
+                                     method='POST')
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as response:
+                code, body = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            code, body = e.code, e.read()
+        try:
+            return code, json.loads(body or b'{}')
+        except ValueError:
+            return code, {}
+
+    def fail_next(self, count=1, status=503):
+        """Answer the next ``count`` requests with ``status`` instead of serving them."""
+        with self._lock:
+            self._failures.extend([status] * count)
+
+    def _take_failure(self):
+        with self._lock:
+            return self._failures.pop(0) if self._failures else None
+
+    def start(self):
+        self._server = ThreadingHTTPServer((self.host, self.port), _StubHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local OnlyOffice Document Server stub')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    stub = OnlyOfficeStub(args.host, args.port).start()
+    print(f"OnlyOffice stub listening on {stub.url}")
+    try:
+        stub._thread.join()
+    except KeyboardInterrupt:
+        stub.stop()
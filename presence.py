@@ -0,0 +1,201 @@
+"""Socket state: authenticated sockets, room presence and typing.
+
+Sockets authenticate once at connect; each keeps its user and a cache of
+membership decisions so joining a room only hits the database the first
+time. Typing notifications are throttled per user and coalesced per room
+into one event per window. Both are per worker: a socket lives in one
+worker, and typing events reach the others through the message queue.
+
+Presence is shared by all workers through the presence_sockets table, so a
+user with tabs on two workers shows up once in every snapshot and goes
+offline only when their last socket anywhere leaves.
+"""
+import os
+import time
+import uuid
+import socket
+import threading
+from datetime import datetime, timedelta
+
+from models import db, User, PresenceSocket
+
+
+class SocketRegistry:
+    """sid -> {'user': {...}, 'projects': {project_id: allowed}}"""
+
+    def __init__(self):
+        self._sockets = {}
+        self._lock = threading.Lock()
+
+    def add(self, sid, user):
+        with self._lock:
+            self._sockets[sid] = {'user': user, 'projects': {}}
+
+    def remove(self, sid):
+        with self._lock:
+            return self._sockets.pop(sid, None)
+
+    def user(self, sid):
+        entry = self._sockets.get(sid)
+        return entry['user'] if entry else None
+
+    def can_access(self, sid, project_id, check):
+        """Cached membership decision; ``check()`` runs on the first ask only"""
+        entry = self._sockets.get(sid)
+        if entry is None:
+            return False
+        allowed = entry['projects'].get(project_id)
+        if allowed is None:
+            allowed = entry['projects'][project_id] = bool(check())
+        return allowed
+
+
+class PresenceRegistry:
+    """Which users are online in which rooms, across workers.
+
+    Each socket in a room is a PresenceSocket row tagged with this process.
+    join/leave write the row and then count the user's live rows in the same
+    transaction, so concurrent workers agree on who came online or went
+    offline. Every worker refreshes its rows in heartbeat(); rows of a worker
+    that died without cleaning up expire after ``ttl`` seconds. This worker's
+    own sockets are also kept in memory for is_present() and rooms_of().
+    """
+
+    def __init__(self, ttl=90):
+        self.ttl = ttl
+        self._local = {}  # sid -> {room: user_id}
+        self._lock = threading.Lock()
+        self._worker = (None, None)
+
+    @property
+    def worker(self):
+        # Random per process, so a restarted worker reusing a pid doesn't
+        # keep its predecessor's rows alive
+        pid, worker = self._worker
+        if pid != os.getpid():
+            pid, worker = self._worker = (os.getpid(), f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}")
+        return worker
+
+    def _live_sockets(self, room, user_id):
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+        return PresenceSocket.query.filter(PresenceSocket.room == room, PresenceSocket.user_id == user_id,
+                                           PresenceSocket.seen_at >= cutoff).count()
+
+    def join(self, room, sid, user):
+        """Add a socket; True if the user just came online in ``room``"""
+        with self._lock:
+            self._local.setdefault(sid, {})[room] = user['id']
+        try:
+            entry = PresenceSocket.query.filter_by(room=room, sid=sid).first()
+            if entry is not None:
+                entry.seen_at = datetime.utcnow()
+                db.session.commit()
+                return False
+            db.session.add(PresenceSocket(room=room, sid=sid, user_id=user['id'], worker=self.worker))
+            db.session.flush()
+            first = self._live_sockets(room, user['id']) == 1
+            db.session.commit()
+            return first
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def leave(self, room, sid, user_id):
+        """Remove a socket; True if that was the user's last one in ``room`` on any worker"""
+        with self._lock:
+            rooms = self._local.get(sid)
+            if not rooms or rooms.get(room) != user_id:
+                return False
+            del rooms[room]
+            if not rooms:
+                del self._local[sid]
+        try:
+            PresenceSocket.query.filter_by(room=room, sid=sid).delete()
+            last = self._live_sockets(room, user_id) == 0
+            db.session.commit()
+            return last
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def rooms_of(self, sid):
+        with self._lock:
+            return list(self._local.get(sid, {}).items())
+
+    def is_present(self, room, sid, user_id):
+        return self._local.get(sid, {}).get(room) == user_id
+
+    def users(self, room):
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+        user_ids = [user_id for (user_id,) in db.session.query(PresenceSocket.user_id).distinct()
+                    .filter(PresenceSocket.room == room, PresenceSocket.seen_at >= cutoff)]
+        User.prime_cache(user_ids)
+        users = []
+        for user_id in user_ids:
+            data = User.cached_dict(user_id)
+            if data is not None:
+                users.append({'id': user_id, 'username': data['username'], 'avatar_color': data['avatar_color']})
+        return users
+
+    def heartbeat(self):
+        """Refresh this worker's rows and drop expired ones; returns (room, user_id) now offline"""
+        now = datetime.utcnow()
+        cutoff = now - timedelta(seconds=self.ttl)
+        try:
+            PresenceSocket.query.filter_by(worker=self.worker).update({'seen_at': now}, synchronize_session=False)
+            expired = db.session.query(PresenceSocket.room, PresenceSocket.user_id)\
+                .filter(PresenceSocket.seen_at < cutoff).distinct().all()
+            PresenceSocket.query.filter(PresenceSocket.seen_at < cutoff).delete(synchronize_session=False)
+            gone = [(room, user_id) for room, user_id in expired if not self._live_sockets(room, user_id)]
+            db.session.commit()
+            return gone
+        except Exception:
+            db.session.rollback()
+            raise
+
+
+class TypingCoalescer:
+    """Forward at most one typing notice per user per ``interval`` seconds,
+    batched per room over ``window`` seconds into one ``user_typing`` event.
+    """
+
+    def __init__(self, emit, spawn, window=0.3, interval=1.5):
+        self.emit = emit
+        self.spawn = spawn
+        self.window = window
+        self.interval = interval
+        self._last = {}      # (room, user_id) -> monotonic time last forwarded
+        self._pending = {}   # room -> {user_id: user}
+        self._pruned_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def typing(self, room, user):
+        now = time.monotonic()
+        key = (room, user['id'])
+        with self._lock:
+            if now - self._pruned_at >= self.interval:
+                # Entries older than the interval no longer throttle anything
+                self._last = {k: t for k, t in self._last.items() if now - t < self.interval}
+                self._pruned_at = now
+            if now - self._last.get(key, float('-inf')) < self.interval:
+                return False
+            self._last[key] = now
+            pending = self._pending.get(room)
+            schedule = pending is None
+            if schedule:
+                pending = self._pending[room] = {}
+            pending[user['id']] = user
+        if schedule:
+            self.spawn(self._flush_later, room)
+        return True
+
+    def forget(self, room, user_id):
+        with self._lock:
+            self._last.pop((room, user_id), None)
+
+    def _flush_later(self, room):
+        time.sleep(self.window)
+        with self._lock:
+            users = self._pending.pop(room, None)
+        if users:
+            self.emit('user_typing', {'users': list(users.values())}, room=room)
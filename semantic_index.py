@@ -0,0 +1,272 @@
+"""Local vector index over card text and extracted attachment text.
+
+Every project has its own directory under ``SEMANTIC_INDEX_FOLDER``:
+
+    <project_id>/vectors-<gen>.f32   float32 rows, memory-mapped (capacity x dim)
+    <project_id>/meta.json           embedder, dim, capacity, the vectors file
+                                     and what each row holds
+
+A row holds one card (title and content) or one attachment (file name and
+extracted text). Writers hold a per-project file lock and then atomically
+replace meta.json; readers map the vectors file meta.json names, read-only,
+and reload when meta.json changes. A row a reader may be scoring is never
+given to another item: deleting zeroes it (a zero row scores 0 and is
+skipped) and new or changed items are appended past the rows meta.json
+lists. Freed rows are reclaimed when the file fills up, by writing the live
+rows to a new file that is swapped in together with meta.json. Vectors are
+L2-normalized, so a matrix-vector product gives cosine similarity.
+
+Embedders are pluggable (see EMBEDDERS); the default hashing embedder works
+offline. An index built by another embedder or dimension is rebuilt. NumPy is
+optional: without it ``available`` is False and callers skip semantic search.
+"""
+import os
+import json
+import math
+import uuid
+import hashlib
+import shutil
+from collections import Counter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from cache import LRUCache
+from chat_search import tokenize
+from locks import file_lock
+from storage import atomic_replace
+
+available = np is not None
+
+KINDS = ('card', 'attachment')
+
+
+class HashingEmbedder:
+    """Signed feature hashing of CJK bigrams, words and the character
+    trigrams of longer latin words.
+
+    The trigrams let inflections and compounds ("deploy", "deployment")
+    land near each other.
+    """
+    name = 'hashing'
+
+    def __init__(self, dim=512):
+        self.dim = dim
+
+    def _features(self, text):
+        features = Counter()
+        for token in tokenize(text):
+            features[token] += 1
+            if len(token) > 4 and token.isascii():
+                padded = f'#{token}#'
+                for i in range(len(padded) - 2):
+                    features['#' + padded[i:i + 3]] += 0.5
+        return features
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, count in self._features(text).items():
+                # Stable across processes, unlike hash()
+                digest = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+                sign = 1.0 if digest & 1 else -1.0
+                vectors[row, (digest >> 1) % self.dim] += sign * (1.0 + math.log(count))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+
+EMBEDDERS = {'hashing': HashingEmbedder}
+
+
+def embedder_from_config(config):
+    return EMBEDDERS[config.get('SEMANTIC_EMBEDDER', 'hashing')](config.get('SEMANTIC_DIM', 512))
+
+
+class SemanticIndex:
+    def __init__(self, folder, embedder, max_chars=20000, initial_capacity=64, lock_timeout=60):
+        self.folder = folder
+        self.embedder = embedder
+        self.max_chars = max_chars
+        self.initial_capacity = initial_capacity
+        self.lock_timeout = lock_timeout
+        # Read-only views, keyed by (project_id, meta.json identity): a write reloads them
+        self._readers = LRUCache(maxsize=64)
+
+    def _dir(self, project_id):
+        return os.path.join(self.folder, str(project_id))
+
+    def _lock(self, project_id):
+        return file_lock(os.path.join(self._dir(project_id), '.lock'), timeout=self.lock_timeout)
+
+    def _read_meta(self, project_id):
+        try:
+            with open(os.path.join(self._dir(project_id), 'meta.json'), encoding='utf-8') as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if (meta.get('embedder') != self.embedder.name or meta.get('dim') != self.embedder.dim
+                or 'vectors' not in meta):
+            return None
+        return meta
+
+    def is_current(self, project_id):
+        """True if the project has an index built by this embedder"""
+        return self._read_meta(project_id) is not None
+
+    def _embed(self, texts):
+        return self.embedder.embed([(text or '')[:self.max_chars] for text in texts])
+
+    def _open(self, project_id, meta, mode):
+        return np.memmap(os.path.join(self._dir(project_id), meta['vectors']), dtype=np.float32,
+                         mode=mode, shape=(meta['capacity'], self.embedder.dim))
+
+    def _write(self, project_id, vectors, entries):
+        """Write ``vectors`` to a new file with room to grow and switch meta.json to it.
+
+        Call with the project lock held. Readers of the old file keep their
+        mapping; the file is unlinked, not truncated.
+        """
+        directory = self._dir(project_id)
+        meta = {
+            'embedder': self.embedder.name,
+            'dim': self.embedder.dim,
+            'capacity': max(self.initial_capacity, 2 * len(entries)),
+            'vectors': f'vectors-{uuid.uuid4().hex}.f32',
+            'entries': entries,
+        }
+        mapped = self._open(project_id, meta, 'w+')
+        if len(vectors):
+            mapped[:len(vectors)] = vectors
+        mapped.flush()
+        del mapped
+        self._write_meta(project_id, meta)
+        for name in os.listdir(directory):
+            if name.startswith('vectors') and name != meta['vectors']:
+                os.remove(os.path.join(directory, name))
+
+    def _write_meta(self, project_id, meta):
+        with atomic_replace(os.path.join(self._dir(project_id), 'meta.json')) as tmp_path:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+
+    def build(self, project_id, items):
+        """Replace the project's index with ``items`` of (kind, id, card_id, text)"""
+        os.makedirs(self._dir(project_id), exist_ok=True)
+        with self._lock(project_id):
+            self._build(project_id, items)
+
+    def _build(self, project_id, items):
+        vectors = self._embed([item[3] for item in items]) if items else []
+        self._write(project_id, vectors, [[kind, item_id, card_id] for kind, item_id, card_id, _ in items])
+
+    def ensure(self, project_id, load_items):
+        """Build the index from ``load_items()`` unless it is current.
+
+        Single-flight: concurrent callers in any worker wait for the one build.
+        """
+        if self.is_current(project_id):
+            return
+        os.makedirs(self._dir(project_id), exist_ok=True)
+        with self._lock(project_id):
+            if not self.is_current(project_id):
+                self._build(project_id, load_items())
+
+    def apply(self, project_id, upserts=(), deletes=(), deleted_cards=()):
+        """Incremental update; a project without a current index is left for a lazy rebuild.
+
+        ``upserts`` are (kind, id, card_id, text), ``deletes`` (kind, id);
+        ``deleted_cards`` also drops each card's attachments.
+        """
+        if not os.path.isdir(self._dir(project_id)):
+            return False
+        # Taken even to find out the index isn't current: a build in progress
+        # may have loaded the database before this change was committed
+        with self._lock(project_id):
+            meta = self._read_meta(project_id)
+            if meta is None:
+                return False
+            entries = meta['entries']
+            rows = {(e[0], e[1]): i for i, e in enumerate(entries) if e}
+
+            deleted_cards = set(deleted_cards)
+            gone = {tuple(key) for key in deletes}
+            gone.update(key for key, i in rows.items() if entries[i][2] in deleted_cards)
+            # A changed item moves to a new row rather than being rewritten in place
+            gone.update((kind, item_id) for kind, item_id, _, _ in upserts)
+            freed = [rows[key] for key in gone if key in rows]
+            for row in freed:
+                entries[row] = None
+            added = [[kind, item_id, card_id] for kind, item_id, card_id, _ in upserts]
+            embedded = self._embed([u[3] for u in upserts]) if upserts else None
+
+            if len(entries) + len(added) <= meta['capacity']:
+                vectors = self._open(project_id, meta, 'r+')
+                for row in freed:
+                    vectors[row] = 0
+                if added:
+                    vectors[len(entries):len(entries) + len(added)] = embedded
+                vectors.flush()
+                del vectors
+                entries.extend(added)
+                self._write_meta(project_id, meta)
+            else:
+                # Full: copy the live rows and the new ones into a fresh file
+                old = self._open(project_id, meta, 'r')
+                live = [i for i, entry in enumerate(entries) if entry]
+                vectors = np.concatenate([old[live], embedded]) if added else np.array(old[live])
+                del old
+                self._write(project_id, vectors, [entries[i] for i in live] + added)
+        return True
+
+    def _reader(self, project_id):
+        meta_path = os.path.join(self._dir(project_id), 'meta.json')
+        for _ in range(3):
+            try:
+                stat = os.stat(meta_path)
+            except FileNotFoundError:
+                return None
+            # A new inode per write (atomic replace), so this changes on every write
+            key = (project_id, stat.st_ino, stat.st_mtime_ns)
+            reader = self._readers.get(key)
+            if reader is not None:
+                return reader
+            meta = self._read_meta(project_id)
+            if meta is None:
+                return None
+            entries = meta['entries']
+            row_kinds = np.array([entry[0] if entry else '' for entry in entries])
+            try:
+                matrix = self._open(project_id, meta, 'r')[:len(entries)]
+            except FileNotFoundError:
+                continue  # Replaced between reading meta.json and opening the file
+            reader = (matrix, entries, row_kinds)
+            self._readers.set(key, reader)
+            return reader
+        return None
+
+    def search(self, project_id, text, k=10, kinds=KINDS):
+        """Top ``k`` rows as (kind, id, card_id, cosine score), best first"""
+        reader = self._reader(project_id)
+        if reader is None or not reader[1]:
+            return []
+        matrix, entries, row_kinds = reader
+        scores = np.array(matrix @ self._embed([text])[0])
+        scores[~np.isin(row_kinds, kinds)] = -np.inf  # Also masks free rows
+        k = min(k, len(entries))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(entries[i][0], entries[i][1], entries[i][2], float(scores[i]))
+                for i in top if np.isfinite(scores[i]) and scores[i] > 0]
+
+    def card_scores(self, project_id, text, k=50):
+        """{card_id: best score of the card or any of its attachments} for the top ``k`` rows"""
+        scores = {}
+        for _, _, card_id, score in self.search(project_id, text, k):
+            scores[card_id] = max(score, scores.get(card_id, 0.0))
+        return scores
+
+    def drop(self, project_id):
+        shutil.rmtree(self._dir(project_id), ignore_errors=True)
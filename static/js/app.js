@@ -39,6 +39,47 @@ async function api(endpoint, options = {}) {
     return data;
 }
 
+// POST that answers with Server-Sent Events; calls onDelta(text) for each
+// chunk and resolves with the body of the final 'done' event
+async function apiStream(endpoint, body, onDelta, signal) {
+    const response = await fetch(`${API_BASE}${endpoint}`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'Authorization': `Bearer ${state.token}`
+        },
+        body: JSON.stringify({ ...body, stream: true }),
+        signal
+    });
+
+    // Plain JSON instead of a stream: an error, or a background job to poll
+    if (!response.ok || !(response.headers.get('Content-Type') || '').startsWith('text/event-stream')) {
+        const data = await response.json();
+        if (!response.ok) throw new Error(data.error || '请求失败');
+        return data;
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let end;
+        while ((end = buffer.indexOf('\n\n')) !== -1) {
+            const block = buffer.slice(0, end);
+            buffer = buffer.slice(end + 2);
+            const event = (block.match(/^event: (.*)$/m) || [])[1];
+            const data = JSON.parse((block.match(/^data: (.*)$/m) || [])[1] || '{}');
+            if (event === 'delta') onDelta(data.text);
+            else if (event === 'error') throw new Error(data.error);
+            else if (event === 'done') return data;
+        }
+    }
+    throw new Error('请求中断');
+}
+
 async function apiFormData(endpoint, formData) {
     const headers = {};
     if (state.token) {
@@ -317,6 +358,61 @@ async function loadProject(projectId) {
     }
 }
 
+// Re-fetch the board without re-joining the room
+async function refreshBoard() {
+    try {
+        const project = await api(`/projects/${state.currentProject.id}`);
+        if (state.currentProject?.id !== project.id) return;
+        state.currentProject = { ...state.currentProject, ...project };
+        state.cards = project.cards || [];
+        state.categories = project.categories || [];
+        renderKanban();
+        refreshCategoryFilter();
+    } catch (err) {
+        console.error('Failed to refresh board:', err);
+    }
+}
+
+// Apply typed changes from a board_delta event to local state
+function applyBoardChanges(changes) {
+    let categoriesChanged = false;
+    changes.forEach(change => {
+        const [entity, op] = change.type.split('.');
+        if (entity === 'project') {
+            Object.assign(state.currentProject, change.fields);
+            return;
+        }
+        const list = entity === 'card' ? state.cards : state.categories;
+        const index = list.findIndex(item => item.id === change.id);
+        if (op === 'deleted') {
+            if (index !== -1) list.splice(index, 1);
+        } else if (index !== -1) {
+            Object.assign(list[index], change.fields);
+        } else if (op === 'created') {
+            list.push(change.fields);
+        }
+        if (entity === 'category') {
+            categoriesChanged = true;
+            state.cards.forEach(card => {
+                const cardIndex = (card.categories || []).findIndex(c => c.id === change.id);
+                if (cardIndex === -1) return;
+                if (op === 'deleted') card.categories.splice(cardIndex, 1);
+                else Object.assign(card.categories[cardIndex], change.fields);
+            });
+        }
+    });
+    if (categoriesChanged) refreshCategoryFilter();
+}
+
+// Rebuild the filter options, keeping the current selections
+function refreshCategoryFilter() {
+    const category = document.getElementById('categoryFilter').value;
+    const assignee = document.getElementById('assigneeFilter').value;
+    updateFilters();
+    document.getElementById('categoryFilter').value = category;
+    document.getElementById('assigneeFilter').value = assignee;
+}
+
 function renderKanban() {
     const project = state.currentProject;
 
@@ -678,7 +774,11 @@ function renderAttachments(attachments) {
     list.innerHTML = attachments.map(att => `
         <div class="attachment-item" data-id="${att.id}">
             <div class="attachment-icon">
-                <i class="fas fa-${getFileIcon(att.file_type)}"></i>
+                ${hasThumbnail(att.file_type) ? `
+                    <img class="attachment-thumb" loading="lazy" alt=""
+                        src="${API_BASE}/attachments/${att.id}/thumbnail?size=sm&v=${Date.parse(att.uploaded_at)}"
+                        onerror="this.replaceWith(Object.assign(document.createElement('i'), {className: 'fas fa-${getFileIcon(att.file_type)}'}))">
+                ` : `<i class="fas fa-${getFileIcon(att.file_type)}"></i>`}
             </div>
             <div class="attachment-info">
                 <div class="attachment-name">${escapeHtml(att.original_filename)}</div>
@@ -1363,7 +1463,7 @@ function renderMembersList() {
             </div>
             <div class="attachment-info">
                 <div class="attachment-name">${escapeHtml(m.username)}</div>
-                <div class="attachment-size">${m.id === state.currentProject.owner_id ? '所有者' : '成员'}</div>
+                <div class="attachment-size">${m.id === state.currentProject.owner_id ? '所有者' : '成员'}${state.onlineUsers?.has(m.id) ? ' · 在线' : ''}</div>
             </div>
         </div>
     `).join('');
@@ -1399,22 +1499,56 @@ function initSocket() {
         state.socket.disconnect();
     }
 
-    state.socket = io();
+    state.socket = io({ auth: { token: state.token } });
+    state.onlineUsers = new Set();
 
     state.socket.on('connect', () => {
-        state.socket.emit('join', {
-            project_id: state.currentProject.id,
-            user_id: state.user.id
-        });
+        state.socket.emit('join', { project_id: state.currentProject.id });
+    });
+
+    state.socket.on('presence_state', (data) => {
+        if (data.project_id !== state.currentProject?.id) return;
+        state.onlineUsers = new Set(data.users.map(u => u.id));
+        renderMembersList();
+    });
+
+    state.socket.on('presence', (data) => {
+        if (data.project_id !== state.currentProject?.id) return;
+        data.joined.forEach(u => state.onlineUsers.add(u.id));
+        data.left.forEach(id => state.onlineUsers.delete(id));
+        renderMembersList();
     });
 
     state.socket.on('new_message', (message) => {
         appendChatMessage(message);
     });
 
+    // Several messages committed together (busy rooms, bot batches)
+    state.socket.on('new_messages', (data) => {
+        data.messages.forEach(msg => appendChatMessage(msg, false));
+        const container = document.getElementById('chatMessages');
+        container.scrollTop = container.scrollHeight;
+    });
+
+    state.socket.on('board_delta', (delta) => {
+        const project = state.currentProject;
+        if (!project || delta.project_id !== project.id) return;
+        if (delta.revision <= project.revision) return;  // Already reflected locally
+        if (delta.base_revision !== project.revision) {
+            // Missed an event (or it came from another worker) - resync
+            refreshBoard();
+            return;
+        }
+        applyBoardChanges(delta.changes);
+        project.revision = delta.revision;
+        renderKanban();
+    });
+
     state.socket.on('user_typing', (data) => {
+        const names = data.users.filter(u => u.id !== state.user.id).map(u => u.username);
+        if (!names.length) return;
         const indicator = document.getElementById('typingIndicator');
-        indicator.textContent = `${data.username} 正在输入...`;
+        indicator.textContent = `${names.join('、')} 正在输入...`;
         indicator.classList.remove('hidden');
 
         clearTimeout(window.typingTimeout);
@@ -1434,12 +1568,40 @@ async function loadChatMessages() {
 
         data.messages.forEach(msg => appendChatMessage(msg, false));
         container.scrollTop = container.scrollHeight;
+        state.chatOldestId = data.oldest_id;
+        state.chatHasMore = data.has_more;
     } catch (err) {
         console.error('Failed to load messages:', err);
     }
 }
 
-function appendChatMessage(msg, scroll = true) {
+// Load the page before the oldest message shown, keeping the scroll position
+async function loadOlderChatMessages() {
+    if (!state.chatHasMore || state.chatLoadingOlder || !state.chatOldestId) return;
+    state.chatLoadingOlder = true;
+    const projectId = state.currentProject.id;
+    try {
+        const data = await api(`/projects/${projectId}/messages?before=${state.chatOldestId}`);
+        if (state.currentProject?.id !== projectId) return;
+        const container = document.getElementById('chatMessages');
+        const previousHeight = container.scrollHeight;
+
+        data.messages.slice().reverse().forEach(msg => appendChatMessage(msg, false, true));
+        container.scrollTop += container.scrollHeight - previousHeight;
+        state.chatOldestId = data.oldest_id || state.chatOldestId;
+        state.chatHasMore = data.has_more;
+    } catch (err) {
+        console.error('Failed to load older messages:', err);
+    } finally {
+        state.chatLoadingOlder = false;
+    }
+}
+
+document.getElementById('chatMessages').addEventListener('scroll', (e) => {
+    if (e.target.scrollTop < 50) loadOlderChatMessages();
+});
+
+function appendChatMessage(msg, scroll = true, prepend = false) {
     const container = document.getElementById('chatMessages');
     const isOwn = msg.user_id === state.user?.id;
 
@@ -1452,7 +1614,11 @@ function appendChatMessage(msg, scroll = true) {
         <div class="message-content">
             ${!isOwn ? `<div class="message-sender">${escapeHtml(msg.user?.username || '未知')}</div>` : ''}
             ${msg.content ? `<div class="message-text">${escapeHtml(msg.content)}</div>` : ''}
-            ${msg.file_path ? `
+            ${msg.file_path && isImageFile(msg.file_name) ? `
+                <img class="message-image" loading="lazy" alt="${escapeHtml(msg.file_name || '')}"
+                    src="${API_BASE}/chat/files/${msg.file_path}/thumbnail?size=md"
+                    onclick="window.open('${API_BASE}/chat/files/${msg.file_path}', '_blank')">
+            ` : msg.file_path ? `
                 <div class="message-file" onclick="window.open('${API_BASE}/chat/files/${msg.file_path}', '_blank')">
                     <i class="fas fa-file"></i>
                     <span>${escapeHtml(msg.file_name || '文件')}</span>
@@ -1462,7 +1628,11 @@ function appendChatMessage(msg, scroll = true) {
         </div>
     `;
 
-    container.appendChild(div);
+    if (prepend) {
+        container.insertBefore(div, container.firstChild);
+    } else {
+        container.appendChild(div);
+    }
     if (scroll) container.scrollTop = container.scrollHeight;
 }
 
@@ -1480,12 +1650,10 @@ document.getElementById('chatInput').addEventListener('keypress', (e) => {
 });
 
 document.getElementById('chatInput').addEventListener('input', () => {
-    if (state.socket && state.currentProject) {
-        state.socket.emit('typing', {
-            project_id: state.currentProject.id,
-            user_id: state.user.id,
-            username: state.user.username
-        });
+    // The server throttles too, but there is no point sending every keystroke
+    if (state.socket && state.currentProject && Date.now() - (state.lastTypingSent || 0) > 1000) {
+        state.lastTypingSent = Date.now();
+        state.socket.emit('typing', { project_id: state.currentProject.id });
     }
 });
 
@@ -1579,15 +1747,22 @@ async function askAI() {
     container.appendChild(loadingMsg);
     container.scrollTop = container.scrollHeight;
 
+    // Render the answer as it is generated; leaving the project cancels it
+    if (state.aiAbort) state.aiAbort.abort();
+    const controller = state.aiAbort = new AbortController();
+    let answer = '';
     try {
-        const data = await api(`/projects/${state.currentProject.id}/ai/ask`, {
-            method: 'POST',
-            body: JSON.stringify({ question })
-        });
+        const data = await apiStream(`/projects/${state.currentProject.id}/ai/ask`, { question }, (text) => {
+            answer += text;
+            loadingMsg.innerHTML = `<p>${marked.parse(answer)}</p>`;
+            container.scrollTop = container.scrollHeight;
+        }, controller.signal);
 
         loadingMsg.innerHTML = `<p>${marked.parse(data.answer)}</p>`;
     } catch (err) {
-        loadingMsg.innerHTML = `<p style="color: var(--accent-danger);">${err.message}</p>`;
+        if (err.name !== 'AbortError') {
+            loadingMsg.innerHTML = `<p style="color: var(--accent-danger);">${err.message}</p>`;
+        }
     }
 
     container.scrollTop = container.scrollHeight;
@@ -1616,18 +1791,38 @@ document.getElementById('summarizeBtn').addEventListener('click', async () => {
     summaryContent.innerHTML = '<div class="loading"><div class="spinner"></div></div>';
     openModal('summaryModal');
 
+    if (state.aiAbort) state.aiAbort.abort();
+    const controller = state.aiAbort = new AbortController();
+    let summary = '';
     try {
-        const data = await api(`/projects/${state.currentProject.id}/ai/summarize`, {
-            method: 'POST',
-            body: JSON.stringify({ card_ids: selectedIds })
-        });
-
-        summaryContent.innerHTML = marked.parse(data.summary);
+        const data = await apiStream(`/projects/${state.currentProject.id}/ai/summarize`, { card_ids: selectedIds }, (text) => {
+            summary += text;
+            summaryContent.innerHTML = marked.parse(summary);
+        }, controller.signal);
+
+        // Large selections are summarized in the background
+        const result = data.job ? await waitForAIJob(data.job, summaryContent, controller.signal) : data.summary;
+        summaryContent.innerHTML = marked.parse(result);
     } catch (err) {
-        summaryContent.innerHTML = `<p style="color: var(--accent-danger);">${err.message}</p>`;
+        if (err.name !== 'AbortError') {
+            summaryContent.innerHTML = `<p style="color: var(--accent-danger);">${err.message}</p>`;
+        }
     }
 });
 
+async function waitForAIJob(job, progressEl, signal) {
+    while (job.status !== 'done') {
+        if (job.status === 'failed') throw new Error(job.error || '任务失败');
+        const { done, total } = job.progress;
+        progressEl.innerHTML = `<div class="loading"><div class="spinner"></div></div>
+            <p class="text-muted" style="text-align: center;">正在分段总结 ${done}/${total || '?'}</p>`;
+        await new Promise(resolve => setTimeout(resolve, 1000));
+        if (signal.aborted) throw new DOMException('Aborted', 'AbortError');
+        job = await api(`/ai/jobs/${job.id}`);
+    }
+    return job.result;
+}
+
 document.getElementById('copySummaryBtn').addEventListener('click', () => {
     const content = document.getElementById('summaryContent').innerText;
     navigator.clipboard.writeText(content);
@@ -1640,6 +1835,7 @@ document.getElementById('backToProjects').addEventListener('click', () => {
         state.socket.emit('leave', { project_id: state.currentProject.id });
         state.socket.disconnect();
     }
+    if (state.aiAbort) state.aiAbort.abort();
     state.currentProject = null;
     document.getElementById('chatPanel').classList.remove('open');
     document.getElementById('aiPanel').classList.remove('open');
@@ -1715,6 +1911,14 @@ function getFileIcon(type) {
     return icons[type] || 'file';
 }
 
+function hasThumbnail(type) {
+    return type === 'image' || type === 'pdf';
+}
+
+function isImageFile(filename) {
+    return /\.(png|jpe?g|gif)$/i.test(filename || '');
+}
+
 function debounce(fn, delay) {
     let timer;
     return function (...args) {
@@ -0,0 +1,72 @@
+"""Crash- and reader-safe file operations for attachments and their versions.
+
+Live files are never modified in place: new content is written to a temp
+file in the same directory and renamed over the target, so a concurrent
+download sees either the old or the new document, never a half-written one.
+That also makes hard links a safe way to keep version backups - the backup
+keeps pointing at the old inode after the live path is replaced.
+"""
+import os
+import shutil
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+
+def _temp_path_in(directory):
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.part')
+    return fd, tmp_path
+
+
+@contextmanager
+def atomic_replace(target_path):
+    """Yield a temp path next to ``target_path`` and rename it over the target on success."""
+    fd, tmp_path = _temp_path_in(os.path.dirname(target_path))
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def stream_to_temp(chunks, directory):
+    """Write an iterable of byte chunks to a fsynced temp file in ``directory``.
+
+    Returns ``(tmp_path, size, sha256_hexdigest)``; the caller renames or
+    removes the file. Memory use is one chunk regardless of total size.
+    """
+    fd, tmp_path = _temp_path_in(directory)
+    h = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                f.write(chunk)
+                h.update(chunk)
+                size += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return tmp_path, size, h.hexdigest()
+
+
+def copy_atomic(src, dst):
+    """Copy ``src`` over ``dst`` via a temp file, leaving any hard links to ``dst`` untouched."""
+    with atomic_replace(dst) as tmp_path:
+        shutil.copy2(src, tmp_path)
+
+
+def link_or_copy(src, dst):
+    """Preserve ``src`` at ``dst`` with a hard link (no data copied), copying if linking fails."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
@@ -0,0 +1,65 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp = tempfile.mkdtemp(prefix='teamwork-tests-')
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(_tmp, 'teamwork.db')}")
+
+
+@pytest.fixture(scope='session')
+def app():
+    import app as teamwork
+    app = teamwork.app
+    app.config.update(
+        TESTING=True,
+        UPLOAD_FOLDER=_tmp,
+        DERIVATIVE_FOLDER=os.path.join(_tmp, 'derivatives'),
+        CHAT_ARCHIVE_FOLDER=os.path.join(_tmp, 'archive', 'chat'),
+        SEMANTIC_INDEX_FOLDER=os.path.join(_tmp, 'semantic'),
+        AI_BACKEND='fake',
+    )
+    app.extensions['semantic'].folder = app.config['SEMANTIC_INDEX_FOLDER']
+    teamwork.init_db(app)
+    return app
+
+
+def _clear_tables(app):
+    from models import db
+    with app.app_context():
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.commit()
+
+
+@pytest.fixture
+def db(app):
+    """The database inside an app context, emptied after the test"""
+    from models import db
+    with app.app_context():
+        yield db
+        db.session.rollback()
+    _clear_tables(app)
+
+
+@pytest.fixture
+def client(app):
+    """Test client; each request gets its own app context and session, as in production"""
+    yield app.test_client()
+    _clear_tables(app)
+
+
+@pytest.fixture
+def auth(client):
+    """auth(username) -> (headers, user) for a registered user"""
+    def auth(username='alice'):
+        response = client.post('/api/auth/register', json={
+            'username': username, 'email': f'{username}@example.com', 'password': 'pw'})
+        if response.status_code != 201:
+            response = client.post('/api/auth/login', json={'username': username, 'password': 'pw'})
+        data = response.get_json()
+        return {'Authorization': f"Bearer {data['access_token']}"}, data['user']
+    return auth
@@ -0,0 +1,48 @@
+import ai_backend
+from ai_backend import AIDispatcher, OpenAIBackend, FakeBackend
+
+
+class RecordingBackend(FakeBackend):
+    def __init__(self):
+        super().__init__()
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_replaced_backend_is_closed_after_in_flight_calls(monkeypatch):
+    monkeypatch.setattr(ai_backend, 'backend_from_config', lambda config: RecordingBackend())
+    dispatcher = AIDispatcher(max_concurrency=2, queue_timeout=1)
+    first = dispatcher.for_config({'OPENAI_API_KEY': 'a'})
+    stream = first.stream('m', [{'role': 'user', 'content': 'hello'}], 10)
+    old = first._backend
+
+    second = dispatcher.for_config({'OPENAI_API_KEY': 'b'})
+    assert second._backend is not old
+    assert not old.closed  # The open stream still uses it
+    assert ''.join(stream)
+    stream.close()
+    assert old.closed
+
+    # No calls in flight: closed when replaced
+    current = second._backend
+    dispatcher.for_config({'OPENAI_API_KEY': 'c'})
+    assert current.closed
+    assert dispatcher._in_flight == {}
+
+
+def test_unchanged_settings_keep_the_backend(monkeypatch):
+    monkeypatch.setattr(ai_backend, 'backend_from_config', lambda config: RecordingBackend())
+    dispatcher = AIDispatcher()
+    backend = dispatcher.for_config({'OPENAI_API_KEY': 'a'})._backend
+    assert dispatcher.for_config({'OPENAI_API_KEY': 'a'})._backend is backend
+    assert not backend.closed
+
+
+def test_openai_backend_close_releases_the_pool():
+    backend = OpenAIBackend('key', base_url='http://127.0.0.1:9/v1')
+    client = backend.client
+    backend.close()
+    assert client.is_closed()
+    assert backend.client is not client
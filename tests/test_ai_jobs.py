@@ -0,0 +1,54 @@
+import pytest
+
+import app as teamwork
+from ai_backend import FakeBackend
+from map_reduce import MAP_INSTRUCTION
+
+
+@pytest.fixture
+def summarize(app, client, auth, monkeypatch):
+    # Run background jobs inline, in the request that starts them
+    monkeypatch.setattr(teamwork.socketio, 'start_background_task', lambda fn, *args: fn(*args))
+    monkeypatch.setitem(app.config, 'AI_SUMMARY_CHUNK_TOKENS', 400)
+    headers, _ = auth()
+    project = client.post('/api/projects', json={'name': 'P'}, headers=headers).get_json()
+    card_ids = [client.post(f"/api/projects/{project['id']}/cards", headers=headers,
+                            json={'title': f'卡片{i}', 'content': '很长的卡片描述。' * 80}).get_json()['id']
+                for i in range(8)]
+
+    def summarize(**data):
+        response = client.post(f"/api/projects/{project['id']}/ai/summarize", headers=headers,
+                               json={'card_ids': card_ids, 'mode': 'map_reduce', **data})
+        assert response.status_code == 202, response.get_json()
+        job_id = response.get_json()['job']['id']
+        return client.get(f'/api/ai/jobs/{job_id}', headers=headers).get_json()
+    return summarize
+
+
+def test_job_reports_progress_and_result(summarize):
+    job = summarize()
+    assert job['status'] == 'done'
+    assert job['stage'] == 'reduce'
+    assert job['progress']['done'] == job['progress']['total'] > 2
+    assert job['result'].startswith('摘要:')
+
+
+def test_failed_map_call_fails_the_job(summarize, monkeypatch):
+    complete = FakeBackend.complete
+
+    def flaky(self, model, messages, max_tokens):
+        if messages[0]['content'] == MAP_INSTRUCTION:
+            raise RuntimeError('rate limited')
+        return complete(self, model, messages, max_tokens)
+    monkeypatch.setattr(FakeBackend, 'complete', flaky)
+
+    job = summarize()
+    assert job['status'] == 'failed'
+    assert 'rate limited' in job['error']
+    assert job['result'] is None
+
+
+def test_other_users_cannot_read_a_job(summarize, client, auth):
+    job = summarize()
+    headers, _ = auth('bob')
+    assert client.get(f"/api/ai/jobs/{job['id']}", headers=headers).status_code == 403
@@ -0,0 +1,35 @@
+import pytest
+
+
+@pytest.fixture
+def project(client, auth):
+    headers, _ = auth()
+    project = client.post('/api/projects', json={'name': 'P'}, headers=headers).get_json()
+    response = client.post(f"/api/projects/{project['id']}/messages:batch", headers=headers,
+                           json={'messages': [{'content': f'm{i}'} for i in range(10)]})
+    assert response.status_code == 201, response.get_json()
+    return project, headers
+
+
+def page(client, project, headers, **params):
+    return client.get(f"/api/projects/{project['id']}/messages", query_string=params, headers=headers)
+
+
+def test_before_and_after_pages(client, project):
+    project, headers = project
+    latest = page(client, project, headers, per_page=4).get_json()
+    assert [m['content'] for m in latest['messages']] == ['m6', 'm7', 'm8', 'm9']
+    older = page(client, project, headers, per_page=4, before=latest['messages'][0]['id']).get_json()
+    assert [m['content'] for m in older['messages']] == ['m2', 'm3', 'm4', 'm5']
+    newer = page(client, project, headers, per_page=2, after=older['messages'][-1]['id']).get_json()
+    assert [m['content'] for m in newer['messages']] == ['m6', 'm7']
+
+
+@pytest.mark.parametrize('params', [
+    {'before': 5, 'after': 2},
+    {'before': 5, 'around': 3},
+    {'after': 2, 'around': 3},
+])
+def test_only_one_cursor(client, project, params):
+    project, headers = project
+    assert page(client, project, headers, **params).status_code == 400
@@ -0,0 +1,44 @@
+import os
+import queue
+
+import socketio
+
+from fanout import MemoryFanout
+
+
+def make_server(channel):
+    return socketio.Server(async_mode='threading', client_manager=MemoryFanout(channel=channel))
+
+
+def test_emit_before_any_connect():
+    sender = make_server('emit-before-connect')
+    receiver = make_server('emit-before-connect')
+    received = queue.Queue()
+    receiver.manager._handle_emit = received.put
+    # What a socket connect does; the sending server never sees one
+    receiver.manager.initialize()
+
+    sender.emit('board_delta', {'revision': 1}, room='project_1')
+
+    message = received.get(timeout=5)
+    assert message['event'] == 'board_delta'
+    assert message['data'] == {'revision': 1}
+    assert message['host_id'] == sender.manager.host_id != receiver.manager.host_id
+
+
+def test_sender_started_once_per_process():
+    server = make_server('sender-once')
+    server.emit('a', 1)
+    outbox = server.manager._outbox
+    server.manager.initialize()
+    server.emit('b', 2)
+    assert server.manager._outbox is outbox
+    assert server.manager._sender_pid == os.getpid()
+
+
+def test_host_id_is_per_process():
+    manager = MemoryFanout(channel='host-id')
+    host_id = manager.host_id
+    # As if the manager had been created in the gunicorn master before fork
+    manager._host = (-1, host_id)
+    assert manager.host_id != host_id
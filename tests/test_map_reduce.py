@@ -0,0 +1,51 @@
+import pytest
+
+import map_reduce
+from map_reduce import summarize, chunk_texts, MAP_INSTRUCTION, REDUCE_INSTRUCTION, SUMMARY_INSTRUCTION
+
+
+def short_summary(instruction, content):
+    return f'{instruction[:2]}:{content[:20]}'
+
+
+def test_single_chunk_is_one_call():
+    calls = []
+    progress = []
+    summary = summarize(lambda i, c: calls.append(i) or 'done', ['a', 'b'], 1000,
+                        progress=lambda *p: progress.append(p))
+    assert summary == 'done'
+    assert calls == [SUMMARY_INSTRUCTION]
+    assert progress == [(1, 1, 'reduce')]
+
+
+def test_map_then_reduce_reports_progress():
+    texts = ['word ' * 400 for _ in range(6)]
+    chunks = chunk_texts(texts, 200)
+    progress = []
+    summary = summarize(short_summary, texts, 200, parallelism=3, progress=lambda *p: progress.append(p))
+    assert summary.startswith(REDUCE_INSTRUCTION[:2])
+    total = len(chunks) + 1
+    assert [p[0] for p in progress] == list(range(1, total + 1))
+    assert {p[1] for p in progress} == {total}
+    assert [p[2] for p in progress] == ['map'] * len(chunks) + ['reduce']
+
+
+def test_failed_chunk_fails_the_summary():
+    def complete(instruction, content):
+        if instruction == MAP_INSTRUCTION and 'broken' in content:
+            raise RuntimeError('upstream error')
+        return 'ok'
+
+    with pytest.raises(RuntimeError, match='upstream error'):
+        summarize(complete, ['fine ' * 300, 'broken ' * 300], 200)
+
+
+def test_reduce_rounds_are_bounded(monkeypatch):
+    monkeypatch.setattr(map_reduce, 'MAX_REDUCE_ROUNDS', 2)
+    calls = []
+
+    def complete(instruction, content):
+        calls.append(instruction)
+        return content  # Never shrinks, so every round still needs reducing
+    summarize(complete, ['word ' * 400 for _ in range(4)], 200)
+    assert calls[-1] == REDUCE_INSTRUCTION
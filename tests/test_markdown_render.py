@@ -0,0 +1,53 @@
+import markdown
+import bleach
+
+from markdown_render import MarkdownRenderer, EXTENSIONS, ALLOWED_TAGS, ALLOWED_ATTRS
+
+DOCS = [
+    '# Title\n\n| a | b |\n|---|---|\n| 1 | 2 |\n',
+    '```python\nprint(1)\n```',
+    '<script>alert(1)</script> **bold** [link](javascript:alert(1))',
+    '',
+]
+
+
+def reference(content):
+    html = markdown.markdown(content, extensions=EXTENSIONS)
+    return bleach.clean(html, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRS)
+
+
+def test_render_matches_fresh_parser_and_reuses_pool():
+    renderer = MarkdownRenderer(cache_size=16, pool_size=2)
+    for content in DOCS:
+        assert renderer.render(content) == reference(content)
+    assert len(renderer._idle) == 1
+    assert renderer.render(DOCS[0]) == reference(DOCS[0])
+    assert renderer.cache.stats()['hits'] == 1
+
+
+def test_batch_requires_auth(client):
+    response = client.post('/api/render-markdown:batch', json={'items': [{'id': 1, 'content': '*a*'}]})
+    assert response.status_code == 401
+
+
+def test_batch_renders_items(client, auth):
+    headers, _ = auth()
+    response = client.post('/api/render-markdown:batch', headers=headers,
+                           json={'items': [{'id': i, 'content': c} for i, c in enumerate(DOCS)]})
+    assert response.status_code == 200
+    assert response.get_json()['results'] == [{'id': i, 'html': reference(c)} for i, c in enumerate(DOCS)]
+
+
+def test_batch_rejects_bad_input(app, client, auth):
+    headers, _ = auth()
+    post = lambda items: client.post('/api/render-markdown:batch', headers=headers, json={'items': items})
+    assert post([{'id': 1, 'content': 5}]).status_code == 400
+    assert post(['text']).status_code == 400
+    assert post([{'content': 'x'}] * (app.config['MARKDOWN_BATCH_MAX'] + 1)).status_code == 400
+    assert post([{'content': 'x' * (app.config['MARKDOWN_ITEM_MAX_CHARS'] + 1)}]).status_code == 400
+    count = app.config['MARKDOWN_BATCH_MAX_CHARS'] // app.config['MARKDOWN_ITEM_MAX_CHARS'] + 1
+    assert post([{'content': 'x' * app.config['MARKDOWN_ITEM_MAX_CHARS']}] * count).status_code == 400
+
+
+def test_single_render_rejects_non_string(client):
+    assert client.post('/api/render-markdown', json={'content': 5}).status_code == 400
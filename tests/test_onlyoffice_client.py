@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+from onlyoffice_client import CircuitBreaker, OnlyOfficeClient, OnlyOfficeUnavailable
+from onlyoffice_stub import OnlyOfficeStub
+
+
+@pytest.fixture
+def stub():
+    stub = OnlyOfficeStub().start()
+    yield stub
+    stub.stop()
+
+
+def open_breaker(threshold=2, reset_timeout=0.05):
+    breaker = CircuitBreaker(threshold, reset_timeout)
+    for _ in range(threshold):
+        breaker.record_failure()
+    return breaker
+
+
+def test_half_open_admits_a_single_probe():
+    breaker = open_breaker()
+    assert breaker.allow() is False
+    time.sleep(0.06)
+    assert breaker.state == 'half-open'
+    assert [breaker.allow() for _ in range(5)] == [True, False, False, False, False]
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    assert all(breaker.allow() for _ in range(5))
+
+
+def test_failed_probe_reopens():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert breaker.allow() is True
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert breaker.allow() is False
+    time.sleep(0.06)
+    assert breaker.allow() is True
+
+
+def test_unreported_probe_is_given_up():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert breaker.allow() is True
+    time.sleep(0.06)
+    assert breaker.allow() is True
+
+
+def test_client_fails_fast_then_recovers(stub):
+    client = OnlyOfficeClient(stub.url, retries=0, breaker_threshold=2, breaker_reset=0.05)
+    stub.fail_next(2)
+    assert client.drop('a') is False
+    assert client.drop('b') is False
+    assert client.breaker.state == 'open'
+    with pytest.raises(OnlyOfficeUnavailable):
+        client.command('drop', key='c')
+    assert stub.commands == []
+    time.sleep(0.06)
+    assert client.drop('d') is True
+    assert client.breaker.state == 'closed'
+    assert [c['key'] for c in stub.commands] == ['d']
+
+
+def test_retries_count_as_one_failure(stub):
+    client = OnlyOfficeClient(stub.url, retries=2, backoff=0, breaker_threshold=2, breaker_reset=0.05)
+    stub.fail_next(3)
+    assert client.drop('a') is False
+    assert client.breaker.state == 'closed'
+    assert client.drop('b') is True
+    assert [c['key'] for c in stub.commands] == ['b']
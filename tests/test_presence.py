@@ -0,0 +1,67 @@
+import os
+import time
+from datetime import datetime, timedelta
+
+from models import User, PresenceSocket
+from presence import PresenceRegistry, TypingCoalescer
+
+
+def make_user(db, name):
+    user = User(username=name, email=f'{name}@example.com')
+    user.set_password('pw')
+    db.session.add(user)
+    db.session.commit()
+    return {'id': user.id, 'username': user.username, 'avatar_color': user.avatar_color}
+
+
+def worker(name):
+    """A registry standing in for another worker process"""
+    registry = PresenceRegistry(ttl=90)
+    registry._worker = (os.getpid(), name)
+    return registry
+
+
+def test_presence_is_shared_between_workers(db):
+    alice = make_user(db, 'alice')
+    a, b = worker('a'), worker('b')
+    assert a.join('project_1', 'sid-a', alice) is True
+    assert b.join('project_1', 'sid-b', alice) is False
+    assert [u['id'] for u in a.users('project_1')] == [alice['id']]
+    assert [u['id'] for u in b.users('project_1')] == [alice['id']]
+    # Still connected through the other worker
+    assert a.leave('project_1', 'sid-a', alice['id']) is False
+    assert b.leave('project_1', 'sid-b', alice['id']) is True
+    assert a.users('project_1') == []
+
+
+def test_dead_worker_sockets_expire(db):
+    alice = make_user(db, 'alice')
+    a, b = worker('a'), worker('b')
+    b.join('project_1', 'sid-b', alice)
+    # Worker b stops heartbeating
+    PresenceSocket.query.update({'seen_at': datetime.utcnow() - timedelta(seconds=120)})
+    db.session.commit()
+    assert a.users('project_1') == []
+    assert a.heartbeat() == [('project_1', alice['id'])]
+    assert PresenceSocket.query.count() == 0
+    assert a.join('project_1', 'sid-a', alice) is True
+
+
+def test_heartbeat_keeps_own_sockets_alive(db):
+    alice = make_user(db, 'alice')
+    a = worker('a')
+    a.join('project_1', 'sid-a', alice)
+    PresenceSocket.query.update({'seen_at': datetime.utcnow() - timedelta(seconds=120)})
+    db.session.commit()
+    assert a.heartbeat() == []
+    assert [u['id'] for u in a.users('project_1')] == [alice['id']]
+
+
+def test_typing_throttle_entries_expire():
+    emitted = []
+    typing = TypingCoalescer(lambda *a, **k: emitted.append(a), lambda *a: None, window=0, interval=0.01)
+    for i in range(100):
+        typing.typing(f'project_{i}', {'id': i})
+    time.sleep(0.02)
+    typing.typing('project_x', {'id': 'x'})
+    assert list(typing._last) == [('project_x', 'x')]
@@ -0,0 +1,59 @@
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('numpy')
+
+from semantic_index import SemanticIndex, HashingEmbedder
+
+
+@pytest.fixture
+def index(tmp_path):
+    return SemanticIndex(str(tmp_path), HashingEmbedder(64), initial_capacity=4)
+
+
+def test_open_readers_never_see_reused_rows(index):
+    index.build(1, [('card', 1, 1, 'deploy servers'), ('card', 2, 2, 'lunch menu')])
+    reader = index._reader(1)
+    index.apply(1, deletes=[('card', 1)])
+    index.apply(1, upserts=[('card', 3, 3, 'deploy servers')])
+    # The old view scores the deleted row as zero; it isn't attributed to card 3
+    matrix, entries, _ = reader
+    assert entries[0] == ['card', 1, 1] and not matrix[0].any()
+    assert index.search(1, 'deploy servers', k=5)[0][:3] == ('card', 3, 3)
+    assert [e for e in index._read_meta(1)['entries']] == [None, ['card', 2, 2], ['card', 3, 3]]
+
+
+def test_full_file_is_compacted_into_a_new_one(index):
+    index.build(1, [('card', i, i, f'topic{i}') for i in range(3)])
+    first = index._read_meta(1)['vectors']
+    # Capacity is twice the rows written; each update appends a row
+    for _ in range(4):
+        index.apply(1, upserts=[('card', 0, 0, 'topic0 again')])
+    meta = index._read_meta(1)
+    assert meta['vectors'] != first
+    assert sorted(e[1] for e in meta['entries'] if e) == [0, 1, 2]
+    assert [n for n in os.listdir(index._dir(1)) if n.startswith('vectors')] == [meta['vectors']]
+    assert index.search(1, 'topic2', k=1)[0][1] == 2
+
+
+def test_ensure_builds_once_for_concurrent_callers(index):
+    loads = []
+
+    def load_items():
+        loads.append(1)
+        time.sleep(0.1)
+        return [('card', 1, 1, 'text')]
+
+    threads = [threading.Thread(target=index.ensure, args=(1, load_items)) for _ in range(4)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert loads == [1]
+    assert index.is_current(1)
+
+
+def test_apply_without_index_is_left_for_a_lazy_build(index):
+    assert index.apply(1, upserts=[('card', 1, 1, 'text')]) is False
+    assert not index.is_current(1)